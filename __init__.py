@@ -1,8 +1,15 @@
 from fastapi import APIRouter
 
 from .crud import db
+from .electrum import close_electrum_clients
+from .filterscan import cancel_filter_scans
+from .mempool import close_http_client
+from .scanner import cancel_scans
 from .views import watchonly_generic_router
 from .views_api import watchonly_api_router
+from .warmer import start_warmer, stop_warmer
+from .watcher import stop_watchers
+from .workers import start_workers, stop_workers
 
 watchonly_static_files = [
     {
@@ -15,4 +22,26 @@ watchonly_ext: APIRouter = APIRouter(prefix="/watchonly", tags=["watchonly"])
 watchonly_ext.include_router(watchonly_generic_router)
 watchonly_ext.include_router(watchonly_api_router)
 
-__all__ = ["watchonly_ext", "watchonly_static_files", "db"]
+
+def watchonly_start():
+    start_workers()
+    start_warmer()
+
+
+async def watchonly_stop():
+    cancel_scans()
+    cancel_filter_scans()
+    stop_watchers()
+    stop_warmer()
+    stop_workers()
+    await close_http_client()
+    await close_electrum_clients()
+
+
+__all__ = [
+    "db",
+    "watchonly_ext",
+    "watchonly_start",
+    "watchonly_static_files",
+    "watchonly_stop",
+]
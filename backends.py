@@ -0,0 +1,187 @@
+"""
+Chain data sources of the server side features (scanning, watching, previous
+transactions, broadcasting), selected by `Config.chain_backend`.
+"""
+
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import httpx
+from embit.transaction import Transaction
+
+from .electrum import ElectrumClient, get_electrum_client
+from .helpers import address_scripthash, mempool_api_url, script_scripthash
+from .mempool import (
+    HTTP_MAX_CONNECTIONS_PER_HOST,
+    MempoolClient,
+    address_balance,
+    address_tx_count,
+)
+from .models import (
+    Address,
+    AddressHistory,
+    AddressUtxo,
+    CachedTransaction,
+    Config,
+)
+
+
+class ChainBackend(ABC):
+    @abstractmethod
+    async def get_address_histories(
+        self, addresses: list[Address]
+    ) -> list[AddressHistory]:
+        """Balance (unconfirmed included), number of transactions and UTXOs of
+        the addresses, in order"""
+
+    @abstractmethod
+    async def get_transactions(self, tx_ids: list[str]) -> list[CachedTransaction]:
+        """Raw transactions, with the block height once they are confirmed"""
+
+    @abstractmethod
+    async def broadcast(self, tx_hex: str) -> str:
+        """Broadcast the raw transaction, returns the transaction id"""
+
+
+class EsploraBackend(ChainBackend):
+    """mempool.space (Esplora) REST API, one request per address"""
+
+    def __init__(self, client: MempoolClient):
+        self.client = client
+
+    async def get_address_histories(
+        self, addresses: list[Address]
+    ) -> list[AddressHistory]:
+        return await asyncio.gather(
+            *[self._address_history(a.address) for a in addresses]
+        )
+
+    async def _address_history(self, address: str) -> AddressHistory:
+        stats = await self.client.get_address_stats(address)
+        history = AddressHistory(
+            amount=address_balance(stats), tx_count=address_tx_count(stats)
+        )
+        if history.amount:
+            history.utxos = await self.client.get_address_utxos(address)
+        return history
+
+    async def get_transactions(self, tx_ids: list[str]) -> list[CachedTransaction]:
+        return await asyncio.gather(*[self._transaction(i) for i in tx_ids])
+
+    async def _transaction(self, tx_id: str) -> CachedTransaction:
+        tx_hex, status = await asyncio.gather(
+            self.client.get_tx_hex(tx_id), self.client.get_tx_status(tx_id)
+        )
+        block_height = status.get("block_height") if status.get("confirmed") else None
+        return CachedTransaction(id=tx_id, tx_hex=tx_hex, block_height=block_height)
+
+    async def broadcast(self, tx_hex: str) -> str:
+        return await self.client.broadcast(tx_hex)
+
+
+class ElectrumBackend(ChainBackend):
+    """Electrum server, the requests for all the addresses are pipelined"""
+
+    def __init__(self, client: ElectrumClient):
+        self.client = client
+
+    async def get_address_histories(
+        self, addresses: list[Address]
+    ) -> list[AddressHistory]:
+        scripthashes = [_scripthash(a) for a in addresses]
+        results = await self.client.batch(
+            [("blockchain.scripthash.get_history", [h]) for h in scripthashes]
+            + [("blockchain.scripthash.listunspent", [h]) for h in scripthashes]
+        )
+        histories, unspents = results[: len(addresses)], results[len(addresses) :]
+        return [
+            AddressHistory(
+                amount=sum(utxo["value"] for utxo in unspent),
+                tx_count=len(history),
+                utxos=[_electrum_utxo(utxo) for utxo in unspent],
+            )
+            for history, unspent in zip(histories, unspents)
+        ]
+
+    async def subscribe(self, addresses: list[Address]) -> dict[str, Optional[str]]:
+        """Subscribe to the changes of the addresses, returns their status by
+        scripthash (see `ElectrumClient.listen()` for the notifications)"""
+        scripthashes = [_scripthash(a) for a in addresses]
+        statuses = await self.client.batch(
+            [("blockchain.scripthash.subscribe", [h]) for h in scripthashes]
+        )
+        return dict(zip(scripthashes, statuses))
+
+    async def get_transactions(self, tx_ids: list[str]) -> list[CachedTransaction]:
+        txs_hex = await self.client.batch(
+            [("blockchain.transaction.get", [tx_id]) for tx_id in tx_ids]
+        )
+        # the height is found in the history of the first output of the tx
+        scripthashes = [
+            script_scripthash(
+                Transaction.from_string(tx_hex).vout[0].script_pubkey.data
+            )
+            for tx_hex in txs_hex
+        ]
+        histories = await self.client.batch(
+            [("blockchain.scripthash.get_history", [h]) for h in scripthashes]
+        )
+        txs = []
+        for tx_id, tx_hex, history in zip(tx_ids, txs_hex, histories):
+            height = next((h["height"] for h in history if h["tx_hash"] == tx_id), 0)
+            txs.append(
+                CachedTransaction(
+                    id=tx_id, tx_hex=tx_hex, block_height=height if height > 0 else None
+                )
+            )
+        return txs
+
+    async def broadcast(self, tx_hex: str) -> str:
+        return await self.client.request("blockchain.transaction.broadcast", tx_hex)
+
+
+def _scripthash(address: Address) -> str:
+    # stored since the addresses are created, computed for older rows
+    return address.scripthash or address_scripthash(address.address)
+
+
+def _electrum_utxo(utxo: dict) -> AddressUtxo:
+    # height 0 (or -1 with unconfirmed parents) for the mempool
+    confirmed = utxo["height"] > 0
+    return AddressUtxo(
+        tx_id=utxo["tx_hash"],
+        vout=utxo["tx_pos"],
+        amount=utxo["value"],
+        confirmed=confirmed,
+        block_height=utxo["height"] if confirmed else None,
+    )
+
+
+def electrum_server(config: Config, network: str) -> str:
+    if network == "Mainnet":
+        return config.electrum_server
+    return config.electrum_testnet_server
+
+
+def chain_backend(
+    config: Config,
+    network: str,
+    concurrency: int = HTTP_MAX_CONNECTIONS_PER_HOST,
+    rate_limit: float = 0,
+    http_client: Optional[httpx.AsyncClient] = None,
+) -> ChainBackend:
+    """Backend of the user config for the network. `concurrency` and
+    `rate_limit` only apply to the Esplora API"""
+    if config.chain_backend == "electrum":
+        server = electrum_server(config, network)
+        if not server:
+            raise ValueError(f"No Electrum server configured for {network}.")
+        return ElectrumBackend(get_electrum_client(server))
+    client = MempoolClient(
+        mempool_api_url(config.mempool_endpoint, network),
+        concurrency=concurrency,
+        rate_limit=rate_limit,
+        http_client=http_client,
+    )
+    return EsploraBackend(client)
@@ -0,0 +1,119 @@
+"""
+BIP158 compact block filters ("basic" type): a Golomb-coded set of the
+output scripts of a block and of the scripts spent by its inputs. A wallet can
+tell, without revealing its addresses, whether a block may concern it.
+"""
+
+from collections.abc import Iterable
+from io import BytesIO
+
+from embit import compact
+
+# Golomb-Rice parameter and false positive rate (1/M) of the basic filter
+FILTER_P = 19
+FILTER_M = 784931
+
+MASK_64 = (1 << 64) - 1
+
+
+def _rotl(x: int, b: int) -> int:
+    return ((x << b) | (x >> (64 - b))) & MASK_64
+
+
+def _sipround(v0: int, v1: int, v2: int, v3: int) -> tuple[int, int, int, int]:
+    v0 = (v0 + v1) & MASK_64
+    v1 = _rotl(v1, 13) ^ v0
+    v0 = _rotl(v0, 32)
+    v2 = (v2 + v3) & MASK_64
+    v3 = _rotl(v3, 16) ^ v2
+    v0 = (v0 + v3) & MASK_64
+    v3 = _rotl(v3, 21) ^ v0
+    v2 = (v2 + v1) & MASK_64
+    v1 = _rotl(v1, 17) ^ v2
+    v2 = _rotl(v2, 32)
+    return v0, v1, v2, v3
+
+
+def siphash(k0: int, k1: int, data: bytes) -> int:
+    """SipHash-2-4 of the data, with the 128 bits key `(k0, k1)`"""
+    v0 = k0 ^ 0x736F6D6570736575
+    v1 = k1 ^ 0x646F72616E646F6D
+    v2 = k0 ^ 0x6C7967656E657261
+    v3 = k1 ^ 0x7465646279746573
+    end = len(data) - len(data) % 8
+    for i in range(0, end, 8):
+        m = int.from_bytes(data[i : i + 8], "little")
+        v3 ^= m
+        v0, v1, v2, v3 = _sipround(v0, v1, v2, v3)
+        v0, v1, v2, v3 = _sipround(v0, v1, v2, v3)
+        v0 ^= m
+    m = ((len(data) & 0xFF) << 56) | int.from_bytes(data[end:], "little")
+    v3 ^= m
+    v0, v1, v2, v3 = _sipround(v0, v1, v2, v3)
+    v0, v1, v2, v3 = _sipround(v0, v1, v2, v3)
+    v0 ^= m
+    v2 ^= 0xFF
+    for _ in range(4):
+        v0, v1, v2, v3 = _sipround(v0, v1, v2, v3)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+class BlockFilter:
+    def __init__(self, block_hash: str, data: bytes):
+        """`block_hash` as displayed (hex), `data` is the serialized filter"""
+        stream = BytesIO(data)
+        self.n = compact.read_from(stream)
+        self._data = stream.read()
+        # the key is the first 16 bytes of the block hash (internal order)
+        key = bytes.fromhex(block_hash)[::-1]
+        self._k0 = int.from_bytes(key[:8], "little")
+        self._k1 = int.from_bytes(key[8:16], "little")
+
+    def hash_to_range(self, item: bytes) -> int:
+        return (siphash(self._k0, self._k1, item) * self.n * FILTER_M) >> 64
+
+    def values(self) -> set[int]:
+        """The hashed items of the set"""
+        bits = bin(int.from_bytes(b"\x01" + self._data, "big"))[3:]
+        values: set[int] = set()
+        value, pos = 0, 0
+        for _ in range(self.n):
+            # quotient in unary (1s ended by a 0), remainder on P bits
+            end = bits.index("0", pos)
+            remainder = int(bits[end + 1 : end + 1 + FILTER_P], 2)
+            value += ((end - pos) << FILTER_P) | remainder
+            values.add(value)
+            pos = end + 1 + FILTER_P
+        return values
+
+    def match_any(self, items: Iterable[bytes]) -> bool:
+        """True if one of the items may be in the block (false positive rate
+        1/M per item)"""
+        if not self.n:
+            return False
+        values = self.values()
+        return any(self.hash_to_range(item) in values for item in items)
+
+
+def match_block_filters(
+    filters: list[tuple[str, bytes]], scripts: list[bytes]
+) -> list[bool]:
+    """For each `(block hash, filter)`, whether one of the scripts may be in the
+    block. Run in the worker pool"""
+    return [BlockFilter(h, data).match_any(scripts) for h, data in filters]
+
+
+def build_block_filter(block_hash: str, items: Iterable[bytes]) -> bytes:
+    """Serialized filter of the (non empty) items"""
+    unique = {item for item in items if item}
+    block_filter = BlockFilter(block_hash, compact.to_bytes(len(unique)))
+    bits = []
+    last = 0
+    for value in sorted(block_filter.hash_to_range(item) for item in unique):
+        delta, last = value - last, value
+        bits.append("1" * (delta >> FILTER_P) + "0")
+        bits.append(format(delta & ((1 << FILTER_P) - 1), f"0{FILTER_P}b"))
+    bitstring = "".join(bits)
+    bitstring += "0" * (-len(bitstring) % 8)
+    data = int(bitstring, 2).to_bytes(len(bitstring) // 8, "big") if bitstring else b""
+    return compact.to_bytes(len(unique)) + data
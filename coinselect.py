@@ -0,0 +1,151 @@
+from math import ceil
+from typing import NamedTuple, Optional
+
+# version, locktime, input and output counts; plus the segwit marker and flag
+TX_OVERHEAD_WEIGHT = 4 * (4 + 4 + 1 + 1)
+SEGWIT_OVERHEAD_WEIGHT = 2
+# smaller change outputs are not worth creating, the amount goes to the fee
+DUST_LIMIT = 546
+# same limit as Bitcoin Core
+BNB_MAX_TRIES = 100_000
+
+
+class Coin(NamedTuple):
+    amount: int
+    # weight of the input spending the coin
+    weight: int
+
+
+class Selection(NamedTuple):
+    # indexes of the selected coins
+    coins: list[int]
+    fee: int
+    change: int
+    weight: int
+    algorithm: str
+
+
+def fee_for(weight: int, fee_rate: float) -> int:
+    """Fee in sats for `weight` weight units at `fee_rate` sat/vbyte"""
+    return ceil(weight * fee_rate / 4)
+
+
+def select_coins(
+    coins: list[Coin],
+    target: int,
+    fixed_weight: int,
+    change_weight: int,
+    change_spend_weight: int,
+    fee_rate: float,
+) -> Optional[Selection]:
+    """
+    Select the coins paying `target` sats plus the fee.
+    `fixed_weight` is the weight of the outputs, `change_weight` the weight of
+    the change output and `change_spend_weight` the weight of the input
+    spending the change later.
+    Branch and bound looks for a selection without change first, the
+    largest-first selection (with change) is the fallback.
+    Returns `None` if the coins do not cover the amount and the fee.
+    """
+    # the segwit marker is always counted, legacy only transactions overpay
+    # by half a vbyte
+    fixed_weight += TX_OVERHEAD_WEIGHT + SEGWIT_OVERHEAD_WEIGHT
+    target_value = target + fee_for(fixed_weight, fee_rate)
+
+    # only coins worth more than the fee for spending them
+    effective = [coin.amount - fee_for(coin.weight, fee_rate) for coin in coins]
+    pool = sorted(
+        (i for i, value in enumerate(effective) if value > 0),
+        key=lambda i: effective[i],
+        reverse=True,
+    )
+    if sum(effective[i] for i in pool) < target_value:
+        return None
+
+    cost_of_change = fee_for(change_weight + change_spend_weight, fee_rate)
+    selected = branch_and_bound(
+        [effective[i] for i in pool], target_value, cost_of_change
+    )
+    if selected is not None:
+        indexes = [pool[i] for i in selected]
+        return _selection(coins, indexes, target, fixed_weight, 0, "bnb")
+
+    change_fee = fee_for(change_weight, fee_rate)
+    indexes, value = [], 0
+    for i in pool:
+        indexes.append(i)
+        value += effective[i]
+        if value >= target_value + change_fee + DUST_LIMIT:
+            break
+    change = value - target_value - change_fee
+    if change < DUST_LIMIT:
+        # not worth a change output, the excess goes to the fee
+        return _selection(coins, indexes, target, fixed_weight, 0, "largest_first")
+    return _selection(
+        coins, indexes, target, fixed_weight + change_weight, change, "largest_first"
+    )
+
+
+def branch_and_bound(
+    values: list[int],
+    target: int,
+    cost_of_change: int,
+    max_tries: int = BNB_MAX_TRIES,
+) -> Optional[list[int]]:
+    """
+    Depth first search for the subset of `values` (sorted in descending order)
+    with a sum between `target` and `target + cost_of_change` that wastes the
+    least, i.e. the smallest sum. Returns the indexes of the subset.
+    """
+    # remaining[i] is the sum of the values not decided yet: `values[i:]`
+    remaining = [0] * (len(values) + 1)
+    for i in range(len(values) - 1, -1, -1):
+        remaining[i] = remaining[i + 1] + values[i]
+    if remaining[0] < target:
+        return None
+
+    best: Optional[list[int]] = None
+    best_excess = cost_of_change + 1
+    selection: list[int] = []
+    value = 0
+    index = 0
+    for _ in range(max_tries):
+        backtrack = False
+        if value + remaining[index] < target or value > target + cost_of_change:
+            backtrack = True
+        elif value >= target:
+            if value - target < best_excess:
+                best, best_excess = list(selection), value - target
+                if best_excess == 0:
+                    break
+            backtrack = True
+
+        if not backtrack:
+            # include the next value, its omission is explored when backtracking
+            selection.append(index)
+            value += values[index]
+            index += 1
+            continue
+
+        if not selection:
+            break
+        last = selection.pop()
+        value -= values[last]
+        index = last + 1
+        # omitting `last` and including an equal value was already explored
+        while index < len(values) and values[index] == values[last]:
+            index += 1
+    return best
+
+
+def _selection(
+    coins: list[Coin],
+    indexes: list[int],
+    target: int,
+    weight: int,
+    change: int,
+    algorithm: str,
+) -> Selection:
+    weight += sum(coins[i].weight for i in indexes)
+    fee = sum(coins[i].amount for i in indexes) - target - change
+    return Selection(indexes, fee, change, weight, algorithm)
@@ -1,19 +1,144 @@
+import asyncio
+import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
 from typing import Optional
 
-from lnbits.db import Database
+from lnbits.db import Connection, Database, model_to_dict
 from lnbits.helpers import urlsafe_short_hash
-
-from .helpers import derive_address
-from .models import Address, Config, ConfigDb, WalletAccount
+from sqlalchemy import text
+
+from . import metrics
+from .helpers import derive_address_scripts, script_scripthash
+from .metrics import CONFIG_CACHE, instrument_engine, timed_crud
+from .models import (
+    Address,
+    AddressPool,
+    BlockHash,
+    CachedTransaction,
+    Config,
+    ConfigDb,
+    SpentUtxo,
+    TransactionInput,
+    WalletAccount,
+    WalletSyncCheckpoint,
+    WalletUtxo,
+)
+from .watched import AddressIndex
+from .workers import run_in_worker
 
 db = Database("ext_watchonly")
+instrument_engine(db.engine.sync_engine)
+
+# rows per multi-row INSERT, keeps the bound parameters below the SQLite limit
+INSERT_BATCH_SIZE = 500
+# seconds a config is served from memory, bounds how long a change made by
+# another LNbits process can go unnoticed
+CONFIG_CACHE_TTL = 60
+CONFIG_CACHE_SIZE = 1024
+# scanned blocks whose hashes are kept per network, deeper reorgs are not
+# detected
+REORG_DEPTH = 100
+
+# only changed by deltas, see `update_addresses()`
+BALANCE_COLUMNS = ["balance", "receive_balance", "change_balance"]
+
+# user -> (expiry time, config)
+_config_cache: dict[str, tuple[float, Config]] = {}
+
+# called with the wallet id after an address is allocated, see `warmer.py`
+address_allocated_hooks: list[Callable[[str], None]] = []
+
+# scripts of all the wallets, loaded on first use
+_address_index = AddressIndex()
+_address_index_load: Optional[asyncio.Future] = None
+
+
+@asynccontextmanager
+async def transaction() -> AsyncIterator[Connection]:
+    """
+    Connection for statements that must be committed together.
+    Use `_execute()` and `_insert_many()` with it, `conn.execute()` commits
+    after every statement.
+    """
+    async with db.connect() as conn:
+        try:
+            yield conn
+            await conn.conn.commit()
+        except BaseException:
+            await conn.conn.rollback()
+            raise
+
+
+async def _execute(conn: Connection, query: str, values: Optional[dict] = None):
+    """Execute the statement without committing it"""
+    return await conn.conn.execute(
+        text(conn.rewrite_query(query)), conn.rewrite_values(values or {})
+    )
+
+
+async def _insert_many(
+    conn: Connection, table_name: str, models: list, on_conflict: str = ""
+) -> int:
+    """
+    Insert the models using multi-row INSERT statements, without committing.
+    Returns the number of inserted rows.
+    """
+    if not models:
+        return 0
+    fields = list(model_to_dict(models[0]).keys())
+    columns = ", ".join([f'"{field}"' for field in fields])
+    inserted = 0
+    for start in range(0, len(models), INSERT_BATCH_SIZE):
+        rows = []
+        values: dict = {}
+        for i, model in enumerate(models[start : start + INSERT_BATCH_SIZE]):
+            rows.append("(" + ", ".join([f":{f}_{i}" for f in fields]) + ")")
+            for field, value in model_to_dict(model).items():
+                values[f"{field}_{i}"] = value
+        result = await _execute(
+            conn,
+            f"""
+            INSERT INTO {table_name} ({columns})
+            VALUES {", ".join(rows)} {on_conflict}
+            """,
+            values,
+        )
+        inserted += result.rowcount
+    return inserted
+
+
+async def _delete_in(
+    conn: Connection,
+    table: str,
+    column: str,
+    values: list[str],
+    condition: str = "",
+    params: Optional[dict] = None,
+):
+    """Delete the rows whose column is in the values (and match the extra
+    condition), without committing"""
+    for start in range(0, len(values), INSERT_BATCH_SIZE):
+        batch = {
+            f"v_{i}": v for i, v in enumerate(values[start : start + INSERT_BATCH_SIZE])
+        }
+        await _execute(
+            conn,
+            f"""
+            DELETE FROM {table}
+            WHERE {column} IN ({", ".join([f":{key}" for key in batch])}) {condition}
+            """,
+            {**(params or {}), **batch},
+        )
 
 
+@timed_crud
 async def create_watch_wallet(wallet: WalletAccount) -> WalletAccount:
     await db.insert("watchonly.wallets", wallet)
     return wallet
 
 
+@timed_crud
 async def get_watch_wallet(wallet_id: str) -> Optional[WalletAccount]:
     return await db.fetchone(
         "SELECT * FROM watchonly.wallets WHERE id = :id",
@@ -22,6 +147,7 @@ async def get_watch_wallet(wallet_id: str) -> Optional[WalletAccount]:
     )
 
 
+@timed_crud
 async def get_watch_wallets(user: str, network: str) -> list[WalletAccount]:
     return await db.fetchall(
         """
@@ -33,54 +159,152 @@ async def get_watch_wallets(user: str, network: str) -> list[WalletAccount]:
     )
 
 
+@timed_crud
 async def update_watch_wallet(wallet: WalletAccount) -> WalletAccount:
-    await db.update("watchonly.wallets", wallet)
+    """Update the wallet, except for the balances and `address_no`"""
+    values = model_to_dict(wallet)
+    for column in [*BALANCE_COLUMNS, "address_no"]:
+        values.pop(column)
+    columns = ", ".join([f'"{key}" = :{key}' for key in values if key != "id"])
+    await db.execute(f"UPDATE watchonly.wallets SET {columns} WHERE id = :id", values)
     return wallet
 
 
+@timed_crud
 async def delete_watch_wallet(wallet_id: str) -> None:
     await db.execute(
         "DELETE FROM watchonly.wallets WHERE id = :id",
         {"id": wallet_id},
     )
+    await db.execute(
+        "DELETE FROM watchonly.wallet_sync_checkpoints WHERE wallet = :wallet",
+        {"wallet": wallet_id},
+    )
 
 
+@timed_crud
 async def get_fresh_address(wallet_id: str) -> Optional[Address]:
-    # todo: move logic to views_api after satspay refactoring
-    wallet = await get_watch_wallet(wallet_id)
-
-    if not wallet:
-        return None
-
-    wallet_addresses = await get_addresses(wallet_id)
-    receive_addresses = list(
-        filter(
-            lambda addr: addr.branch_index == 0 and addr.has_activity, wallet_addresses
+    """
+    Allocate the next receive address of the wallet. `address_no` is moved
+    past the last receive address with activity and incremented in a single
+    statement, concurrent calls never get the same address.
+    """
+    async with transaction() as conn:
+        result = await _execute(
+            conn,
+            """
+            UPDATE watchonly.wallets SET address_no = 1 + COALESCE(
+                (
+                    SELECT MAX(address_index) FROM watchonly.addresses
+                    WHERE wallet = :wallet AND branch_index = 0 AND has_activity
+                    AND address_index > wallets.address_no
+                ),
+                address_no
+            )
+            WHERE id = :wallet
+            RETURNING address_no
+            """,
+            {"wallet": wallet_id},
         )
-    )
-    last_receive_index = (
-        receive_addresses.pop().address_index if receive_addresses else -1
-    )
-    address_index = (
-        last_receive_index
-        if last_receive_index > wallet.address_no
-        else wallet.address_no
-    )
-
-    address = await get_address_at_index(wallet_id, 0, address_index + 1)
-
-    if not address:
-        addresses = await create_fresh_addresses(
-            wallet_id, address_index + 1, address_index + 2
+        row = result.mappings().first()
+        if not row:
+            return None
+        address_index = row["address_no"]
+        result = await _execute(
+            conn,
+            """
+            SELECT * FROM watchonly.addresses
+            WHERE wallet = :wallet AND branch_index = 0
+            AND address_index = :address_index
+            """,
+            {"wallet": wallet_id, "address_index": address_index},
         )
-        address = addresses.pop()
+        row = result.mappings().first()
+
+    for hook in address_allocated_hooks:
+        hook(wallet_id)
+    if row:
+        return Address(**row)
+    # not derived yet, the pool of the wallet is empty
+    [address] = await create_fresh_addresses(
+        wallet_id, address_index, address_index + 1
+    )
+    return address
 
-    wallet.address_no = address_index + 1
-    await update_watch_wallet(wallet)
 
-    return address
+@timed_crud
+async def get_branch_indexes(wallet_id: str) -> dict[int, tuple[int, int]]:
+    """
+    Returns the highest address index and the highest address index with
+    activity (or -1) for each branch of the wallet: {branch: (last, last_active)}
+    """
+    rows: list[dict] = await db.fetchall(
+        """
+        SELECT branch_index, MAX(address_index) AS last_index,
+        MAX(CASE WHEN has_activity THEN address_index ELSE -1 END)
+            AS last_active_index
+        FROM watchonly.addresses WHERE wallet = :wallet
+        GROUP BY branch_index
+        """,
+        {"wallet": wallet_id},
+    )
+    return {
+        row["branch_index"]: (row["last_index"], row["last_active_index"])
+        for row in rows
+    }
+
+
+@timed_crud
+async def get_address_pools(
+    wallet_ids: Optional[list[str]] = None,
+) -> list[AddressPool]:
+    """Indexes of the receive and change branches of the wallets (all the
+    wallets by default)"""
+    values = {f"wallet_{i}": wallet_id for i, wallet_id in enumerate(wallet_ids or [])}
+    where = ""
+    if wallet_ids is not None:
+        if not wallet_ids:
+            return []
+        where = f"WHERE w.id IN ({', '.join([f':{key}' for key in values])})"
+    return await db.fetchall(
+        f"""
+        SELECT w.id AS wallet, w.address_no, b.branch_index,
+        COALESCE(MAX(a.address_index), -1) AS last_index,
+        COALESCE(MAX(CASE WHEN a.has_activity THEN a.address_index END), -1)
+            AS last_active_index
+        FROM watchonly.wallets w
+        CROSS JOIN (SELECT 0 AS branch_index UNION ALL SELECT 1) b
+        LEFT JOIN watchonly.addresses a
+            ON a.wallet = w.id AND a.branch_index = b.branch_index
+        {where}
+        GROUP BY w.id, w.address_no, b.branch_index
+        """,
+        values,
+        AddressPool,
+    )
 
 
+@timed_crud
+async def create_gap_addresses(
+    wallet_id: str, receive_gap_limit: int, change_gap_limit: int
+) -> list[Address]:
+    """
+    Make sure each branch has `gap_limit` addresses after the last address
+    with activity. Only the missing addresses are derived and created.
+    """
+    indexes = await get_branch_indexes(wallet_id)
+    addresses = []
+    for branch_index, gap_limit in ((0, receive_gap_limit), (1, change_gap_limit)):
+        last_index, last_active_index = indexes.get(branch_index, (-1, -1))
+        end_index = last_active_index + gap_limit + 1
+        if end_index > last_index + 1:
+            addresses += await create_fresh_addresses(
+                wallet_id, last_index + 1, end_index, branch_index == 1
+            )
+    return addresses
+
+
+@timed_crud
 async def create_fresh_addresses(
     wallet_id: str,
     start_address_index: int,
@@ -96,39 +320,67 @@ async def create_fresh_addresses(
 
     branch_index = 1 if change_address else 0
 
-    for address_index in range(start_address_index, end_address_index):
-        address = await derive_address(wallet.masterpub, address_index, branch_index)
-        assert address  # TODO: why optional
-
-        addr = Address(
+    # derive the whole range (in the worker pool) before touching the database
+    derived, _ = await run_in_worker(
+        derive_address_scripts,
+        wallet.masterpub,
+        start_address_index,
+        end_address_index,
+        branch_index,
+    )
+    addresses = [
+        Address(
             id=urlsafe_short_hash(),
             address=address,
             wallet=wallet_id,
             branch_index=branch_index,
             address_index=address_index,
+            script_pubkey=script_pubkey.hex(),
+            scripthash=script_scripthash(script_pubkey),
+        )
+        for address_index, (address, script_pubkey) in enumerate(
+            derived, start_address_index
         )
+    ]
 
-        await db.insert("watchonly.addresses", addr)
+    if not addresses:
+        return []
 
-    # return fresh addresses
-    return await db.fetchall(
+    async with transaction() as conn:
+        inserted = await _insert_many(
+            conn,
+            "watchonly.addresses",
+            addresses,
+            "ON CONFLICT (wallet, branch_index, address_index) DO NOTHING",
+        )
+
+    if inserted != len(addresses):
+        # some of the addresses were created concurrently, return the stored ones
+        addresses = await get_addresses_in_range(
+            wallet_id, branch_index, start_address_index, end_address_index
+        )
+    for a in addresses:
+        if a.script_pubkey:
+            spk = bytes.fromhex(a.script_pubkey)
+            _address_index.add(wallet_id, branch_index, a.address_index, spk)
+    return addresses
+
+
+@timed_crud
+async def get_unused_change_address(wallet_id: str) -> Optional[Address]:
+    return await db.fetchone(
         """
-            SELECT * FROM watchonly.addresses WHERE wallet = :wallet
-            AND branch_index = :branch_index
-            AND address_index >= :start_address_index
-            AND address_index < :end_address_index
-            ORDER BY branch_index, address_index
+        SELECT * FROM watchonly.addresses
+        WHERE wallet = :wallet AND branch_index = 1
+        AND COALESCE(has_activity, false) = false
+        ORDER BY address_index LIMIT 1
         """,
-        {
-            "wallet": wallet_id,
-            "branch_index": branch_index,
-            "start_address_index": start_address_index,
-            "end_address_index": end_address_index,
-        },
+        {"wallet": wallet_id},
         Address,
     )
 
 
+@timed_crud
 async def get_address(address: str) -> Optional[Address]:
     return await db.fetchone(
         "SELECT * FROM watchonly.addresses WHERE address = :address",
@@ -137,6 +389,7 @@ async def get_address(address: str) -> Optional[Address]:
     )
 
 
+@timed_crud
 async def get_address_by_id(address_id: str) -> Optional[Address]:
     return await db.fetchone(
         "SELECT * FROM watchonly.addresses WHERE id = :id",
@@ -145,6 +398,39 @@ async def get_address_by_id(address_id: str) -> Optional[Address]:
     )
 
 
+@timed_crud
+async def get_addresses_by_ids(address_ids: list[str]) -> list[Address]:
+    return await _get_addresses_in("id", address_ids)
+
+
+@timed_crud
+async def get_addresses_by_scripthashes(scripthashes: list[str]) -> list[Address]:
+    """Addresses (of all the wallets) paid to by the scripts, see
+    `helpers.script_scripthash()`"""
+    return await _get_addresses_in("scripthash", scripthashes)
+
+
+async def _get_addresses_in(column: str, values: list[str]) -> list[Address]:
+    return await _fetch_in("watchonly.addresses", column, values, Address)
+
+
+async def _fetch_in(table: str, column: str, values: list[str], model):
+    rows: list = []
+    for start in range(0, len(values), INSERT_BATCH_SIZE):
+        batch = values[start : start + INSERT_BATCH_SIZE]
+        params = {f"v_{i}": value for i, value in enumerate(batch)}
+        rows += await db.fetchall(
+            f"""
+            SELECT * FROM {table}
+            WHERE {column} IN ({", ".join([f":{key}" for key in params])})
+            """,
+            params,
+            model,
+        )
+    return rows
+
+
+@timed_crud
 async def get_address_at_index(
     wallet_id: str, branch_index: int, address_index: int
 ) -> Optional[Address]:
@@ -163,6 +449,32 @@ async def get_address_at_index(
     )
 
 
+@timed_crud
+async def get_addresses_in_range(
+    wallet_id: str,
+    branch_index: int,
+    start_address_index: int,
+    end_address_index: int,
+) -> list[Address]:
+    return await db.fetchall(
+        """
+            SELECT * FROM watchonly.addresses WHERE wallet = :wallet
+            AND branch_index = :branch_index
+            AND address_index >= :start_address_index
+            AND address_index < :end_address_index
+            ORDER BY branch_index, address_index
+        """,
+        {
+            "wallet": wallet_id,
+            "branch_index": branch_index,
+            "start_address_index": start_address_index,
+            "end_address_index": end_address_index,
+        },
+        Address,
+    )
+
+
+@timed_crud
 async def get_addresses(wallet_id: str) -> list[Address]:
     return await db.fetchall(
         """
@@ -174,35 +486,511 @@ async def get_addresses(wallet_id: str) -> list[Address]:
     )
 
 
+@timed_crud
+async def get_watched_addresses(wallet_id: str, limit: int) -> list[Address]:
+    """Addresses that can receive or spend funds: unused or not empty"""
+    return await db.fetchall(
+        """
+        SELECT * FROM watchonly.addresses
+        WHERE wallet = :wallet
+        AND (COALESCE(has_activity, false) = false OR amount <> 0)
+        ORDER BY branch_index, address_index LIMIT :limit
+        """,
+        {"wallet": wallet_id, "limit": limit},
+        Address,
+    )
+
+
+@timed_crud
+async def get_addresses_page(
+    wallet_id: str,
+    limit: Optional[int] = None,
+    after: Optional[tuple[int, int]] = None,
+    branch_index: Optional[int] = None,
+    has_activity: Optional[bool] = None,
+    has_note: Optional[bool] = None,
+) -> list[Address]:
+    """
+    Addresses of the wallet ordered by (branch_index, address_index).
+    `after` is the (branch_index, address_index) of the last address of the
+    previous page, the other arguments are optional filters.
+    """
+    where = ["wallet = :wallet"]
+    values: dict = {"wallet": wallet_id}
+    if after:
+        where.append(
+            """(branch_index > :after_branch
+            OR (branch_index = :after_branch AND address_index > :after_index))"""
+        )
+        values["after_branch"], values["after_index"] = after
+    if branch_index is not None:
+        where.append("branch_index = :branch_index")
+        values["branch_index"] = branch_index
+    if has_activity is not None:
+        where.append("COALESCE(has_activity, false) = :has_activity")
+        values["has_activity"] = has_activity
+    if has_note is not None:
+        where.append(
+            "(note IS NOT NULL AND note <> '')"
+            if has_note
+            else "(note IS NULL OR note = '')"
+        )
+    pagination = ""
+    if limit is not None:
+        pagination = "LIMIT :limit"
+        values["limit"] = limit
+
+    return await db.fetchall(
+        f"""
+        SELECT * FROM watchonly.addresses WHERE {" AND ".join(where)}
+        ORDER BY branch_index, address_index {pagination}
+        """,
+        values,
+        Address,
+    )
+
+
+@timed_crud
 async def update_address(address: Address) -> Address:
-    await db.update("watchonly.addresses", address)
+    await update_addresses([address])
     return address
 
 
+@timed_crud
+async def update_addresses(addresses: list[Address]):
+    """
+    Update the amount, note and activity of the addresses. The amount changes
+    are applied to the wallet balances and the last used receive address of
+    each wallet is moved past funded addresses, in the same transaction.
+    """
+    last_receive_index: dict[str, int] = {}
+    for address in addresses:
+        if address.branch_index == 0 and address.amount != 0:
+            last_receive_index[address.wallet] = max(
+                last_receive_index.get(address.wallet, -1), address.address_index
+            )
+
+    async with transaction() as conn:
+        for address in addresses:
+            branch_column = (
+                "change_balance" if address.branch_index == 1 else "receive_balance"
+            )
+            delta = """
+                (:amount - COALESCE(
+                    (SELECT amount FROM watchonly.addresses WHERE id = :id), :amount
+                ))
+            """
+            values = {"id": address.id, "wallet": address.wallet}
+            await _execute(
+                conn,
+                f"""
+                UPDATE watchonly.wallets
+                SET balance = balance + {delta},
+                    {branch_column} = {branch_column} + {delta}
+                WHERE id = :wallet
+                """,
+                {**values, "amount": address.amount},
+            )
+            await _execute(
+                conn,
+                """
+                UPDATE watchonly.addresses
+                SET amount = :amount, note = :note, has_activity = :has_activity
+                WHERE id = :id
+                """,
+                {
+                    **values,
+                    "amount": address.amount,
+                    "note": address.note,
+                    "has_activity": address.has_activity,
+                },
+            )
+        for wallet_id, address_index in last_receive_index.items():
+            await _execute(
+                conn,
+                """
+                UPDATE watchonly.wallets SET address_no = :address_index
+                WHERE id = :wallet AND address_no < :address_index
+                """,
+                {"wallet": wallet_id, "address_index": address_index},
+            )
+
+
+@timed_crud
 async def delete_addresses_for_wallet(wallet_id: str) -> None:
     await db.execute(
         "DELETE FROM watchonly.addresses WHERE wallet = :wallet", {"wallet": wallet_id}
     )
+    _address_index.remove_wallet(wallet_id)
+
+
+async def get_address_index() -> AddressIndex:
+    """
+    Index of the addresses of all the wallets, to find the owner of an address
+    or of the outputs of a transaction without a query per lookup.
+    Loaded from the database on first use, then kept up to date by
+    `create_fresh_addresses()` and `delete_addresses_for_wallet()`.
+    """
+    if not _address_index.loaded:
+        await reload_address_index()
+    return _address_index
+
+
+@timed_crud
+async def reload_address_index():
+    """Read all the addresses again, to see the ones created by other
+    processes. Concurrent calls share the same query."""
+    global _address_index_load
+    if _address_index_load is None or _address_index_load.done():
+        _address_index_load = asyncio.ensure_future(_load_address_index())
+    await asyncio.shield(_address_index_load)
+
+
+async def _load_address_index():
+    _address_index.start_loading()
+    try:
+        rows = await db.fetchall(
+            """
+            SELECT wallet, branch_index, address_index, script_pubkey
+            FROM watchonly.addresses WHERE script_pubkey IS NOT NULL
+            """
+        )
+    except BaseException:
+        _address_index.loading = False
+        raise
+    _address_index.load(
+        (
+            row["wallet"],
+            row["branch_index"],
+            row["address_index"],
+            bytes.fromhex(row["script_pubkey"]),
+        )
+        for row in rows
+    )
+
+
+def clear_address_index():
+    _address_index.clear()
+
+
+@timed_crud
+async def get_transactions(tx_ids: list[str]) -> list[CachedTransaction]:
+    transactions: list[CachedTransaction] = []
+    for start in range(0, len(tx_ids), INSERT_BATCH_SIZE):
+        batch = tx_ids[start : start + INSERT_BATCH_SIZE]
+        values = {f"id_{i}": tx_id for i, tx_id in enumerate(batch)}
+        transactions += await db.fetchall(
+            f"""
+            SELECT * FROM watchonly.transactions
+            WHERE id IN ({", ".join([f":{key}" for key in values])})
+            """,
+            values,
+            CachedTransaction,
+        )
+    return transactions
 
 
+@timed_crud
+async def create_transactions(transactions: list[CachedTransaction]) -> None:
+    async with transaction() as conn:
+        await _insert_many(
+            conn, "watchonly.transactions", transactions, "ON CONFLICT (id) DO NOTHING"
+        )
+
+
+@timed_crud
+async def get_utxos(wallet_id: str) -> list[WalletUtxo]:
+    return await db.fetchall(
+        """
+        SELECT * FROM watchonly.utxos WHERE wallet = :wallet
+        ORDER BY block_height DESC, tx_id, vout
+        """,
+        {"wallet": wallet_id},
+        WalletUtxo,
+    )
+
+
+@timed_crud
+async def get_utxos_by_address_ids(address_ids: list[str]) -> list[WalletUtxo]:
+    return await _fetch_in("watchonly.utxos", "address_id", address_ids, WalletUtxo)
+
+
+@timed_crud
+async def get_utxos_by_tx_ids(tx_ids: list[str]) -> list[WalletUtxo]:
+    """Cached UTXOs (of all the wallets) created by the transactions"""
+    return await _fetch_in("watchonly.utxos", "tx_id", tx_ids, WalletUtxo)
+
+
+@timed_crud
+async def get_spendable_utxos(
+    wallet_ids: list[str], include_unconfirmed: bool = True
+) -> list[TransactionInput]:
+    """Cached UTXOs of the wallets, with the address details needed to spend them"""
+    values: dict = {f"wallet_{i}": wallet_id for i, wallet_id in enumerate(wallet_ids)}
+    where = [f"u.wallet IN ({', '.join([f':{key}' for key in values])})"]
+    if not include_unconfirmed:
+        where.append("u.confirmed = :confirmed")
+        values["confirmed"] = True
+    return await db.fetchall(
+        f"""
+        SELECT u.tx_id, u.vout, u.amount, a.address, a.branch_index,
+            a.address_index, u.wallet
+        FROM watchonly.utxos u
+        JOIN watchonly.addresses a ON a.id = u.address_id
+        WHERE {" AND ".join(where)}
+        """,
+        values,
+        TransactionInput,
+    )
+
+
+@timed_crud
+async def update_address_utxos(address_ids: list[str], utxos: list[WalletUtxo]):
+    """Replace the cached UTXOs of the addresses"""
+    async with transaction() as conn:
+        for start in range(0, len(address_ids), INSERT_BATCH_SIZE):
+            batch = address_ids[start : start + INSERT_BATCH_SIZE]
+            values = {f"id_{i}": address_id for i, address_id in enumerate(batch)}
+            await _execute(
+                conn,
+                f"""
+                DELETE FROM watchonly.utxos
+                WHERE address_id IN ({", ".join([f":{key}" for key in values])})
+                """,
+                values,
+            )
+        await _insert_many(conn, "watchonly.utxos", utxos)
+
+
+@timed_crud
+async def delete_utxos_for_wallet(wallet_id: str) -> None:
+    await db.execute(
+        "DELETE FROM watchonly.utxos WHERE wallet = :wallet", {"wallet": wallet_id}
+    )
+    await db.execute(
+        "DELETE FROM watchonly.spent_utxos WHERE wallet = :wallet",
+        {"wallet": wallet_id},
+    )
+
+
+@timed_crud
+async def save_spent_utxos(utxos: list[SpentUtxo]):
+    async with transaction() as conn:
+        await _insert_many(
+            conn,
+            "watchonly.spent_utxos",
+            utxos,
+            "ON CONFLICT (address_id, tx_id, vout) DO UPDATE "
+            "SET spent_height = excluded.spent_height",
+        )
+
+
+@timed_crud
+async def get_network_wallets(network: str) -> list[WalletAccount]:
+    """The wallets of all the users on the network"""
+    return await db.fetchall(
+        "SELECT * FROM watchonly.wallets WHERE network = :network",
+        {"network": network},
+        WalletAccount,
+    )
+
+
+@timed_crud
+async def get_wallet_sync_checkpoints(
+    wallet_ids: list[str],
+) -> list[WalletSyncCheckpoint]:
+    return await _fetch_in(
+        "watchonly.wallet_sync_checkpoints", "wallet", wallet_ids, WalletSyncCheckpoint
+    )
+
+
+@timed_crud
+async def get_block_hashes(network: str) -> dict[int, str]:
+    """The hashes of the recent scanned blocks, by height"""
+    rows = await db.fetchall(
+        "SELECT * FROM watchonly.block_hashes WHERE network = :network",
+        {"network": network},
+        BlockHash,
+    )
+    return {row.height: row.block_hash for row in rows}
+
+
+@timed_crud
+async def save_sync_progress(
+    network: str, wallet_ids: list[str], block_hashes: dict[int, str]
+):
+    """
+    Move the checkpoints of the wallets to the last of the scanned blocks and
+    store their hashes, keeping the last `REORG_DEPTH` blocks of the network
+    (and the UTXOs spent in them).
+    """
+    height = max(block_hashes)
+    checkpoints = [
+        WalletSyncCheckpoint(
+            wallet=wallet_id, height=height, block_hash=block_hashes[height]
+        )
+        for wallet_id in wallet_ids
+    ]
+    async with transaction() as conn:
+        await _insert_many(
+            conn,
+            "watchonly.wallet_sync_checkpoints",
+            checkpoints,
+            """
+            ON CONFLICT (wallet) DO UPDATE
+            SET height = excluded.height, block_hash = excluded.block_hash
+            """,
+        )
+        await _insert_many(
+            conn,
+            "watchonly.block_hashes",
+            [
+                BlockHash(network=network, height=h, block_hash=block_hash)
+                for h, block_hash in block_hashes.items()
+            ],
+            """
+            ON CONFLICT (network, height) DO UPDATE
+            SET block_hash = excluded.block_hash
+            """,
+        )
+        await _execute(
+            conn,
+            """
+            DELETE FROM watchonly.block_hashes
+            WHERE network = :network AND height <= :height
+            """,
+            {"network": network, "height": height - REORG_DEPTH},
+        )
+        await _delete_in(
+            conn,
+            "watchonly.spent_utxos",
+            "wallet",
+            wallet_ids,
+            "AND spent_height <= :height",
+            {"height": height - REORG_DEPTH},
+        )
+
+
+@timed_crud
+async def rollback_wallet_sync(
+    network: str, wallet_ids: list[str], height: int, block_hash: Optional[str] = None
+):
+    """
+    Forget the blocks above `height` after a reorg: the UTXOs confirmed in
+    them are removed and the ones spent in them restored (and the amounts of
+    their addresses updated), then the checkpoints of the wallets are moved
+    back to the block (or removed without `block_hash`).
+    """
+    wallets = set(wallet_ids)
+    orphaned = [
+        utxo
+        for utxo in await _fetch_in("watchonly.utxos", "wallet", wallet_ids, WalletUtxo)
+        if utxo.block_height is not None and utxo.block_height > height
+    ]
+    restored = [
+        WalletUtxo(**utxo.dict(exclude={"spent_height"}))
+        for utxo in await _fetch_in(
+            "watchonly.spent_utxos", "wallet", wallet_ids, SpentUtxo
+        )
+        if utxo.spent_height > height
+        and (utxo.block_height is None or utxo.block_height <= height)
+    ]
+    address_ids = list({utxo.address_id for utxo in orphaned + restored})
+    kept = {
+        (utxo.address_id, utxo.tx_id, utxo.vout): utxo
+        for utxo in await get_utxos_by_address_ids(address_ids) + restored
+        if utxo.block_height is None or utxo.block_height <= height
+    }
+    await update_address_utxos(address_ids, list(kept.values()))
+    changed = []
+    for address in await get_addresses_by_ids(address_ids):
+        amount = sum(u.amount for u in kept.values() if u.address_id == address.id)
+        if address.wallet in wallets and address.amount != amount:
+            address.amount = amount
+            changed.append(address)
+    await update_addresses(changed)
+
+    async with transaction() as conn:
+        await _delete_in(
+            conn,
+            "watchonly.spent_utxos",
+            "wallet",
+            wallet_ids,
+            "AND spent_height > :height",
+            {"height": height},
+        )
+        await _delete_in(
+            conn, "watchonly.wallet_sync_checkpoints", "wallet", wallet_ids
+        )
+        if block_hash:
+            await _insert_many(
+                conn,
+                "watchonly.wallet_sync_checkpoints",
+                [
+                    WalletSyncCheckpoint(wallet=w, height=height, block_hash=block_hash)
+                    for w in wallet_ids
+                ],
+            )
+        await _execute(
+            conn,
+            """
+            DELETE FROM watchonly.block_hashes
+            WHERE network = :network AND height > :height
+            """,
+            {"network": network, "height": height},
+        )
+
+
+@timed_crud
 async def create_config(user: str) -> Config:
-    config = Config()
-    await db.insert("watchonly.config", ConfigDb(user=user, json_data=config))
-    return config
+    """Create the default config, unless the user already has one"""
+    await db.execute(
+        """
+        INSERT INTO watchonly.config ("user", json_data) VALUES (:user, :json_data)
+        ON CONFLICT ("user") DO NOTHING
+        """,
+        model_to_dict(ConfigDb(user=user, json_data=Config())),
+    )
+    return await _fetch_config(user) or Config()
 
 
+@timed_crud
 async def update_config(config: Config, user: str) -> Config:
     _config = ConfigDb(user=user, json_data=config)
     await db.update("watchonly.config", _config, """WHERE "user" = :user""")
+    _config_cache.pop(user, None)
     return config
 
 
+@timed_crud
 async def get_config(user: str) -> Config:
+    """The config of the user, served from memory for `CONFIG_CACHE_TTL`"""
+    cached = _config_cache.get(user)
+    if cached and cached[0] > time.monotonic():
+        if metrics.enabled:
+            CONFIG_CACHE.inc("hit")
+        return cached[1].copy()
+
+    if metrics.enabled:
+        CONFIG_CACHE.inc("miss")
+    config = await _fetch_config(user) or await create_config(user)
+    # re-inserted at the end, the dict is kept in insertion order
+    _config_cache.pop(user, None)
+    if len(_config_cache) >= CONFIG_CACHE_SIZE:
+        # evict the oldest entry
+        _config_cache.pop(next(iter(_config_cache)))
+    _config_cache[user] = (time.monotonic() + CONFIG_CACHE_TTL, config)
+    return config.copy()
+
+
+def clear_config_cache():
+    _config_cache.clear()
+
+
+async def _fetch_config(user: str) -> Optional[Config]:
     _config = await db.fetchone(
         """SELECT * FROM watchonly.config WHERE "user" = :user""",
         {"user": user},
         ConfigDb,
     )
-    if not _config:
-        return await create_config(user)
-    return _config.json_data
+    return _config.json_data if _config else None
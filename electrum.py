@@ -0,0 +1,191 @@
+"""
+Client for the Electrum protocol (JSON-RPC over TCP or TLS), as served by
+ElectrumX, Fulcrum or electrs.
+Requests are pipelined over a single connection per server: a batch of calls
+is written at once and the responses are matched by id, so hundreds of
+scripthashes are queried in one round trip.
+"""
+
+import asyncio
+import json
+import ssl
+import time
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+from loguru import logger
+
+from . import metrics
+
+ELECTRUM_TIMEOUT = 30
+# calls written per round trip, servers limit the size of the pending requests
+ELECTRUM_BATCH_SIZE = 500
+ELECTRUM_CLIENT_NAME = "lnbits-watchonly"
+ELECTRUM_PROTOCOL_VERSION = "1.4"
+# longest response line read, the history of a busy address or a large
+# transaction is well above the 64 KiB default of asyncio
+ELECTRUM_MAX_LINE = 32 * 1024 * 1024
+
+# notification sent to the listeners when the connection is lost
+DISCONNECTED = "disconnected"
+
+_electrum_clients: dict[str, "ElectrumClient"] = {}
+
+
+class ElectrumError(Exception):
+    """Error returned by the Electrum server"""
+
+
+class ElectrumClient:
+    def __init__(self, url: str, timeout: float = ELECTRUM_TIMEOUT):
+        """`url` is `ssl://host:port` or `tcp://host:port` (TLS by default)"""
+        parsed = urlparse(url if "://" in url else f"ssl://{url}")
+        if parsed.scheme not in ("ssl", "tcp") or not parsed.hostname:
+            raise ValueError(f"Invalid Electrum server '{url}'.")
+        self.url = url
+        self.host = parsed.hostname
+        self.use_ssl = parsed.scheme == "ssl"
+        self.port = parsed.port or (50002 if self.use_ssl else 50001)
+        self.timeout = timeout
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._connect_lock = asyncio.Lock()
+        self._next_id = 0
+        self._pending: dict[int, asyncio.Future] = {}
+        # queues receiving the notifications (subscriptions)
+        self._listeners: set[asyncio.Queue] = set()
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.connected:
+                return
+            reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.host,
+                    self.port,
+                    ssl=ssl.create_default_context() if self.use_ssl else None,
+                    limit=ELECTRUM_MAX_LINE,
+                ),
+                self.timeout,
+            )
+            self._read_task = asyncio.create_task(self._read_loop(reader))
+        await self.request(
+            "server.version", ELECTRUM_CLIENT_NAME, ELECTRUM_PROTOCOL_VERSION
+        )
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        if self._read_task:
+            self._read_task.cancel()
+            self._read_task = None
+        self._fail_pending(ConnectionError("Electrum connection closed."))
+
+    async def request(self, method: str, *params) -> Any:
+        [result] = await self.batch([(method, list(params))])
+        return result
+
+    async def batch(self, calls: list[tuple[str, list]]) -> list:
+        """Results of the calls, in order. Raises `ElectrumError` if one fails"""
+        if not self.connected:
+            await self.connect()
+        results: list = []
+        for start in range(0, len(calls), ELECTRUM_BATCH_SIZE):
+            results += await self._send(calls[start : start + ELECTRUM_BATCH_SIZE])
+        return results
+
+    async def _send(self, calls: list[tuple[str, list]]) -> list:
+        assert self._writer, "Not connected."
+        loop = asyncio.get_running_loop()
+        ids, lines = [], []
+        for method, params in calls:
+            self._next_id += 1
+            ids.append(self._next_id)
+            self._pending[self._next_id] = loop.create_future()
+            request = {"id": self._next_id, "method": method, "params": params}
+            lines.append(json.dumps({"jsonrpc": "2.0", **request}))
+        start = time.perf_counter()
+        try:
+            self._writer.write(("\n".join(lines) + "\n").encode())
+            await self._writer.drain()
+            results = asyncio.gather(*[self._pending[i] for i in ids])
+            # retrieve the error when cancelled, it is not awaited anymore
+            results.add_done_callback(lambda f: f.cancelled() or f.exception())
+            return await asyncio.wait_for(results, self.timeout)
+        finally:
+            for i in ids:
+                self._pending.pop(i, None)
+            if metrics.enabled:
+                metrics.ELECTRUM_BATCHES.observe(time.perf_counter() - start, self.host)
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        error: Exception = ConnectionError("Electrum connection closed.")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                for msg in message if isinstance(message, list) else [message]:
+                    self._dispatch(msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.debug(f"watchonly: Electrum '{self.url}': {exc!s}")
+            error = ConnectionError(str(exc))
+        finally:
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+            self._fail_pending(error)
+
+    def _dispatch(self, msg: dict):
+        future = self._pending.get(msg.get("id"))  # type: ignore[arg-type]
+        if future is not None:
+            if future.done():
+                return
+            if msg.get("error"):
+                error = msg["error"]
+                message = error.get("message") if isinstance(error, dict) else error
+                future.set_exception(ElectrumError(message))
+            else:
+                future.set_result(msg.get("result"))
+        elif "method" in msg:
+            for queue in self._listeners:
+                queue.put_nowait((msg["method"], msg.get("params", [])))
+
+    def _fail_pending(self, error: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        for queue in self._listeners:
+            queue.put_nowait((DISCONNECTED, []))
+
+    def listen(self) -> asyncio.Queue:
+        """Queue receiving the notifications as `(method, params)`"""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._listeners.add(queue)
+        return queue
+
+    def unlisten(self, queue: asyncio.Queue):
+        self._listeners.discard(queue)
+
+
+def get_electrum_client(url: str) -> ElectrumClient:
+    """The client (connection) shared by all the requests to the server"""
+    client = _electrum_clients.get(url)
+    if client is None:
+        client = _electrum_clients[url] = ElectrumClient(url)
+    return client
+
+
+async def close_electrum_clients():
+    for client in _electrum_clients.values():
+        await client.close()
+    _electrum_clients.clear()
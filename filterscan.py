@@ -0,0 +1,377 @@
+"""
+Scanning with the compact block filters (BIP158) of a Bitcoin Core node
+(`-rest -blockfilterindex`), configured with the `WATCHONLY_BLOCK_FILTER_URL`
+(Mainnet) and `WATCHONLY_BLOCK_FILTER_TESTNET_URL` environment variables.
+The filters of the blocks are matched locally against the scripts of all
+the wallets (see `crud.get_address_index()`), only the blocks that match are
+downloaded. The server never sees the addresses, and the number of requests
+per block does not depend on the number of wallets or addresses.
+Each wallet has a checkpoint (the last block scanned for it), rescans only
+fetch the blocks after the checkpoints and go back to the last common block
+after a reorg.
+"""
+
+import asyncio
+import os
+import time
+from io import BytesIO
+from typing import Optional
+
+import httpx
+from embit import compact
+from embit.transaction import Transaction
+from loguru import logger
+
+from .blockfilter import match_block_filters
+from .crud import (
+    create_gap_addresses,
+    get_address_index,
+    get_addresses_by_ids,
+    get_addresses_by_scripthashes,
+    get_block_hashes,
+    get_config,
+    get_network_wallets,
+    get_utxos_by_address_ids,
+    get_utxos_by_tx_ids,
+    get_wallet_sync_checkpoints,
+    get_watch_wallet,
+    rollback_wallet_sync,
+    save_spent_utxos,
+    save_sync_progress,
+    update_address_utxos,
+    update_addresses,
+)
+from .helpers import script_scripthash
+from .mempool import MempoolClient
+from .models import (
+    Address,
+    FilterScanProgress,
+    SpentUtxo,
+    WalletSyncCheckpoint,
+    WalletUtxo,
+)
+from .workers import run_in_worker
+
+BLOCK_FILTER_URLS = {
+    "Mainnet": os.getenv("WATCHONLY_BLOCK_FILTER_URL", ""),
+    "Testnet": os.getenv("WATCHONLY_BLOCK_FILTER_TESTNET_URL", ""),
+}
+# blocks whose hashes and filters are fetched (and matched) together, the
+# checkpoints of the wallets are saved after each window
+FILTER_SCAN_WINDOW = 50
+# safety check, the gap limit is extended at most this many times per block
+MAX_GAP_EXTENSIONS = 100
+
+
+class BlockFilterClient(MempoolClient):
+    """Bitcoin Core REST interface, with the retries and limits of the
+    Esplora client"""
+
+    def operation(self, path: str) -> str:
+        # `/rest/blockfilter/basic/{hash}.hex` -> `rest/blockfilter`
+        return "/".join(path.strip("/").split("/")[:2]).split(".")[0]
+
+    async def get_tip_height(self) -> int:
+        r = await self.get("/rest/chaininfo.json")
+        return r.json()["blocks"]
+
+    async def get_block_hash(self, height: int) -> str:
+        r = await self.get(f"/rest/blockhashbyheight/{height}.hex")
+        return r.text.strip()
+
+    async def get_block_filter(self, block_hash: str) -> bytes:
+        r = await self.get(f"/rest/blockfilter/basic/{block_hash}.hex")
+        return bytes.fromhex(r.text.strip())
+
+    async def get_block(self, block_hash: str) -> list[Transaction]:
+        r = await self.get(f"/rest/block/{block_hash}.bin")
+        return parse_block(r.content)
+
+
+def parse_block(raw_block: bytes) -> list[Transaction]:
+    stream = BytesIO(raw_block)
+    stream.seek(80)  # header
+    return [Transaction.read_from(stream) for _ in range(compact.read_from(stream))]
+
+
+class FilterScanJob:
+    def __init__(self, network: str, start_height: Optional[int]):
+        self.progress = FilterScanProgress(
+            network=network, start_height=start_height, started_at=int(time.time())
+        )
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.progress.status == "running"
+
+
+filter_scans: dict[str, FilterScanJob] = {}
+
+
+def get_filter_scan(network: str) -> Optional[FilterScanJob]:
+    return filter_scans.get(network)
+
+
+def start_filter_scan(
+    network: str,
+    start_height: Optional[int] = None,
+    http_client: Optional[httpx.AsyncClient] = None,
+) -> FilterScanJob:
+    """Start scanning the blocks of the network in the background, unless a
+    scan is already running"""
+    job = filter_scans.get(network)
+    if job and job.running:
+        return job
+
+    url = BLOCK_FILTER_URLS.get(network)
+    if not url:
+        raise ValueError(f"No block filter server configured for {network}.")
+    client = BlockFilterClient(url, http_client=http_client)
+    job = FilterScanJob(network, start_height)
+    job.task = asyncio.create_task(_run_filter_scan(job, client))
+    filter_scans[network] = job
+    return job
+
+
+def cancel_filter_scans():
+    for job in filter_scans.values():
+        if job.task and not job.task.done():
+            job.task.cancel()
+
+
+async def _run_filter_scan(job: FilterScanJob, client: BlockFilterClient):
+    try:
+        await scan_block_filters(job, client)
+        job.progress.status = "done"
+    except asyncio.CancelledError:
+        job.progress.status = "cancelled"
+        raise
+    except Exception as exc:
+        logger.warning(f"Block filter scan failed: {exc!s}")
+        job.progress.status = "failed"
+        job.progress.error = str(exc)
+    finally:
+        job.progress.finished_at = int(time.time())
+
+
+async def scan_block_filters(job: FilterScanJob, client: BlockFilterClient):
+    """Scan the blocks from the start height (or the checkpoint of each
+    wallet) to the tip, for all the wallets of the network"""
+    progress = job.progress
+    wallet_ids = [w.id for w in await get_network_wallets(progress.network)]
+    if not wallet_ids:
+        return
+    progress.tip_height = await client.get_tip_height()
+    checkpoints = await _rollback_reorgs(
+        progress, client, await get_wallet_sync_checkpoints(wallet_ids)
+    )
+    # first block to scan per wallet, the wallets never scanned need the
+    # start height
+    starts = {c.wallet: c.height + 1 for c in checkpoints}
+    if progress.start_height is not None:
+        for wallet_id in wallet_ids:
+            starts[wallet_id] = min(
+                starts.get(wallet_id, progress.start_height), progress.start_height
+            )
+    if not starts:
+        raise ValueError("No checkpoint yet, the start height is required.")
+    progress.wallets = len(starts)
+    progress.skipped_wallets = len(wallet_ids) - len(starts)
+    progress.start_height = min(starts.values())
+    index = await get_address_index()
+
+    height = progress.start_height
+    while height <= progress.tip_height:
+        heights = range(
+            height, min(height + FILTER_SCAN_WINDOW, progress.tip_height + 1)
+        )
+        hashes = await asyncio.gather(*[client.get_block_hash(h) for h in heights])
+        data = await asyncio.gather(*[client.get_block_filter(h) for h in hashes])
+        filters = list(zip(hashes, data))
+        scanned = {w for w, start in starts.items() if start <= heights[-1]}
+        matches: list[bool] = []
+        for i, block_height in enumerate(heights):
+            if len(matches) <= i:
+                # again for the next blocks when the wallets got new addresses
+                scripts_count = len(index)
+                remaining, _ = await run_in_worker(
+                    match_block_filters, filters[i:], index.scripts(scanned)
+                )
+                matches += remaining
+            if matches[i]:
+                progress.matched_blocks += 1
+                txs = await client.get_block(hashes[i])
+                wallets = {w for w in scanned if starts[w] <= block_height}
+                await scan_block(wallets, block_height, txs)
+                if len(index) != scripts_count:
+                    del matches[i + 1 :]
+            progress.height = block_height
+        await save_sync_progress(
+            progress.network, list(scanned), dict(zip(heights, hashes))
+        )
+        height = heights[-1] + 1
+
+
+async def _rollback_reorgs(
+    progress: FilterScanProgress,
+    client: BlockFilterClient,
+    checkpoints: list[WalletSyncCheckpoint],
+) -> list[WalletSyncCheckpoint]:
+    """Move back to the last common block the checkpoints no longer in the
+    chain of the node, returns the checkpoints left"""
+    by_block: dict[tuple[int, str], list[str]] = {}
+    for checkpoint in checkpoints:
+        by_block.setdefault((checkpoint.height, checkpoint.block_hash), []).append(
+            checkpoint.wallet
+        )
+    kept: list[WalletSyncCheckpoint] = []
+    block_hashes: Optional[dict[int, str]] = None
+    for (height, block_hash), wallet_ids in by_block.items():
+        if await _in_chain(client, progress.tip_height, height, block_hash):
+            kept += [c for c in checkpoints if c.wallet in wallet_ids]
+            continue
+        if block_hashes is None:
+            block_hashes = await get_block_hashes(progress.network)
+        fork = None
+        for h in sorted((h for h in block_hashes if h < height), reverse=True):
+            if await _in_chain(client, progress.tip_height, h, block_hashes[h]):
+                fork = h
+                break
+        if fork is None:
+            if progress.start_height is None:
+                raise ValueError(
+                    f"Block {height} was reorganized out of the chain deeper than "
+                    "the blocks kept, a start height before the fork is required."
+                )
+            # scanned again from the start height
+            await rollback_wallet_sync(
+                progress.network, wallet_ids, progress.start_height - 1
+            )
+            fork = progress.start_height - 1
+        else:
+            await rollback_wallet_sync(
+                progress.network, wallet_ids, fork, block_hashes[fork]
+            )
+            kept += [
+                WalletSyncCheckpoint(
+                    wallet=wallet_id, height=fork, block_hash=block_hashes[fork]
+                )
+                for wallet_id in wallet_ids
+            ]
+        logger.warning(
+            f"watchonly: {progress.network} reorg, {len(wallet_ids)} wallets "
+            f"rolled back from block {height} to {fork}"
+        )
+        if progress.reorg_height is None or fork < progress.reorg_height:
+            progress.reorg_height = fork
+    return kept
+
+
+async def _in_chain(
+    client: BlockFilterClient, tip_height: Optional[int], height: int, block_hash: str
+) -> bool:
+    if tip_height is None or height > tip_height:
+        return False
+    return await client.get_block_hash(height) == block_hash
+
+
+async def scan_block(wallet_ids: set[str], height: int, txs: list[Transaction]):
+    """Update the UTXOs and the amounts of the addresses of the wallets paid
+    or spent by the transactions of the block, then extend the gap of the
+    wallets with new activity (and look again for the new addresses in the
+    block)"""
+    for _ in range(MAX_GAP_EXTENSIONS):
+        active_wallets = await _apply_block(wallet_ids, height, txs)
+        extended = False
+        for wallet_id in active_wallets:
+            wallet = await get_watch_wallet(wallet_id)
+            if not wallet:
+                continue
+            config = await get_config(wallet.user)
+            created = await create_gap_addresses(
+                wallet.id, config.receive_gap_limit, config.change_gap_limit
+            )
+            extended = extended or len(created) > 0
+        if not extended:
+            return
+
+
+async def _apply_block(
+    wallet_ids: set[str], height: int, txs: list[Transaction]
+) -> set[str]:
+    """Store the changes of the block, returns the wallets paid in it"""
+    index = await get_address_index()
+    received: dict[bytes, list[tuple[str, int, int]]] = {}
+    spent_outpoints: set[tuple[str, int]] = set()
+    for tx in txs:
+        tx_id = tx.txid().hex()
+        for vout, _ in index.match_outputs(tx):
+            out = tx.vout[vout]
+            received.setdefault(out.script_pubkey.data, []).append(
+                (tx_id, vout, out.value)
+            )
+        # the null outpoint of the coinbase matches no UTXO
+        spent_outpoints.update((inp.txid.hex(), inp.vout) for inp in tx.vin)
+
+    # addresses of the scanned wallets
+    addresses: dict[str, Address] = {}
+    receivers = await get_addresses_by_scripthashes(
+        [script_scripthash(spk) for spk in received]
+    )
+    spent = [
+        utxo
+        for utxo in await get_utxos_by_tx_ids(list({i for i, _ in spent_outpoints}))
+        if (utxo.tx_id, utxo.vout) in spent_outpoints
+    ]
+    spenders = await get_addresses_by_ids(
+        list({u.address_id for u in spent} - {a.id for a in receivers})
+    )
+    for address in receivers + spenders:
+        if address.wallet in wallet_ids:
+            addresses[address.id] = address
+    if not addresses:
+        return set()
+
+    utxos: dict[str, dict[tuple[str, int], WalletUtxo]] = {i: {} for i in addresses}
+    for utxo in await get_utxos_by_address_ids(list(addresses)):
+        utxos[utxo.address_id][(utxo.tx_id, utxo.vout)] = utxo
+    active_wallets = set()
+    for address in receivers:
+        if address.id not in addresses:
+            continue
+        active_wallets.add(address.wallet)
+        spk = bytes.fromhex(address.script_pubkey or "")
+        for tx_id, vout, amount in received.get(spk, []):
+            utxos[address.id][(tx_id, vout)] = WalletUtxo(
+                address_id=address.id,
+                wallet=address.wallet,
+                tx_id=tx_id,
+                vout=vout,
+                amount=amount,
+                confirmed=True,
+                block_height=height,
+            )
+    spent_utxos = []
+    for address_utxos in utxos.values():
+        for outpoint in spent_outpoints & address_utxos.keys():
+            spent_utxos.append(
+                SpentUtxo(**address_utxos.pop(outpoint).dict(), spent_height=height)
+            )
+
+    # restored if the block is reorganized out of the chain
+    await save_spent_utxos(spent_utxos)
+    await update_address_utxos(
+        list(addresses),
+        [u for address_utxos in utxos.values() for u in address_utxos.values()],
+    )
+    changed = []
+    for address in addresses.values():
+        amount = sum(u.amount for u in utxos[address.id].values())
+        if address.amount == amount and address.has_activity:
+            continue
+        address.amount = amount
+        address.has_activity = True
+        changed.append(address)
+    await update_addresses(changed)
+    return active_wallets
@@ -1,9 +1,30 @@
+import hashlib
+import time
+from functools import lru_cache
 from typing import Optional, Tuple
 
+from embit import script
 from embit.descriptor import Descriptor, Key
-from embit.descriptor.arguments import AllowedDerivation
+from embit.descriptor.arguments import AllowedDerivation, KeyOrigin
 from embit.networks import NETWORKS
 
+from . import metrics
+
+# number of distinct masterpubs (wallets) kept parsed in memory
+PARSED_KEYS_CACHE_SIZE = 256
+
+
+def mempool_api_url(mempool_endpoint: str, network: str) -> str:
+    """Base url of the mempool.space REST API for the given network"""
+    endpoint = mempool_endpoint.rstrip("/")
+    return endpoint if network == "Mainnet" else endpoint + "/testnet"
+
+
+def mempool_ws_url(mempool_endpoint: str, network: str) -> str:
+    """Url of the mempool.space websocket API for the given network"""
+    url = mempool_api_url(mempool_endpoint, network) + "/api/v1/ws"
+    return "ws" + url[len("http") :] if url.startswith("http") else url
+
 
 def detect_network(k):
     version = k.key.version
@@ -14,9 +35,11 @@ def detect_network(k):
             return net
 
 
+@lru_cache(maxsize=PARSED_KEYS_CACHE_SIZE)
 def parse_key(masterpub: str) -> Tuple[Descriptor, Optional[dict]]:
     """Parses masterpub or descriptor and returns a tuple: (Descriptor, network)
     To create addresses use descriptor.derive(num).address(network=network)
+    The result is cached per masterpub and must not be mutated by the caller.
     """
     network = None
     desc = None
@@ -72,6 +95,112 @@ def parse_key(masterpub: str) -> Tuple[Descriptor, Optional[dict]]:
     return desc, network
 
 
+@lru_cache(maxsize=2 * PARSED_KEYS_CACHE_SIZE)
+def branch_descriptor(masterpub: str, branch_index: int) -> Descriptor:
+    """Returns the descriptor of the receive (0) or change (1) branch with the
+    extended keys already derived down to the branch level, so that deriving
+    an address only costs one child derivation per key.
+    """
+    desc, _ = parse_key(masterpub)
+    # `branch()` creates new key objects, it is safe to update them in place
+    branch = desc.branch(branch_index)
+    for k in branch.keys:
+        if not k.can_derive:
+            continue
+        indexes = k.allowed_derivation.indexes
+        # only `.../<path>/*` can be pre-derived, keep exotic wildcards as is
+        if len(indexes) < 2 or indexes[-1] is not None or None in indexes[:-1]:
+            continue
+        path = indexes[:-1]
+        if k.origin:
+            k.origin = KeyOrigin(k.origin.fingerprint, k.origin.derivation + path)
+        else:
+            k.origin = KeyOrigin(k.key.child(0).fingerprint, path)
+        k.key = k.key.derive(path)
+        k.allowed_derivation = AllowedDerivation([None])
+    return branch
+
+
 async def derive_address(masterpub: str, num: int, branch_index=0):
-    desc, network = parse_key(masterpub)
-    return desc.derive(num, branch_index).address(network=network)
+    address, _ = derive_address_script(masterpub, num, branch_index)
+    return address
+
+
+def derive_address_script(
+    masterpub: str, num: int, branch_index=0
+) -> Tuple[str, bytes]:
+    """Address and scriptPubKey at the index of the branch"""
+    start = time.perf_counter() if metrics.enabled else 0
+    _, network = parse_key(masterpub)
+    desc = branch_descriptor(masterpub, branch_index)
+    script_pubkey = desc.derive(num).script_pubkey()
+    address = script_pubkey.address(network=network)
+    if metrics.enabled:
+        metrics.DERIVATIONS.observe(time.perf_counter() - start)
+    return address, script_pubkey.data
+
+
+def derive_address_scripts(
+    masterpub: str, start: int, end: int, branch_index=0
+) -> list[Tuple[str, bytes]]:
+    """Addresses and scriptPubKeys of the range of the branch, run in the
+    worker pool"""
+    return [
+        derive_address_script(masterpub, i, branch_index) for i in range(start, end)
+    ]
+
+
+def _var_int_size(n: int) -> int:
+    return 1 if n < 0xFD else 3 if n <= 0xFFFF else 5
+
+
+@lru_cache(maxsize=PARSED_KEYS_CACHE_SIZE)
+def input_weight(masterpub: str) -> int:
+    """Estimated weight (in weight units) of an input spending an output of the
+    wallet, assuming 72 byte ECDSA signatures (worst case)."""
+    desc, _ = parse_key(masterpub)
+    script_sig = 0
+    witness: list[int] = []  # sizes of the witness stack items
+    if desc.taproot:
+        # key path spend
+        witness = [64]
+    elif desc.miniscript:
+        n = len(desc.keys)
+        multi = type(desc.miniscript).__name__ in ("Multi", "Sortedmulti")
+        m = desc.miniscript.args[0].num if multi else n
+        # OP_m <n pubkeys> OP_n OP_CHECKMULTISIG
+        redeem_script = 3 + 34 * n
+        if desc.wsh:
+            witness = [0] + [72] * m + [redeem_script]
+            # p2sh-p2wsh pushes the 34 byte witness program
+            script_sig = 35 if desc.sh else 0
+        else:
+            script_sig = 1 + 73 * m + (2 if redeem_script > 75 else 1) + redeem_script
+    elif desc.wpkh:
+        witness = [72, 33]
+        # p2sh-p2wpkh pushes the 22 byte witness program
+        script_sig = 23 if desc.sh else 0
+    else:
+        script_sig = 73 + 34
+
+    # outpoint, script_sig and sequence
+    weight = 4 * (36 + _var_int_size(script_sig) + script_sig + 4)
+    if witness:
+        weight += _var_int_size(len(witness))
+        weight += sum(_var_int_size(item) + item for item in witness)
+    return weight
+
+
+def output_weight(address: str) -> int:
+    """Weight (in weight units) of an output paying to the address"""
+    script_pubkey = script.address_to_scriptpubkey(address)
+    return 4 * (8 + _var_int_size(len(script_pubkey.data)) + len(script_pubkey.data))
+
+
+def script_scripthash(script_pubkey: bytes) -> str:
+    """Electrum scripthash: reversed sha256 of the scriptPubKey, hex encoded"""
+    return hashlib.sha256(script_pubkey).digest()[::-1].hex()
+
+
+def address_scripthash(address: str) -> str:
+    return script_scripthash(script.address_to_scriptpubkey(address).data)
@@ -0,0 +1,224 @@
+import asyncio
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+import httpx
+from embit.transaction import Transaction
+
+from . import metrics
+from .models import AddressUtxo
+
+# status codes for which a request is retried (rate limited or server busy)
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+MAX_RETRY_DELAY = 30
+# errors of a broadcast when the node already has the transaction
+ALREADY_BROADCASTED_ERRORS = [
+    "txn-already-in-mempool",
+    "txn-already-known",
+    "Transaction already in block chain",
+    "Transaction outputs already in utxo set",
+]
+
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+HTTP_MAX_CONNECTIONS = 50
+HTTP_MAX_CONNECTIONS_PER_HOST = 10
+HTTP_KEEPALIVE_EXPIRY = 30
+
+_http_client: Optional[httpx.AsyncClient] = None
+_host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def _http2_available() -> bool:
+    # httpx only supports HTTP/2 when the optional `h2` package is installed
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """The HTTP client shared by all the outbound requests of the extension"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=_http2_available(),
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    _host_semaphores.clear()
+
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    host = urlparse(url).netloc
+    if host not in _host_semaphores:
+        _host_semaphores[host] = asyncio.Semaphore(HTTP_MAX_CONNECTIONS_PER_HOST)
+    return _host_semaphores[host]
+
+
+class RateLimiter:
+    """Spaces out requests so that at most `rate` of them start per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class MempoolClient:
+    """
+    Client for the mempool.space (Esplora) REST API.
+    Requests go through the shared, pooled HTTP client. The number of parallel
+    requests and the number of requests per second are limited, failed
+    requests are retried with an exponential backoff.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        concurrency: int = HTTP_MAX_CONNECTIONS_PER_HOST,
+        rate_limit: float = 0,
+        max_retries: int = 5,
+        retry_delay: float = 1,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
+        self.api_url = api_url.rstrip("/")
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._http_client = http_client
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._rate_limiter = RateLimiter(rate_limit)
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        return self._http_client or get_http_client()
+
+    async def request(
+        self, method: str, path: str, max_retries: Optional[int] = None, **kwargs
+    ) -> httpx.Response:
+        """`max_retries` overrides the one of the client (e.g. 0 for the
+        requests that are not idempotent)"""
+        url = self.api_url + path
+        if max_retries is None:
+            max_retries = self.max_retries
+        async with self._semaphore, _host_semaphore(url):
+            retry = 0
+            while True:
+                await self._rate_limiter.wait()
+                delay = self.retry_delay * 2**retry
+                start = time.perf_counter()
+                try:
+                    r = await self.http_client.request(method, url, **kwargs)
+                    self._record(path, start, r.status_code)
+                    if r.status_code not in RETRY_STATUS_CODES or retry >= max_retries:
+                        r.raise_for_status()
+                        return r
+                    retry_after = r.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+                except httpx.TransportError as exc:
+                    self._record(path, start, error=type(exc).__name__)
+                    if retry >= max_retries:
+                        raise
+                retry += 1
+                await asyncio.sleep(min(delay, MAX_RETRY_DELAY))
+
+    def _record(self, path: str, start: float, status: int = 0, error: str = ""):
+        if not metrics.enabled:
+            return
+        host = urlparse(self.api_url).netloc
+        operation = self.operation(path)
+        metrics.MEMPOOL_REQUESTS.observe(time.perf_counter() - start, host, operation)
+        if status >= 400:
+            error = str(status)
+        if error:
+            metrics.MEMPOOL_ERRORS.inc(host, operation, error)
+
+    def operation(self, path: str) -> str:
+        """Metrics label of the request"""
+        return _operation(path)
+
+    async def get(self, path: str) -> httpx.Response:
+        return await self.request("GET", path)
+
+    async def get_address_stats(self, address: str) -> dict:
+        r = await self.get(f"/api/address/{address}")
+        return r.json()
+
+    async def get_address_utxos(self, address: str) -> list[AddressUtxo]:
+        r = await self.get(f"/api/address/{address}/utxo")
+        return [
+            AddressUtxo(
+                tx_id=utxo["txid"],
+                vout=utxo["vout"],
+                amount=utxo["value"],
+                confirmed=utxo["status"]["confirmed"],
+                block_height=utxo["status"].get("block_height"),
+                block_time=utxo["status"].get("block_time"),
+            )
+            for utxo in r.json()
+        ]
+
+    async def get_tx_hex(self, tx_id: str) -> str:
+        r = await self.get(f"/api/tx/{tx_id}/hex")
+        return r.text
+
+    async def get_tx_status(self, tx_id: str) -> dict:
+        r = await self.get(f"/api/tx/{tx_id}/status")
+        return r.json()
+
+    async def broadcast(self, tx_hex: str) -> str:
+        """Broadcast the raw transaction, returns the transaction id.
+        Not retried: the node may have received it even if the response was
+        lost, a transaction it already has is a success."""
+        try:
+            r = await self.request("POST", "/api/tx", max_retries=0, content=tx_hex)
+        except httpx.HTTPStatusError as exc:
+            if not any(e in exc.response.text for e in ALREADY_BROADCASTED_ERRORS):
+                raise
+            return Transaction.from_string(tx_hex).txid().hex()
+        return r.text
+
+
+def _operation(path: str) -> str:
+    """Path without the ids: `/api/tx/{tx_id}/hex` -> `tx/hex`"""
+    parts = path.strip("/").split("/")[1:]
+    return "/".join(parts[:1] + parts[2:])
+
+
+def address_balance(stats: dict) -> int:
+    """Confirmed plus unconfirmed balance from the `/api/address` stats"""
+    chain, mempool = stats["chain_stats"], stats["mempool_stats"]
+    return (
+        chain["funded_txo_sum"]
+        - chain["spent_txo_sum"]
+        + mempool["funded_txo_sum"]
+        - mempool["spent_txo_sum"]
+    )
+
+
+def address_tx_count(stats: dict) -> int:
+    return stats["chain_stats"]["tx_count"] + stats["mempool_stats"]["tx_count"]
@@ -0,0 +1,248 @@
+"""
+Latency histograms and counters of the hot paths, exposed in the Prometheus
+text format by `GET /api/v1/metrics` (LNbits admins only).
+
+Disabled by default, enable it with `WATCHONLY_METRICS=true`. When disabled
+the instrumented functions only check `enabled` before running.
+"""
+
+import functools
+import os
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+from contextvars import ContextVar
+
+from fastapi import HTTPException, Request, Response
+from fastapi.routing import APIRoute
+
+enabled = os.getenv("WATCHONLY_METRICS", "false").lower() in ("1", "true", "yes")
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+LabelValues = tuple[str, ...]
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (not cumulative, +Inf last), sum]
+        self.values: dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        data = self.values.get(label_values)
+        if data is None:
+            data = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _labels((*self.labels, "le"), (*label_values, f"{bound}"))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total:g}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def _labels(names: tuple[str, ...], values: LabelValues) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+HTTP_REQUESTS = Histogram(
+    "watchonly_http_request_duration_seconds",
+    "API request latency.",
+    ("method", "route", "status"),
+)
+CRUD_CALLS = Histogram(
+    "watchonly_crud_duration_seconds",
+    "Duration of the crud.py functions.",
+    ("function",),
+)
+DB_QUERIES = Histogram(
+    "watchonly_db_query_duration_seconds",
+    "Database query duration, by the crud.py function running it.",
+    ("function",),
+)
+DERIVATIONS = Histogram(
+    "watchonly_derivation_duration_seconds",
+    "Address derivation duration.",
+)
+MEMPOOL_REQUESTS = Histogram(
+    "watchonly_mempool_request_duration_seconds",
+    "Outbound mempool (Esplora) request latency, per attempt.",
+    ("host", "operation"),
+)
+MEMPOOL_ERRORS = Counter(
+    "watchonly_mempool_errors_total",
+    "Failed outbound mempool requests, per attempt.",
+    ("host", "operation", "error"),
+)
+ELECTRUM_BATCHES = Histogram(
+    "watchonly_electrum_batch_duration_seconds",
+    "Round trip of the pipelined Electrum requests.",
+    ("host",),
+)
+WORKER_JOBS = Histogram(
+    "watchonly_worker_job_duration_seconds",
+    "Duration of the jobs run in the worker pool, waiting included.",
+    ("function",),
+)
+CONFIG_CACHE = Counter(
+    "watchonly_config_cache_requests_total",
+    "Config lookups served from memory (hit) or the database (miss).",
+    ("result",),
+)
+
+METRICS: list = [
+    HTTP_REQUESTS,
+    CRUD_CALLS,
+    DB_QUERIES,
+    DERIVATIONS,
+    MEMPOOL_REQUESTS,
+    MEMPOOL_ERRORS,
+    ELECTRUM_BATCHES,
+    WORKER_JOBS,
+    CONFIG_CACHE,
+]
+
+# crud.py function running the current database queries
+current_function: ContextVar[str] = ContextVar("current_function", default="")
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    for metric in METRICS:
+        metric.values.clear()
+
+
+def timed_crud(func: Callable) -> Callable:
+    """Record the duration of the crud function, and of the queries it runs"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not enabled:
+            return await func(*args, **kwargs)
+        token = current_function.set(func.__name__)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            CRUD_CALLS.observe(time.perf_counter() - start, func.__name__)
+            current_function.reset(token)
+
+    return wrapper
+
+
+def instrument_engine(engine):
+    """Record the duration of every query run by the (sync) SQLAlchemy engine"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        if enabled:
+            conn.info.setdefault("watchonly_query_start", []).append(
+                time.perf_counter()
+            )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        starts = conn.info.get("watchonly_query_start")
+        if enabled and starts:
+            DB_QUERIES.observe(
+                time.perf_counter() - starts.pop(), current_function.get() or "other"
+            )
+
+
+class TimedRoute(APIRoute):
+    """Route recording its latency in `HTTP_REQUESTS`"""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request) -> Response:
+            if not enabled:
+                return await handler(request)
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as exc:
+                status = exc.status_code
+                raise
+            finally:
+                HTTP_REQUESTS.observe(
+                    time.perf_counter() - start,
+                    request.method,
+                    self.path_format,
+                    str(status),
+                )
+
+        return timed_handler
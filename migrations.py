@@ -1,3 +1,9 @@
+import hashlib
+
+from embit import script
+from lnbits.db import SQLITE
+
+
 async def m001_initial(db):
     """
     Initial wallet table.
@@ -107,3 +113,272 @@ async def m007_add_wallet_meta_data(db):
     Add 'meta' for storing various metadata about the wallet
     """
     await db.execute("ALTER TABLE watchonly.wallets ADD COLUMN meta TEXT DEFAULT '{}';")
+
+
+async def m008_add_indexes_to_addresses(db):
+    """
+    Remove duplicated addresses (same wallet, branch and index), then add a
+    unique index on (wallet, branch_index, address_index) and an index on
+    `address`.
+    """
+    duplicates = await db.fetchall(
+        """
+        SELECT wallet, branch_index, address_index FROM watchonly.addresses
+        GROUP BY wallet, branch_index, address_index HAVING COUNT(*) > 1
+        """
+    )
+    for duplicate in duplicates:
+        rows = await db.fetchall(
+            """
+            SELECT id, amount, has_activity, note FROM watchonly.addresses
+            WHERE wallet = :wallet AND branch_index = :branch_index
+            AND address_index = :address_index
+            """,
+            dict(duplicate),
+        )
+        # keep the entry with the most information about the address
+        keep = max(
+            rows, key=lambda r: (bool(r["has_activity"]), bool(r["note"]), r["amount"])
+        )
+        for row in rows:
+            if row["id"] != keep["id"]:
+                await db.execute(
+                    "DELETE FROM watchonly.addresses WHERE id = :id", {"id": row["id"]}
+                )
+
+    await _create_index(
+        db,
+        "addresses_wallet_branch_index_idx",
+        "addresses",
+        "wallet, branch_index, address_index",
+        unique=True,
+    )
+    await _create_index(db, "addresses_address_idx", "addresses", "address")
+
+
+async def m009_create_transactions_and_utxos_tables(db):
+    """
+    Cache of raw confirmed transactions (by id) and of the UTXOs of the addresses
+    """
+    await db.execute(
+        """
+        CREATE TABLE watchonly.transactions (
+            id TEXT NOT NULL PRIMARY KEY,
+            tx_hex TEXT NOT NULL,
+            block_height INTEGER
+        );
+    """
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE watchonly.utxos (
+            address_id TEXT NOT NULL,
+            wallet TEXT NOT NULL,
+            tx_id TEXT NOT NULL,
+            vout INTEGER NOT NULL,
+            amount {db.big_int} NOT NULL,
+            confirmed BOOLEAN NOT NULL DEFAULT false,
+            block_height INTEGER,
+            block_time INTEGER,
+            PRIMARY KEY (address_id, tx_id, vout)
+        );
+    """
+    )
+    await _create_index(db, "utxos_wallet_idx", "utxos", "wallet")
+
+
+async def m010_add_unique_index_to_config(db):
+    """
+    Keep one config per user and add a unique index on "user", so that the
+    config can be created on first access without races.
+    """
+    duplicates = await db.fetchall(
+        """
+        SELECT "user" FROM watchonly.config GROUP BY "user" HAVING COUNT(*) > 1
+        """
+    )
+    for duplicate in duplicates:
+        row = await db.fetchone(
+            """SELECT * FROM watchonly.config WHERE "user" = :user""",
+            {"user": duplicate["user"]},
+        )
+        await db.execute(
+            """DELETE FROM watchonly.config WHERE "user" = :user""",
+            {"user": duplicate["user"]},
+        )
+        await db.execute(
+            """
+            INSERT INTO watchonly.config ("user", json_data)
+            VALUES (:user, :json_data)
+            """,
+            dict(row),
+        )
+
+    await _create_index(db, "config_user_idx", "config", '"user"', unique=True)
+
+
+async def m011_add_branch_balances_to_wallets(db):
+    """
+    Add the receive and change balances of the wallets, and compute all the
+    balances from the address amounts. They are kept up to date from then on.
+    """
+    for column in ["receive_balance", "change_balance"]:
+        await db.execute(
+            f"""
+            ALTER TABLE watchonly.wallets
+            ADD COLUMN {column} {db.big_int} NOT NULL DEFAULT 0
+            """
+        )
+
+    def branch_sum(branch_filter: str) -> str:
+        return f"""
+            (SELECT COALESCE(SUM(amount), 0) FROM watchonly.addresses
+            WHERE addresses.wallet = wallets.id {branch_filter})
+        """
+
+    await db.execute(
+        f"""
+        UPDATE watchonly.wallets SET
+            balance = {branch_sum("")},
+            receive_balance = {branch_sum("AND branch_index = 0")},
+            change_balance = {branch_sum("AND branch_index = 1")}
+        """
+    )
+
+
+async def m012_add_scripts_to_addresses(db):
+    """
+    Store the scriptPubKey and the Electrum scripthash of the addresses, the
+    outputs of transactions can then be matched with an indexed lookup.
+    """
+    await db.execute("ALTER TABLE watchonly.addresses ADD COLUMN script_pubkey TEXT")
+    await db.execute("ALTER TABLE watchonly.addresses ADD COLUMN scripthash TEXT")
+    await _backfill_address_scripts(db)
+    await _create_index(db, "addresses_scripthash_idx", "addresses", "scripthash")
+
+
+async def _backfill_address_scripts(db):
+    last_id = ""
+    while True:
+        rows = await db.fetchall(
+            """
+            SELECT id, address FROM watchonly.addresses
+            WHERE id > :last_id ORDER BY id LIMIT 1000
+            """,
+            {"last_id": last_id},
+        )
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        for row in rows:
+            try:
+                script_pubkey = script.address_to_scriptpubkey(row["address"]).data
+            except Exception:
+                # not an address of a supported type, left unset
+                continue
+            await db.execute(
+                """
+                UPDATE watchonly.addresses
+                SET script_pubkey = :script_pubkey, scripthash = :scripthash
+                WHERE id = :id
+                """,
+                {
+                    "id": row["id"],
+                    "script_pubkey": script_pubkey.hex(),
+                    "scripthash": hashlib.sha256(script_pubkey).digest()[::-1].hex(),
+                },
+            )
+
+
+async def m013_create_block_filter_checkpoints_table(db):
+    """
+    Last block scanned with the compact block filters, per network
+    """
+    await db.execute(
+        """
+        CREATE TABLE watchonly.block_filter_checkpoints (
+            network TEXT NOT NULL PRIMARY KEY,
+            height INTEGER NOT NULL,
+            block_hash TEXT NOT NULL
+        );
+    """
+    )
+
+
+async def m014_create_wallet_sync_tables(db):
+    """
+    Last block scanned with the compact block filters per wallet, and the
+    hashes of the recent scanned blocks to detect the reorgs. Replaces the
+    checkpoint per network.
+    """
+    await db.execute(
+        """
+        CREATE TABLE watchonly.wallet_sync_checkpoints (
+            wallet TEXT NOT NULL PRIMARY KEY,
+            height INTEGER NOT NULL,
+            block_hash TEXT NOT NULL
+        );
+    """
+    )
+    await db.execute(
+        """
+        CREATE TABLE watchonly.block_hashes (
+            network TEXT NOT NULL,
+            height INTEGER NOT NULL,
+            block_hash TEXT NOT NULL,
+            PRIMARY KEY (network, height)
+        );
+    """
+    )
+    await db.execute(
+        """
+        INSERT INTO watchonly.wallet_sync_checkpoints (wallet, height, block_hash)
+        SELECT w.id, c.height, c.block_hash
+        FROM watchonly.wallets w
+        JOIN watchonly.block_filter_checkpoints c ON c.network = w.network
+    """
+    )
+    await db.execute(
+        """
+        INSERT INTO watchonly.block_hashes (network, height, block_hash)
+        SELECT network, height, block_hash FROM watchonly.block_filter_checkpoints
+    """
+    )
+    await db.execute("DROP TABLE watchonly.block_filter_checkpoints")
+
+
+async def m015_create_spent_utxos_table(db):
+    """
+    UTXOs spent in the recent blocks scanned with the block filters, restored
+    when the spending block is reorganized out of the chain
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE watchonly.spent_utxos (
+            address_id TEXT NOT NULL,
+            wallet TEXT NOT NULL,
+            tx_id TEXT NOT NULL,
+            vout INTEGER NOT NULL,
+            amount {db.big_int} NOT NULL,
+            confirmed BOOLEAN NOT NULL DEFAULT false,
+            block_height INTEGER,
+            block_time INTEGER,
+            spent_height INTEGER NOT NULL,
+            PRIMARY KEY (address_id, tx_id, vout)
+        );
+    """
+    )
+    await _create_index(db, "spent_utxos_wallet_idx", "spent_utxos", "wallet")
+
+
+async def _create_index(db, name: str, table: str, columns: str, unique=False):
+    # sqlite expects the schema on the index name, postgres on the table name
+    index_schema, table_schema = (
+        ("watchonly.", "") if db.type == SQLITE else ("", "watchonly.")
+    )
+    await db.execute(
+        f"""
+        CREATE {"UNIQUE " if unique else ""}INDEX {index_schema}{name}
+        ON {table_schema}{table} ({columns})
+        """
+    )
@@ -19,6 +19,9 @@ class WalletAccount(BaseModel):
     title: str
     address_no: int
     balance: int
+    # balance of the receive (0) and change (1) branches
+    receive_balance: int = 0
+    change_balance: int = 0
     type: Optional[str] = ""
     network: str = "Mainnet"
     meta: str = "{}"
@@ -33,6 +36,38 @@ class Address(BaseModel):
     address_index: int
     note: Optional[str] = None
     has_activity: bool = False
+    # hex, set when the address is created
+    script_pubkey: Optional[str] = None
+    # Electrum scripthash of the scriptPubKey, indexed
+    scripthash: Optional[str] = None
+
+
+class AddressPool(BaseModel):
+    wallet: str
+    address_no: int
+    branch_index: int
+    # highest derived index, and highest index with activity (or -1)
+    last_index: int
+    last_active_index: int
+
+    @property
+    def last_used_index(self) -> int:
+        """Receive addresses are used once handed out (`address_no`)"""
+        if self.branch_index == 0:
+            return max(self.last_active_index, self.address_no)
+        return self.last_active_index
+
+    @property
+    def unused(self) -> int:
+        """Derived addresses after the last used one"""
+        return self.last_index - self.last_used_index
+
+
+class AddressUpdate(BaseModel):
+    # only the fields that are set are updated
+    id: str
+    amount: Optional[int] = None
+    note: Optional[str] = None
 
 
 class TransactionInput(BaseModel):
@@ -43,7 +78,8 @@ class TransactionInput(BaseModel):
     branch_index: int
     address_index: int
     wallet: str
-    tx_hex: str
+    # looked up in the transactions cache (or fetched) when missing
+    tx_hex: Optional[str] = None
 
 
 class TransactionOutput(BaseModel):
@@ -54,6 +90,26 @@ class TransactionOutput(BaseModel):
     wallet: Optional[str] = None
 
 
+class CoinSelect(BaseModel):
+    # wallets whose UTXOs (found by the server side scan) can be spent
+    wallets: list[str]
+    outputs: list[TransactionOutput]
+    fee_rate: float
+    # wallet receiving the change, the first wallet by default
+    change_wallet: Optional[str] = None
+    include_unconfirmed = True
+
+
+class CoinSelection(BaseModel):
+    inputs: list[TransactionInput]
+    # the requested outputs, followed by the change output (if any)
+    outputs: list[TransactionOutput]
+    fee: int
+    tx_size: int
+    change: int
+    algorithm: str
+
+
 class MasterPublicKey(BaseModel):
     id: str
     public_key: str
@@ -68,13 +124,26 @@ class CreatePsbt(BaseModel):
     tx_size: int
 
 
+class PsbtStreamHeader(BaseModel):
+    # first line of the `POST /api/v1/psbt/stream` body, the inputs follow
+    masterpubs: list[MasterPublicKey]
+    outputs: list[TransactionOutput]
+
+
 class SerializedTransaction(BaseModel):
     tx_hex: str
 
 
 class ExtractPsbt(BaseModel):
     psbt_base64 = ""
-    inputs: list[SerializedTransaction]
+    # previous transactions of the inputs, looked up by tx id when missing
+    inputs: list[SerializedTransaction] = []
+    network = "Mainnet"
+
+
+class DecodeTransactions(BaseModel):
+    # raw transactions (hex) and/or PSBTs (base64 or hex)
+    transactions: list[str]
     network = "Mainnet"
 
 
@@ -94,8 +163,114 @@ class Config(BaseModel):
     change_gap_limit = 5
     sats_denominated = True
     network = "Mainnet"
+    # server side scanning: parallel requests and requests per second (0 = no limit)
+    scan_concurrency = 5
+    scan_rate_limit = 10.0
+    # chain data source of the server: "esplora" (`mempool_endpoint`) or
+    # "electrum", the servers are `ssl://host:port` or `tcp://host:port`
+    chain_backend = "esplora"
+    electrum_server = ""
+    electrum_testnet_server = ""
 
 
 class ConfigDb(BaseModel):
     user: str
     json_data: Config
+
+
+class AddressUtxo(BaseModel):
+    tx_id: str
+    vout: int
+    amount: int
+    confirmed: bool = False
+    block_height: Optional[int] = None
+    block_time: Optional[int] = None
+
+
+class WalletUtxo(AddressUtxo):
+    address_id: str
+    wallet: str
+
+
+class SpentUtxo(WalletUtxo):
+    """UTXO spent in a recent block, kept to undo the spend on a reorg"""
+
+    spent_height: int
+
+
+class CachedTransaction(BaseModel):
+    id: str
+    tx_hex: str
+    block_height: Optional[int] = None
+
+
+class AddressHistory(BaseModel):
+    amount: int = 0
+    tx_count: int = 0
+    utxos: list[AddressUtxo] = []
+
+
+class ScannedAddress(BaseModel):
+    id: str
+    address: str
+    wallet: str
+    branch_index: int
+    address_index: int
+    amount: int = 0
+    tx_count: int = 0
+    utxos: list[AddressUtxo] = []
+
+
+class ScanProgress(BaseModel):
+    wallet: str
+    status: str = "running"  # running, done, failed, cancelled
+    total: int = 0
+    scanned: int = 0
+    active: int = 0
+    error: Optional[str] = None
+    started_at: int
+    finished_at: Optional[int] = None
+
+
+class ScanResult(BaseModel):
+    progress: ScanProgress
+    addresses: list[ScannedAddress] = []
+
+
+class StartFilterScan(BaseModel):
+    network = "Mainnet"
+    # first block to scan, by default the block after the checkpoint of each
+    # wallet (the wallets never scanned are skipped)
+    start_height: Optional[int] = None
+
+
+class FilterScanProgress(BaseModel):
+    network: str
+    status: str = "running"  # running, done, failed, cancelled
+    start_height: Optional[int] = None
+    # last scanned block
+    height: Optional[int] = None
+    tip_height: Optional[int] = None
+    matched_blocks: int = 0
+    # wallets scanned, and never scanned skipped for lack of a start height
+    wallets: int = 0
+    skipped_wallets: int = 0
+    # last block kept when the checkpoints were rolled back by a reorg
+    reorg_height: Optional[int] = None
+    error: Optional[str] = None
+    started_at: int
+    finished_at: Optional[int] = None
+
+
+class BlockHash(BaseModel):
+    network: str
+    height: int
+    block_hash: str
+
+
+class WalletSyncCheckpoint(BaseModel):
+    """Last block scanned with the block filters for the wallet"""
+
+    wallet: str
+    height: int
+    block_hash: str
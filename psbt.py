@@ -0,0 +1,261 @@
+"""
+CPU bound PSBT and transaction handling.
+The functions are synchronous and only take and return picklable values, so
+that they can run in the worker pool (see `workers.py`).
+"""
+
+import json
+from io import BytesIO
+from typing import Optional
+
+from embit import finalizer, script
+from embit.ec import PublicKey
+from embit.networks import NETWORKS
+from embit.psbt import PSBT, DerivationPath, InputScope, OutputScope, ser_string
+from embit.transaction import Transaction, TransactionInput, TransactionOutput
+
+from . import models
+from .helpers import branch_descriptor, parse_key
+from .models import CreatePsbt, SignedTransaction
+
+# "psbt" magic bytes, base64 and hex encoded
+PSBT_BASE64_PREFIX = "cHNidP"
+PSBT_HEX_PREFIX = "70736274ff"
+
+
+def create_psbt(data: CreatePsbt) -> str:
+    """Base64 PSBT for the inputs and outputs, `tx_hex` must be set for all inputs"""
+    descriptors = {}
+    for _, masterpub in enumerate(data.masterpubs):
+        descriptors[masterpub.id] = parse_key(masterpub.public_key)
+
+    vin = [TransactionInput(bytes.fromhex(inp.tx_id), inp.vout) for inp in data.inputs]
+    vout = [
+        TransactionOutput(out.amount, script.address_to_scriptpubkey(out.address))
+        for out in data.outputs
+    ]
+
+    inputs_extra: list[dict] = []
+
+    for inp in data.inputs:
+        bip32_derivations = {}
+        descriptor = descriptors[inp.wallet][0]
+        d = descriptor.derive(inp.address_index, inp.branch_index)
+        for k in d.keys:
+            bip32_derivations[PublicKey.parse(k.sec())] = DerivationPath(
+                k.origin.fingerprint, k.origin.derivation
+            )
+        assert inp.tx_hex, f"Missing transaction '{inp.tx_id}'"
+        inputs_extra.append(
+            {
+                "bip32_derivations": bip32_derivations,
+                "non_witness_utxo": Transaction.from_string(inp.tx_hex),
+            }
+        )
+
+    tx = Transaction(vin=vin, vout=vout)
+    psbt = PSBT(tx)
+
+    for i, inp_extra in enumerate(inputs_extra):
+        psbt.inputs[i].bip32_derivations = inp_extra["bip32_derivations"]
+        psbt.inputs[i].non_witness_utxo = inp_extra.get("non_witness_utxo", None)
+
+    outputs_extra = []
+    bip32_derivations = {}
+    for out in data.outputs:
+        if out.branch_index == 1:
+            assert out.wallet
+            descriptor = descriptors[out.wallet][0]
+            d = descriptor.derive(out.address_index, out.branch_index)
+            for k in d.keys:
+                bip32_derivations[PublicKey.parse(k.sec())] = DerivationPath(
+                    k.origin.fingerprint, k.origin.derivation
+                )
+            outputs_extra.append({"bip32_derivations": bip32_derivations})
+
+    for i, out_extra in enumerate(outputs_extra):
+        psbt.outputs[i].bip32_derivations = out_extra["bip32_derivations"]
+
+    return psbt.to_string()
+
+
+def serialize_psbt_inputs(
+    wallets: dict[str, str], inputs: list[models.TransactionInput]
+) -> bytes:
+    """
+    Serialized PSBT input maps of the inputs (see `serialize_psbt_header()`).
+    `wallets` maps the wallet ids to their masterpubs. Segwit inputs only
+    include the spent output (`witness_utxo`), `tx_hex` is only required for
+    the legacy inputs.
+    """
+    stream = BytesIO()
+    for inp in inputs:
+        # the branch descriptors are cached, keys are only derived once per branch
+        masterpub = wallets[inp.wallet]
+        desc = branch_descriptor(masterpub, inp.branch_index).derive(inp.address_index)
+        scope = InputScope(vin=TransactionInput(bytes.fromhex(inp.tx_id), inp.vout))
+        if desc.is_segwit:
+            scope.witness_utxo = TransactionOutput(inp.amount, desc.script_pubkey())
+        else:
+            assert inp.tx_hex, f"Missing transaction '{inp.tx_id}'"
+            scope.non_witness_utxo = Transaction.from_string(inp.tx_hex)
+        scope.redeem_script = desc.redeem_script()
+        scope.witness_script = desc.witness_script()
+        scope.bip32_derivations = _bip32_derivations(desc)
+        scope.write_to(stream)
+    return stream.getvalue()
+
+
+def serialize_psbt_header(
+    outpoints: list[tuple[str, int]], outputs: list[models.TransactionOutput]
+) -> bytes:
+    """Magic bytes and global map (the unsigned transaction) of the PSBT"""
+    vin = [TransactionInput(bytes.fromhex(tx_id), vout) for tx_id, vout in outpoints]
+    vout = [
+        TransactionOutput(out.amount, script.address_to_scriptpubkey(out.address))
+        for out in outputs
+    ]
+    stream = BytesIO()
+    stream.write(PSBT.MAGIC + b"\x01\x00")
+    ser_string(stream, Transaction(vin=vin, vout=vout).serialize())
+    stream.write(b"\x00")
+    return stream.getvalue()
+
+
+def serialize_psbt_outputs(
+    wallets: dict[str, str], outputs: list[models.TransactionOutput]
+) -> bytes:
+    """Serialized PSBT output maps, with the key derivations of the change"""
+    stream = BytesIO()
+    for out in outputs:
+        scope = OutputScope(
+            vout=TransactionOutput(
+                out.amount, script.address_to_scriptpubkey(out.address)
+            )
+        )
+        if out.branch_index == 1 and out.wallet in wallets:
+            assert out.address_index is not None
+            desc = branch_descriptor(wallets[out.wallet], 1).derive(out.address_index)
+            scope.bip32_derivations = _bip32_derivations(desc)
+        scope.write_to(stream)
+    return stream.getvalue()
+
+
+def _bip32_derivations(desc) -> dict:
+    return {
+        PublicKey.parse(k.sec()): DerivationPath(
+            k.origin.fingerprint, k.origin.derivation
+        )
+        for k in desc.keys
+    }
+
+
+def psbt_missing_tx_ids(psbt_base64: str) -> list[Optional[str]]:
+    """Per input, the id of the previous transaction if the spent output is
+    missing from the PSBT (neither `non_witness_utxo` nor `witness_utxo`),
+    `None` otherwise"""
+    psbt = PSBT.from_base64(psbt_base64)
+    return [
+        (
+            inp.txid.hex()
+            if inp.non_witness_utxo is None and inp.witness_utxo is None
+            else None
+        )
+        for inp in psbt.inputs
+    ]
+
+
+def extract_psbt(
+    psbt_base64: str, inputs_tx_hex: list[str], network_name: str
+) -> SignedTransaction:
+    """
+    Finalize the signed PSBT. `inputs_tx_hex` are the previous transactions of
+    the inputs, in order (empty to keep the ones in the PSBT).
+    """
+    network = NETWORKS["main"] if network_name == "Mainnet" else NETWORKS["test"]
+    psbt = PSBT.from_base64(psbt_base64)
+    for i, tx_hex in enumerate(inputs_tx_hex):
+        if tx_hex:
+            psbt.inputs[i].non_witness_utxo = Transaction.from_string(tx_hex)
+
+    final_psbt = finalizer.finalize_psbt(psbt)
+    if not final_psbt:
+        raise ValueError("PSBT cannot be finalized!")
+
+    tx_hex = final_psbt.to_string()
+    transaction = Transaction.from_string(tx_hex)
+    tx = {
+        "locktime": transaction.locktime,
+        "version": transaction.version,
+        "outputs": [],
+        "fee": psbt.fee(),
+    }
+
+    for out in transaction.vout:
+        tx["outputs"].append(
+            {"amount": out.value, "address": out.script_pubkey.address(network)}
+        )
+    return SignedTransaction(tx_hex=tx_hex, tx_json=json.dumps(tx))
+
+
+def extract_tx(tx_hex: str, network_name: str) -> dict:
+    network = NETWORKS["main"] if network_name == "Mainnet" else NETWORKS["test"]
+    transaction = Transaction.from_string(tx_hex)
+    tx = {
+        "locktime": transaction.locktime,
+        "version": transaction.version,
+        "outputs": [],
+    }
+
+    for out in transaction.vout:
+        tx["outputs"].append(
+            {"amount": out.value, "address": out.script_pubkey.address(network)}
+        )
+    return tx
+
+
+def decode_transactions(transactions: list[str], network_name: str) -> list[dict]:
+    """
+    Decoded raw transactions (hex) or PSBTs (base64 or hex), in order. The fee
+    is only known for the PSBTs with all the spent outputs. A transaction that
+    cannot be decoded gets an `error` instead.
+    """
+    network = NETWORKS["main"] if network_name == "Mainnet" else NETWORKS["test"]
+    decoded = []
+    for data in transactions:
+        try:
+            decoded.append(_decode_transaction(data.strip(), network))
+        except Exception as exc:
+            decoded.append({"error": str(exc) or type(exc).__name__})
+    return decoded
+
+
+def _decode_transaction(data: str, network: dict) -> dict:
+    fee = None
+    if data.startswith(PSBT_BASE64_PREFIX) or data.startswith(PSBT_HEX_PREFIX):
+        psbt = PSBT.from_string(data)
+        transaction = psbt.tx
+        try:
+            fee = psbt.fee()
+        except Exception:
+            # some spent outputs are missing
+            pass
+    else:
+        transaction = Transaction.from_string(data)
+
+    outputs = []
+    for out in transaction.vout:
+        try:
+            address: Optional[str] = out.script_pubkey.address(network)
+        except Exception:
+            # OP_RETURN and non standard scripts
+            address = None
+        outputs.append({"amount": out.value, "address": address})
+    return {
+        "tx_id": transaction.txid().hex(),
+        "version": transaction.version,
+        "locktime": transaction.locktime,
+        "inputs": [{"tx_id": i.txid.hex(), "vout": i.vout} for i in transaction.vin],
+        "outputs": outputs,
+        "fee": fee,
+    }
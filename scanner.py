@@ -0,0 +1,198 @@
+import asyncio
+import time
+from typing import Optional
+
+import httpx
+from loguru import logger
+
+from .backends import ChainBackend, chain_backend
+from .crud import (
+    create_fresh_addresses,
+    create_gap_addresses,
+    get_addresses,
+    update_address_utxos,
+    update_addresses,
+)
+from .models import (
+    Address,
+    Config,
+    ScannedAddress,
+    ScanProgress,
+    ScanResult,
+    WalletAccount,
+    WalletUtxo,
+)
+
+# safety check, same as the client side scan (20 000 addresses max)
+MAX_GAP_EXTENSIONS = 1000
+# addresses queried at once, the progress is updated after each batch
+SCAN_BATCH_SIZE = 100
+
+
+class ScanJob:
+    def __init__(self, wallet: WalletAccount):
+        self.progress = ScanProgress(wallet=wallet.id, started_at=int(time.time()))
+        self.addresses: dict[str, ScannedAddress] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.progress.status == "running"
+
+    def result(self) -> ScanResult:
+        addresses = sorted(
+            self.addresses.values(),
+            key=lambda a: (a.branch_index, a.address_index),
+        )
+        return ScanResult(progress=self.progress, addresses=addresses)
+
+
+scan_jobs: dict[str, ScanJob] = {}
+
+
+def get_scan_job(wallet_id: str) -> Optional[ScanJob]:
+    return scan_jobs.get(wallet_id)
+
+
+def start_scan(
+    wallet: WalletAccount,
+    config: Config,
+    http_client: Optional[httpx.AsyncClient] = None,
+) -> ScanJob:
+    """Start scanning the wallet in the background, unless it is already running"""
+    job = scan_jobs.get(wallet.id)
+    if job and job.running:
+        return job
+
+    backend = chain_backend(
+        config,
+        wallet.network,
+        concurrency=config.scan_concurrency,
+        rate_limit=config.scan_rate_limit,
+        http_client=http_client,
+    )
+    job = ScanJob(wallet)
+    job.task = asyncio.create_task(_run_scan(job, wallet, config, backend))
+    scan_jobs[wallet.id] = job
+    return job
+
+
+def cancel_scans():
+    for job in scan_jobs.values():
+        if job.task and not job.task.done():
+            job.task.cancel()
+
+
+async def _run_scan(
+    job: ScanJob, wallet: WalletAccount, config: Config, backend: ChainBackend
+):
+    try:
+        await scan_wallet(job, wallet, config, backend)
+        job.progress.status = "done"
+    except asyncio.CancelledError:
+        job.progress.status = "cancelled"
+        raise
+    except Exception as exc:
+        logger.warning(f"Scanning wallet '{wallet.id}' failed: {exc!s}")
+        job.progress.status = "failed"
+        job.progress.error = str(exc)
+    finally:
+        job.progress.finished_at = int(time.time())
+
+
+async def scan_wallet(
+    job: ScanJob, wallet: WalletAccount, config: Config, backend: ChainBackend
+):
+    """
+    Scan all the addresses of the wallet and extend the receive and change
+    branches until the last `gap_limit` addresses have no activity.
+    """
+    await create_gap_addresses(
+        wallet.id, config.receive_gap_limit, config.change_gap_limit
+    )
+    addresses = await get_addresses(wallet.id)
+
+    # highest known and highest active index per branch
+    last_index = {0: -1, 1: -1}
+    last_active_index = {0: -1, 1: -1}
+    gap_limits = {0: config.receive_gap_limit, 1: config.change_gap_limit}
+
+    pending = addresses
+    for _ in range(MAX_GAP_EXTENSIONS):
+        if not pending:
+            break
+        job.progress.total += len(pending)
+        scanned = []
+        for start in range(0, len(pending), SCAN_BATCH_SIZE):
+            batch = pending[start : start + SCAN_BATCH_SIZE]
+            results = await scan_addresses(batch, backend)
+            _update_progress(job, results)
+            scanned += list(zip(batch, results))
+        await save_scanned_addresses(wallet.id, scanned)
+
+        for address, result in scanned:
+            branch = address.branch_index
+            last_index[branch] = max(last_index[branch], address.address_index)
+            if result.tx_count:
+                last_active_index[branch] = max(
+                    last_active_index[branch], address.address_index
+                )
+
+        pending = []
+        for branch, gap_limit in gap_limits.items():
+            end_index = last_active_index[branch] + gap_limit + 1
+            if last_active_index[branch] >= 0 and end_index > last_index[branch] + 1:
+                pending += await create_fresh_addresses(
+                    wallet.id, last_index[branch] + 1, end_index, branch == 1
+                )
+
+
+async def scan_addresses(
+    addresses: list[Address], backend: ChainBackend
+) -> list[ScannedAddress]:
+    """Current balance, number of transactions and UTXOs of the addresses"""
+    histories = await backend.get_address_histories(addresses)
+    return [
+        ScannedAddress(
+            id=address.id,
+            address=address.address,
+            wallet=address.wallet,
+            branch_index=address.branch_index,
+            address_index=address.address_index,
+            **history.dict(),
+        )
+        for address, history in zip(addresses, histories)
+    ]
+
+
+def _update_progress(job: ScanJob, results: list[ScannedAddress]):
+    job.progress.scanned += len(results)
+    for result in results:
+        if result.tx_count:
+            job.progress.active += 1
+            job.addresses[result.id] = result
+
+
+async def save_scanned_addresses(
+    wallet_id: str, scanned: list[tuple[Address, ScannedAddress]]
+) -> list[Address]:
+    """Store the scan results, returns the addresses that have changed"""
+    await update_address_utxos(
+        [address.id for address, _ in scanned],
+        [
+            WalletUtxo(address_id=address.id, wallet=wallet_id, **utxo.dict())
+            for address, result in scanned
+            for utxo in result.utxos
+        ],
+    )
+
+    changed = []
+    for address, result in scanned:
+        has_activity = address.has_activity or result.tx_count > 0
+        if address.amount == result.amount and address.has_activity == has_activity:
+            continue
+        address.amount = result.amount
+        address.has_activity = has_activity
+        changed.append(address)
+    await update_addresses(changed)
+    return changed
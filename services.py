@@ -0,0 +1,92 @@
+from math import ceil
+
+from .backends import ChainBackend
+from .coinselect import Coin, select_coins
+from .crud import (
+    create_transactions,
+    get_spendable_utxos,
+    get_transactions,
+    get_unused_change_address,
+)
+from .helpers import input_weight, output_weight
+from .models import (
+    CoinSelect,
+    CoinSelection,
+    TransactionOutput,
+    WalletAccount,
+)
+
+
+async def get_transactions_hex(
+    backend: ChainBackend, tx_ids: list[str]
+) -> dict[str, str]:
+    """
+    Raw transactions by id. Served from the transactions cache, the missing
+    ones are fetched from the chain backend and cached once they are confirmed.
+    """
+    tx_ids = list(dict.fromkeys(tx_ids))
+    txs = {tx.id: tx.tx_hex for tx in await get_transactions(tx_ids)}
+    missing = [tx_id for tx_id in tx_ids if tx_id not in txs]
+    if not missing:
+        return txs
+
+    fetched = await backend.get_transactions(missing)
+    txs.update({tx.id: tx.tx_hex for tx in fetched})
+    # unconfirmed transactions can still be replaced (RBF), do not cache them
+    await create_transactions([tx for tx in fetched if tx.block_height is not None])
+    return txs
+
+
+async def select_wallet_coins(
+    data: CoinSelect, wallets: dict[str, WalletAccount]
+) -> CoinSelection:
+    """
+    Select the UTXOs of the wallets paying the outputs at the fee rate.
+    The inputs and outputs of the result can be passed as they are to
+    `POST /api/v1/psbt`.
+    """
+    if not data.outputs:
+        raise ValueError("No outputs.")
+    if data.fee_rate <= 0:
+        raise ValueError("The fee rate must be positive.")
+
+    change_wallet = wallets[data.change_wallet or data.wallets[0]]
+    change_address = await get_unused_change_address(change_wallet.id)
+    if not change_address:
+        raise ValueError("No unused change address.")
+
+    utxos = await get_spendable_utxos(data.wallets, data.include_unconfirmed)
+    coins = [
+        Coin(utxo.amount, input_weight(wallets[utxo.wallet].masterpub))
+        for utxo in utxos
+    ]
+    selection = select_coins(
+        coins,
+        target=sum(out.amount for out in data.outputs),
+        fixed_weight=sum(output_weight(out.address) for out in data.outputs),
+        change_weight=output_weight(change_address.address),
+        change_spend_weight=input_weight(change_wallet.masterpub),
+        fee_rate=data.fee_rate,
+    )
+    if not selection:
+        raise ValueError("Insufficient funds.")
+
+    outputs = list(data.outputs)
+    if selection.change:
+        outputs.append(
+            TransactionOutput(
+                amount=selection.change,
+                address=change_address.address,
+                branch_index=change_address.branch_index,
+                address_index=change_address.address_index,
+                wallet=change_wallet.id,
+            )
+        )
+    return CoinSelection(
+        inputs=[utxos[i] for i in selection.coins],
+        outputs=outputs,
+        fee=selection.fee,
+        tx_size=ceil(selection.weight / 4),
+        change=selection.change,
+        algorithm=selection.algorithm,
+    )
@@ -164,10 +164,8 @@ window.app.component('payment', {
     },
     createPsbt: async function () {
       try {
+        // the previous transactions (tx_hex) are resolved by the server
         this.tx = this.createTx()
-        for (const input of this.tx.inputs) {
-          input.tx_hex = await this.fetchTxHex(input.tx_id)
-        }
 
         const changeOutput = this.tx.outputs.find(o => o.branch_index === 1)
         if (changeOutput) changeOutput.amount = this.changeAmount
@@ -292,34 +290,15 @@ window.app.component('payment', {
       }
     },
 
-    fetchUtxoHexForPsbt: async function (psbtBase64) {
-      if (this.tx?.inputs && this.tx?.inputs.length) return this.tx.inputs
-
-      const {data: psbtUtxos} = await LNbits.api.request(
-        'PUT',
-        '/watchonly/api/v1/psbt/utxos',
-        this.adminkey,
-        {psbtBase64}
-      )
-
-      const inputs = []
-      for (const utxo of psbtUtxos) {
-        const txHex = await this.fetchTxHex(utxo.tx_id)
-        inputs.push({tx_hex: txHex})
-      }
-      return inputs
-    },
     extractTxFromPsbt: async function (psbtBase64) {
       try {
-        const inputs = await this.fetchUtxoHexForPsbt(psbtBase64)
-
+        // the previous transactions of the inputs are resolved by the server
         const {data} = await LNbits.api.request(
           'PUT',
           '/watchonly/api/v1/psbt/extract',
           this.adminkey,
           {
-            psbtBase64,
-            inputs,
+            psbt_base64: psbtBase64,
             network: this.network
           }
         )
@@ -387,26 +366,6 @@ window.app.component('payment', {
         this.showFinalTx = false
       }
     },
-    fetchTxHex: async function (txId) {
-      const {
-        bitcoin: {transactions: transactionsAPI}
-      } = mempoolJS({
-        hostname: this.mempoolEndpoint
-      })
-
-      try {
-        const response = await transactionsAPI.getTxHex({txid: txId})
-        return response
-      } catch (error) {
-        this.$q.notify({
-          type: 'warning',
-          message: `Failed to fetch transaction details for tx id: '${txId}'`,
-          timeout: 10000
-        })
-        LNbits.utils.notifyApiError(error)
-        throw error
-      }
-    },
     handleOutputsChange: function () {
       this.$refs.utxoList.refreshUtxoSelection(this.totalPayedAmount)
     },
@@ -42,7 +42,9 @@ window.app = Vue.createApp({
       showEnterSignedPsbt: false,
       signedBase64Psbt: null,
 
-      connectedDeviceType: null
+      connectedDeviceType: null,
+      // server-sent events with the address activity, by wallet id
+      eventSources: {}
     }
   },
   computed: {
@@ -63,34 +65,38 @@ window.app = Vue.createApp({
   },
 
   methods: {
-    updateAmountForAddress: async function (addressData, amount = 0) {
+    updateAmountForAddress: function (addressData, amount = 0) {
+      addressData.amount = amount
+      if (!addressData.isChange) {
+        const addressWallet = this.walletAccounts.find(
+          w => w.id === addressData.wallet
+        )
+        if (
+          addressWallet &&
+          addressWallet.address_no < addressData.addressIndex
+        ) {
+          addressWallet.address_no = addressData.addressIndex
+        }
+      }
+    },
+    saveAddressAmounts: async function (addresses = []) {
+      if (!addresses.length) return
       try {
         const wallet = this.g.user.wallets[0]
-        addressData.amount = amount
-        if (!addressData.isChange) {
-          const addressWallet = this.walletAccounts.find(
-            w => w.id === addressData.wallet
-          )
-          if (
-            addressWallet &&
-            addressWallet.address_no < addressData.addressIndex
-          ) {
-            addressWallet.address_no = addressData.addressIndex
-          }
-        }
-
         // todo: account deleted
         await LNbits.api.request(
           'PUT',
-          `/watchonly/api/v1/address/${addressData.id}`,
+          '/watchonly/api/v1/addresses',
           wallet.adminkey,
-          {amount}
+          addresses.map(a => ({id: a.id, amount: a.amount}))
         )
       } catch (err) {
-        addressData.error = 'Failed to refresh amount for address'
+        addresses.forEach(a => {
+          a.error = 'Failed to refresh amount for address'
+        })
         this.$q.notify({
           type: 'warning',
-          message: `Failed to refresh amount for address ${addressData.address}`,
+          message: `Failed to refresh amount for ${addresses.length} addresses`,
           timeout: 10000
         })
         LNbits.utils.notifyApiError(err)
@@ -266,6 +272,8 @@ window.app = Vue.createApp({
     },
     updateUtxosForAddresses: async function (addresses = []) {
       this.scan = {scanning: true, scanCount: addresses.length, scanIndex: 0}
+      // amounts are saved in batches, not one request per address
+      let updatedAddresses = []
 
       try {
         for (addrData of addresses) {
@@ -284,6 +292,11 @@ window.app = Vue.createApp({
             // search only if it ever had any activity
             const utxos = await this.getAddressTxsUtxoDelayed(addrData.address)
             this.updateUtxosForAddress(addrData, utxos)
+            updatedAddresses.push(addrData)
+          }
+          if (updatedAddresses.length >= ADDRESS_UPDATE_BATCH_SIZE) {
+            await this.saveAddressAmounts(updatedAddresses)
+            updatedAddresses = []
           }
 
           this.scan.scanIndex++
@@ -296,6 +309,7 @@ window.app = Vue.createApp({
           timeout: 10000
         })
       } finally {
+        await this.saveAddressAmounts(updatedAddresses)
         this.scan.scanning = false
       }
     },
@@ -373,9 +387,42 @@ window.app = Vue.createApp({
 
     updateAccounts: async function (accounts) {
       this.walletAccounts = accounts
+      this.watchAccounts(accounts)
       await this.refreshAddresses()
       await this.scanAddressWithAmount()
     },
+    watchAccounts: function (accounts) {
+      Object.values(this.eventSources).forEach(source => source.close())
+      this.eventSources = {}
+      const inkey = this.g.user.wallets[0].inkey
+      accounts.forEach(account => {
+        const source = new EventSource(
+          `/watchonly/api/v1/events/${account.id}?api-key=${inkey}`
+        )
+        source.addEventListener('address', event =>
+          this.handleAddressEvent(JSON.parse(event.data))
+        )
+        this.eventSources[account.id] = source
+      })
+    },
+    handleAddressEvent: async function ({address}) {
+      const addressData = this.addresses.find(a => a.id === address.id)
+      if (!addressData) {
+        // the gap has been extended on the server
+        await this.refreshAddresses()
+        return
+      }
+      const received = address.amount - addressData.amount
+      addressData.hasActivity = address.has_activity
+      await this.updateUtxosForAddresses([addressData])
+      if (received > 0) {
+        this.$q.notify({
+          type: 'positive',
+          message: `Received ${received} sats on ${addressData.address}`,
+          timeout: 10000
+        })
+      }
+    },
     showAddressDetails: function (addressData) {
       this.openQrCodeDialog(addressData)
     },
@@ -417,6 +464,9 @@ window.app = Vue.createApp({
       this.connectedDeviceType = deviceType
     }
   },
+  unmounted: function () {
+    Object.values(this.eventSources).forEach(source => source.close())
+  },
   created: async function () {
     if (this.g.user.wallets.length) {
       await this.refreshAddresses()
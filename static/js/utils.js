@@ -18,6 +18,8 @@ const COMMAND_LOG = '/log'
 const COMMAND_CHECK_PAIRING = '/check-pairing'
 
 const DEFAULT_RECEIVE_GAP_LIMIT = 20
+// addresses per `PUT /watchonly/api/v1/addresses` request
+const ADDRESS_UPDATE_BATCH_SIZE = 100
 const PAIRING_CONTROL_TEXT = 'lnbits'
 
 const HWW_DEFAULT_CONFIG = Object.freeze({
@@ -0,0 +1,103 @@
+"""
+Benchmark harness. The `benchmark` fixture runs a function a few times and
+keeps the fastest run, the result is compared with `baseline.json`: a
+benchmark fails when it is `threshold` times slower than its baseline.
+
+    pytest --benchmark                   # run and compare with the baseline
+    pytest --benchmark --benchmark-save  # update the baseline
+
+The baseline depends on the machine, update it on the machine that runs the
+benchmarks. Results are kept per database type (SQLite or Postgres).
+"""
+
+import inspect
+import json
+import time
+from pathlib import Path
+
+import pytest
+
+from ...crud import db
+
+BASELINE_FILE = Path(__file__).parent / "baseline.json"
+# the fastest runs of unchanged code still vary by up to ~1.6x between runs
+DEFAULT_THRESHOLD = 2.0
+# fast benchmarks are repeated for at least this long (seconds), the fastest
+# of many runs is more stable
+MIN_DURATION = 0.5
+MAX_ROUNDS = 100
+
+# benchmark name -> fastest run (seconds)
+_results: dict[str, float] = {}
+
+
+def _load_baseline() -> dict:
+    if not BASELINE_FILE.is_file():
+        return {"threshold": DEFAULT_THRESHOLD, "benchmarks": {}}
+    return json.loads(BASELINE_FILE.read_text())
+
+
+class Benchmark:
+    def __init__(self, config: pytest.Config):
+        self.save = config.getoption("--benchmark-save")
+        self.baseline = _load_baseline()
+        self.threshold = config.getoption("--benchmark-threshold") or (
+            self.baseline.get("threshold", DEFAULT_THRESHOLD)
+        )
+
+    async def __call__(self, name: str, func, *args, rounds: int = 3):
+        """Run `func(*args)` (sync or async) at least `rounds` times, returns
+        its result"""
+        best = float("inf")
+        result = None
+        total = 0.0
+        runs = 0
+        while runs < rounds or (total < MIN_DURATION and runs < MAX_ROUNDS):
+            start = time.perf_counter()
+            result = func(*args)
+            if inspect.isawaitable(result):
+                result = await result
+            duration = time.perf_counter() - start
+            best = min(best, duration)
+            total += duration
+            runs += 1
+
+        name = f"{str(db.type).lower()}:{name}"
+        _results[name] = best
+        baseline = self.baseline["benchmarks"].get(name)
+        if baseline and not self.save:
+            threshold = baseline.get("threshold", self.threshold)
+            if best > baseline["seconds"] * threshold:
+                pytest.fail(
+                    f"{name} took {best * 1000:.1f}ms, baseline "
+                    f"{baseline['seconds'] * 1000:.1f}ms (threshold x{threshold})"
+                )
+        return result
+
+
+@pytest.fixture
+def benchmark(request) -> Benchmark:
+    return Benchmark(request.config)
+
+
+def pytest_sessionfinish(session):
+    if not _results or not session.config.getoption("--benchmark-save"):
+        return
+    baseline = _load_baseline()
+    for name, seconds in _results.items():
+        entry = baseline["benchmarks"].setdefault(name, {})
+        entry["seconds"] = round(seconds, 6)
+    baseline["benchmarks"] = dict(sorted(baseline["benchmarks"].items()))
+    BASELINE_FILE.write_text(json.dumps(baseline, indent=2) + "\n")
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _results:
+        return
+    baseline = _load_baseline()["benchmarks"]
+    terminalreporter.section("watchonly benchmarks")
+    for name, seconds in sorted(_results.items()):
+        line = f"{name:<55} {seconds * 1000:>10.2f}ms"
+        if name in baseline:
+            line += f"  x{seconds / baseline[name]['seconds']:.2f} of baseline"
+        terminalreporter.write_line(line)
@@ -0,0 +1,148 @@
+import random
+
+import pytest
+from embit import bip32, bip39
+from embit.psbt import PSBT
+
+from ...coinselect import Coin, select_coins
+from ...crud import create_fresh_addresses, delete_addresses_for_wallet
+from ...helpers import derive_address, parse_key
+from ..test_crud import _create_wallet
+from ..test_helpers import MULTISIG_DESCRIPTOR, TR_DESCRIPTOR, XPUB, YPUB, ZPUB
+from ..test_views_api import _funding_tx
+
+pytestmark = [pytest.mark.benchmark, pytest.mark.asyncio]
+
+DESCRIPTORS = {
+    "wpkh": ZPUB,
+    "sh-wpkh": YPUB,
+    "pkh": XPUB,
+    "tr": TR_DESCRIPTOR,
+    "wsh-sortedmulti": MULTISIG_DESCRIPTOR,
+}
+# the account key of ZPUB
+MNEMONIC = "abandon " * 11 + "about"
+
+
+@pytest.mark.parametrize("kind", DESCRIPTORS)
+async def test_parse_key(benchmark, kind):
+    # the cache would only measure the lookup
+    await benchmark(f"parse_key[{kind}]", parse_key.__wrapped__, DESCRIPTORS[kind])
+
+
+@pytest.mark.parametrize("kind", DESCRIPTORS)
+async def test_derive_address(benchmark, kind):
+    async def derive_100():
+        for i in range(100):
+            await derive_address(DESCRIPTORS[kind], i)
+
+    await benchmark(f"derive_address_x100[{kind}]", derive_100)
+
+
+@pytest.mark.parametrize("count", [1_000, 10_000])
+async def test_create_fresh_addresses(watchonly_db, benchmark, count):
+    wallet = await _create_wallet()
+
+    async def create():
+        await delete_addresses_for_wallet(wallet.id)
+        await create_fresh_addresses(wallet.id, 0, count)
+
+    rounds = 1 if count > 1_000 else 3
+    await benchmark(f"create_fresh_addresses[{count}]", create, rounds=rounds)
+
+
+async def test_get_addresses(watchonly_db, client, benchmark):
+    wallet = await _create_wallet()
+    await create_fresh_addresses(wallet.id, 0, 10_000)
+    url = f"/watchonly/api/v1/addresses/{wallet.id}"
+
+    r = await benchmark("api_get_addresses[10000]", client.get, url)
+    assert len(r.json()) >= 10_000
+    r = await benchmark("api_get_addresses[10000,page]", client.get, f"{url}?limit=100")
+    assert len(r.json()) == 100
+
+
+@pytest.mark.parametrize("count", [10, 100, 1000])
+async def test_psbt_create_and_extract(watchonly_db, client, benchmark, count):
+    wallet = await _create_wallet()
+    inputs = []
+    for i in range(count):
+        address = await derive_address(ZPUB, i)
+        funding_tx = _funding_tx(address, 10_000, nonce=i)
+        inputs.append(
+            {
+                "tx_id": funding_tx.txid().hex(),
+                "vout": 0,
+                "amount": 10_000,
+                "address": address,
+                "branch_index": 0,
+                "address_index": i,
+                "wallet": wallet.id,
+                "tx_hex": funding_tx.to_string(),
+            }
+        )
+    data = {
+        "masterpubs": [
+            {"id": wallet.id, "public_key": ZPUB, "fingerprint": "73c5da0a"}
+        ],
+        "inputs": inputs,
+        "outputs": [
+            {"amount": count * 9_000, "address": await derive_address(ZPUB, 0, 1)}
+        ],
+        "fee_rate": 1,
+        "tx_size": 0,
+    }
+
+    r = await benchmark(
+        f"api_psbt_create[{count}]", _post, client, "/watchonly/api/v1/psbt", data
+    )
+    assert r.status_code == 200, r.text
+
+    psbt = PSBT.from_string(r.json())
+    root = bip32.HDKey.from_seed(bip39.mnemonic_to_seed(MNEMONIC))
+    assert psbt.sign_with(root.derive("m/84h/0h/0h")) == count
+
+    r = await benchmark(
+        f"api_psbt_extract_tx[{count}]",
+        _put,
+        client,
+        "/watchonly/api/v1/psbt/extract",
+        {"psbt_base64": psbt.to_string(), "network": "Mainnet"},
+    )
+    assert r.status_code == 200, r.text
+
+
+async def test_select_coins(benchmark):
+    coins = [Coin(1_000 + (i * 7919) % 100_000, 272) for i in range(20_000)]
+    selection = await benchmark(
+        "select_coins[20000]", select_coins, coins, 5_000_000, 124, 124, 272, 2
+    )
+    assert selection
+
+
+@pytest.mark.parametrize("target", [10_000, 1_234_567, 25_000_000, 1_000_000_000])
+async def test_select_coins_random(benchmark, target):
+    rng = random.Random(21)
+    coins = [
+        Coin(rng.randint(1_000, 5_000_000), rng.choice([272, 364, 592, 230]))
+        for _ in range(20_000)
+    ]
+    selection = await benchmark(
+        f"select_coins_random[20000,{target}]",
+        select_coins,
+        coins,
+        target,
+        124,
+        124,
+        272,
+        12.5,
+    )
+    assert selection
+
+
+async def _post(client, url, data):
+    return await client.post(url, json=data)
+
+
+async def _put(client, url, data):
+    return await client.put(url, json=data)
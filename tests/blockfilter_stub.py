@@ -0,0 +1,83 @@
+import hashlib
+import json
+
+import httpx
+from embit import compact, script
+from embit.transaction import Transaction, TransactionInput, TransactionOutput
+
+from ..blockfilter import build_block_filter
+
+# output of the coinbases, not a wallet address
+MINER_SCRIPT = script.address_to_scriptpubkey("1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa")
+
+
+class BlockFilterStub:
+    """
+    Local stand-in for the REST interface of a Bitcoin Core node, serving
+    the blocks added with `add_block()` and their basic block filters.
+    """
+
+    def __init__(self):
+        # (block hash, raw block, filter) by height
+        self.blocks: list[tuple[str, bytes, bytes]] = []
+        # scripts of the outputs of the blocks, to find the spent scripts
+        self.outputs: dict[tuple[str, int], bytes] = {}
+        self.requests: list[str] = []
+        # makes the hashes of the blocks replaced by a reorg different
+        self.nonce = 0
+
+    def add_block(self, txs: list[Transaction]) -> str:
+        height = len(self.blocks)
+        coinbase = Transaction(
+            vin=[TransactionInput(b"\x00" * 32, 0xFFFFFFFF, script.Script(b"\x01"))],
+            vout=[TransactionOutput(height + 1, MINER_SCRIPT)],
+        )
+        txs = [coinbase, *txs]
+        self.nonce += 1
+        header = height.to_bytes(4, "little") + self.nonce.to_bytes(4, "little")
+        header += b"\x00" * 72
+        block_hash = hashlib.sha256(hashlib.sha256(header).digest()).digest()
+        block_hash_hex = block_hash[::-1].hex()
+
+        items = []
+        for tx in txs:
+            tx_id = tx.txid().hex()
+            for vout, out in enumerate(tx.vout):
+                self.outputs[(tx_id, vout)] = out.script_pubkey.data
+                if out.script_pubkey.data[:1] != b"\x6a":
+                    items.append(out.script_pubkey.data)
+            for inp in tx.vin:
+                spent = self.outputs.get((inp.txid.hex(), inp.vout))
+                if spent:
+                    items.append(spent)
+        raw_block = header + compact.to_bytes(len(txs))
+        raw_block += b"".join(tx.serialize() for tx in txs)
+        self.blocks.append(
+            (block_hash_hex, raw_block, build_block_filter(block_hash_hex, items))
+        )
+        return block_hash_hex
+
+    def reorg(self, height: int):
+        """Drop the blocks from `height`, replaced by the next ones added"""
+        del self.blocks[height:]
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request.url.path)
+        parts = request.url.path.strip("/").split("/")
+        name, _, extension = parts[-1].partition(".")
+        by_hash = {block_hash: (raw, f) for block_hash, raw, f in self.blocks}
+        if parts[1:] == ["chaininfo.json"]:
+            return httpx.Response(
+                200, text=json.dumps({"blocks": len(self.blocks) - 1})
+            )
+        if parts[1] == "blockhashbyheight" and int(name) < len(self.blocks):
+            return httpx.Response(200, text=self.blocks[int(name)][0] + "\n")
+        if parts[1] == "blockfilter" and name in by_hash:
+            return httpx.Response(200, text=by_hash[name][1].hex())
+        if parts[1] == "block" and name in by_hash and extension == "bin":
+            return httpx.Response(200, content=by_hash[name][0])
+        return httpx.Response(404)
@@ -0,0 +1,81 @@
+import asyncio
+import inspect
+import os
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+from lnbits.db import SQLITE
+from lnbits.decorators import check_admin, require_admin_key, require_invoice_key
+
+from .. import migrations, watchonly_ext
+from ..crud import clear_address_index, clear_config_cache, db
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("watchonly benchmarks")
+    group.addoption(
+        "--benchmark", action="store_true", help="run the benchmarks (tests/benchmark)"
+    )
+    group.addoption(
+        "--benchmark-save",
+        action="store_true",
+        help="write the benchmark results to the baseline file",
+    )
+    group.addoption(
+        "--benchmark-threshold",
+        type=float,
+        default=None,
+        help="allowed slowdown compared to the baseline, the threshold of the "
+        "baseline file by default (2.0 = twice as slow)",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmarks only run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest_asyncio.fixture
+async def watchonly_db():
+    """
+    Fresh database with all the extension migrations applied.
+    SQLite by default, Postgres when `LNBITS_DATABASE_URL` is set.
+    """
+    if db.type == SQLITE:
+        if os.path.isfile(db.path):
+            os.remove(db.path)
+    else:
+        await db.execute("DROP SCHEMA IF EXISTS watchonly CASCADE")
+        await db.execute("CREATE SCHEMA watchonly")
+    # every test has its own event loop, the lock binds to the first one
+    db.lock = asyncio.Lock()
+    for name, migration in inspect.getmembers(migrations, inspect.isfunction):
+        if name.startswith("m"):
+            await migration(db)
+    clear_config_cache()
+    clear_address_index()
+    yield db
+    await db.engine.dispose()
+
+
+def _key_info():
+    return SimpleNamespace(wallet=SimpleNamespace(user="user_1"))
+
+
+@pytest.fixture
+def client():
+    """API client authenticated as `user_1` with an admin key, `user_1` is also
+    an LNbits admin."""
+    app = FastAPI()
+    app.include_router(watchonly_ext)
+    app.dependency_overrides[require_invoice_key] = _key_info
+    app.dependency_overrides[require_admin_key] = _key_info
+    app.dependency_overrides[check_admin] = lambda: SimpleNamespace(id="user_1")
+    return AsyncClient(transport=ASGITransport(app=app), base_url="http://test")
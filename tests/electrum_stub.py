@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import json
+from typing import Optional
+
+from embit.transaction import Transaction
+
+from ..helpers import address_scripthash, script_scripthash
+
+BLOCK_HEIGHT = 800_000
+
+
+class ElectrumStub:
+    """
+    Local Electrum server (JSON-RPC over TCP).
+    Serves the history and the unspent outputs of the `funded` addresses (one
+    unconfirmed transaction each) and the confirmed `transactions`, plus the
+    extra entries of `histories` (by scripthash).
+    """
+
+    def __init__(
+        self,
+        funded: Optional[dict[str, int]] = None,
+        transactions: Optional[dict[str, str]] = None,
+        latency=0.0,
+    ):
+        self.funded = funded or {}
+        self.transactions = transactions or {}
+        self.histories: dict[str, list[dict]] = {}
+        self.latency = latency
+        self.height = BLOCK_HEIGHT
+        self.connections = 0
+        self.requests: list[str] = []
+        self.subscribed: set[str] = set()
+        self.broadcasted: list[str] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: set[asyncio.StreamWriter] = set()
+
+    async def start(self) -> str:
+        """Start listening, returns the server url"""
+        self._server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"tcp://127.0.0.1:{port}"
+
+    async def stop(self):
+        for writer in self._writers:
+            writer.close()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                # requests are answered concurrently, like a real server
+                task = asyncio.create_task(self._answer(writer, json.loads(line)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _answer(self, writer: asyncio.StreamWriter, request: dict):
+        self.requests.append(request["method"])
+        await asyncio.sleep(self.latency)
+        response: dict = {"jsonrpc": "2.0", "id": request["id"]}
+        try:
+            response["result"] = self._result(request["method"], request["params"])
+        except KeyError as exc:
+            response["error"] = {"code": 2, "message": f"unknown {exc!s}"}
+        self._send(writer, response)
+
+    def _send(self, writer: asyncio.StreamWriter, message: dict):
+        if not writer.is_closing():
+            writer.write(json.dumps(message).encode() + b"\n")
+
+    def _result(self, method: str, params: list):
+        if method == "server.version":
+            return ["ElectrumStub", "1.4"]
+        if method == "blockchain.headers.subscribe":
+            return {"height": self.height, "hex": "00" * 80}
+        if method == "blockchain.scripthash.get_history":
+            return self.histories.get(params[0], []) + [
+                {"tx_hash": tx_hash, "height": height}
+                for tx_hash, _, height in self._outputs(params[0])
+            ]
+        if method == "blockchain.scripthash.listunspent":
+            return [
+                {"tx_hash": tx_hash, "tx_pos": 0, "height": height, "value": value}
+                for tx_hash, value, height in self._outputs(params[0])
+            ]
+        if method == "blockchain.scripthash.subscribe":
+            self.subscribed.add(params[0])
+            return self.status(params[0])
+        if method == "blockchain.transaction.get":
+            return self.transactions[params[0]]
+        if method == "blockchain.transaction.broadcast":
+            self.broadcasted.append(params[0])
+            return Transaction.from_string(params[0]).txid().hex()
+        raise KeyError(method)
+
+    def _outputs(self, scripthash: str) -> list[tuple[str, int, int]]:
+        """(tx id, value, height) of the outputs paying to the scripthash"""
+        outputs = []
+        for address, amount in self.funded.items():
+            if address_scripthash(address) == scripthash:
+                tx_hash = hashlib.sha256(address.encode()).hexdigest()
+                outputs.append((tx_hash, amount, 0))
+        for tx_id, tx_hex in self.transactions.items():
+            out = Transaction.from_string(tx_hex).vout[0]
+            if script_scripthash(out.script_pubkey.data) == scripthash:
+                outputs.append((tx_id, out.value, self.height))
+        return outputs
+
+    def status(self, scripthash: str) -> Optional[str]:
+        outputs = self._outputs(scripthash)
+        if not outputs:
+            return None
+        history = "".join(f"{tx_hash}:{height}:" for tx_hash, _, height in outputs)
+        return hashlib.sha256(history.encode()).hexdigest()
+
+    def notify_address(self, address: str):
+        scripthash = address_scripthash(address)
+        self._notify(
+            "blockchain.scripthash.subscribe", [scripthash, self.status(scripthash)]
+        )
+
+    def new_block(self):
+        self.height += 1
+        self._notify(
+            "blockchain.headers.subscribe", [{"height": self.height, "hex": "00" * 80}]
+        )
+
+    def _notify(self, method: str, params: list):
+        for writer in self._writers:
+            self._send(writer, {"jsonrpc": "2.0", "method": method, "params": params})
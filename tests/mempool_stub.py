@@ -0,0 +1,109 @@
+import asyncio
+import json
+from typing import Optional
+
+import httpx
+
+
+class MempoolStub:
+    """
+    Local stand-in for the mempool.space REST API.
+    Serves address stats and utxos for the given `funded` addresses.
+    """
+
+    def __init__(
+        self,
+        funded: Optional[dict[str, int]] = None,
+        transactions: Optional[dict[str, str]] = None,
+        latency=0.0,
+    ):
+        self.funded = funded or {}
+        # raw transactions by id, they are reported as confirmed
+        self.transactions = transactions or {}
+        self.latency = latency
+        self.requests: list[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fail_next = 0
+        self.broadcasted: list[str] = []
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request.url.path)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            if self.fail_next:
+                self.fail_next -= 1
+                return httpx.Response(429, text="Too Many Requests")
+            return self._route(request)
+        finally:
+            self.in_flight -= 1
+
+    def _route(self, request: httpx.Request) -> httpx.Response:
+        parts = request.url.path.strip("/").split("/")
+        if parts[0] == "testnet":
+            parts = parts[1:]
+        if parts == ["api", "tx"] and request.method == "POST":
+            tx_hex = request.content.decode()
+            if tx_hex in self.broadcasted:
+                error = {"code": -26, "message": "txn-already-in-mempool"}
+                return httpx.Response(
+                    400, text=f"sendrawtransaction RPC error: {json.dumps(error)}"
+                )
+            self.broadcasted.append(tx_hex)
+            return httpx.Response(200, text=tx_hex[:64])
+        if parts[:2] == ["api", "tx"] and parts[2] in self.transactions:
+            if parts[3:] == ["hex"]:
+                return httpx.Response(200, text=self.transactions[parts[2]])
+            if parts[3:] == ["status"]:
+                status = {"confirmed": True, "block_height": 800000}
+                return httpx.Response(200, text=json.dumps(status))
+        # api/address/{address}[/utxo]
+        if parts[:2] != ["api", "address"]:
+            return httpx.Response(404)
+        address = parts[2]
+        amount = self.funded.get(address, 0)
+        if parts[3:] == ["utxo"]:
+            utxos = [_utxo(address, amount)] if amount else []
+            return httpx.Response(200, text=json.dumps(utxos))
+        return httpx.Response(200, text=json.dumps(_stats(address, amount)))
+
+
+def _stats(address: str, amount: int) -> dict:
+    tx_count = 1 if amount else 0
+    return {
+        "address": address,
+        "chain_stats": {
+            "funded_txo_count": tx_count,
+            "funded_txo_sum": amount,
+            "spent_txo_count": 0,
+            "spent_txo_sum": 0,
+            "tx_count": tx_count,
+        },
+        "mempool_stats": {
+            "funded_txo_count": 0,
+            "funded_txo_sum": 0,
+            "spent_txo_count": 0,
+            "spent_txo_sum": 0,
+            "tx_count": 0,
+        },
+    }
+
+
+def _utxo(address: str, amount: int) -> dict:
+    return {
+        "txid": address.encode().hex()[:64].ljust(64, "0"),
+        "vout": 0,
+        "value": amount,
+        "status": {
+            "confirmed": True,
+            "block_height": 800000,
+            "block_hash": "00" * 32,
+            "block_time": 1700000000,
+        },
+    }
@@ -0,0 +1,128 @@
+import random
+
+import pytest
+
+from ..coinselect import Coin, branch_and_bound, fee_for, select_coins
+from ..crud import create_gap_addresses, get_addresses, update_address_utxos
+from ..helpers import input_weight, output_weight
+from ..models import WalletUtxo
+from .test_crud import _create_wallet
+from .test_helpers import XPUB, YPUB, ZPUB
+
+P2WPKH_INPUT = 272
+P2WPKH_OUTPUT = 124
+
+
+def test_input_and_output_weights():
+    assert input_weight(ZPUB) == 4 * 68
+    assert input_weight(YPUB) == 4 * 91
+    assert input_weight(XPUB) == 4 * 148
+    assert output_weight("bc1qcr8te4kr609gcawutmrza0j4xv80jy8z306fyu") == 4 * 31
+
+
+def test_branch_and_bound_finds_exact_match():
+    assert branch_and_bound([10, 7, 5, 3], 12, 0) == [1, 2]
+    assert branch_and_bound([10, 7, 5, 3], 11, 1) == [1, 2]
+    assert branch_and_bound([10, 7, 5, 3], 26, 0) is None
+    assert branch_and_bound([10, 10, 10], 21, 0) is None
+
+
+def test_select_coins_without_change():
+    fee_rate = 4
+    coins = [Coin(amount, P2WPKH_INPUT) for amount in (50_000, 30_000, 20_000)]
+    # exactly two inputs, the outputs and the overhead
+    weight = 2 * P2WPKH_INPUT + P2WPKH_OUTPUT + 42
+    target = 50_000 - fee_for(weight, fee_rate)
+
+    selection = select_coins(coins, target, P2WPKH_OUTPUT, 124, 272, fee_rate)
+
+    assert selection
+    assert selection.algorithm == "bnb"
+    assert sorted(selection.coins) == [1, 2]
+    assert selection.change == 0
+    assert selection.fee == 50_000 - target
+
+
+def test_select_coins_with_change():
+    coins = [Coin(amount, P2WPKH_INPUT) for amount in (100_000, 1_000, 30_000)]
+
+    selection = select_coins(coins, 40_000, P2WPKH_OUTPUT, 124, 272, 5)
+
+    assert selection
+    assert selection.algorithm == "largest_first"
+    assert selection.coins == [0]
+    assert selection.change > 0
+    assert selection.fee == fee_for(selection.weight, 5)
+    assert selection.fee + selection.change + 40_000 == 100_000
+
+
+def test_select_coins_insufficient_funds():
+    coins = [Coin(1_000, P2WPKH_INPUT), Coin(100, P2WPKH_INPUT)]
+    assert select_coins(coins, 1_000, P2WPKH_OUTPUT, 124, 272, 1) is None
+
+
+def test_select_coins_random_utxos():
+    rng = random.Random(21)
+    coins = [
+        Coin(rng.randint(1_000, 5_000_000), rng.choice([272, 364, 592, 230]))
+        for _ in range(2_000)
+    ]
+    for target in (10_000, 1_234_567, 25_000_000, 1_000_000_000):
+        selection = select_coins(coins, target, P2WPKH_OUTPUT, 124, 272, 12.5)
+        assert selection
+        paid = sum(coins[i].amount for i in selection.coins)
+        assert paid == target + selection.fee + selection.change
+        assert selection.fee >= fee_for(selection.weight, 12.5)
+
+
+@pytest.mark.asyncio
+async def test_api_coin_select(watchonly_db, client):
+    wallet = await _create_wallet()
+    await create_gap_addresses(wallet.id, 20, 5)
+    addresses = await get_addresses(wallet.id)
+    utxos = [
+        WalletUtxo(
+            address_id=addresses[i].id,
+            wallet=wallet.id,
+            tx_id=f"{i:064x}",
+            vout=0,
+            amount=amount,
+            confirmed=True,
+        )
+        for i, amount in enumerate([60_000, 25_000, 15_000])
+    ]
+    await update_address_utxos([a.id for a in addresses], utxos)
+    destination = "bc1qcr8te4kr609gcawutmrza0j4xv80jy8z306fyu"
+
+    r = await client.post(
+        "/watchonly/api/v1/coinselect",
+        json={
+            "wallets": [wallet.id],
+            # no combination of the UTXOs is close enough to skip the change
+            "outputs": [{"amount": 50_000, "address": destination}],
+            "fee_rate": 3,
+        },
+    )
+    assert r.status_code == 200, r.text
+    data = r.json()
+    assert {inp["tx_id"] for inp in data["inputs"]} <= {u.tx_id for u in utxos}
+    assert all(inp["wallet"] == wallet.id for inp in data["inputs"])
+    total_in = sum(inp["amount"] for inp in data["inputs"])
+    total_out = sum(out["amount"] for out in data["outputs"])
+    assert total_in - total_out == data["fee"]
+    assert data["change"] > 0
+    change = data["outputs"][-1]
+    assert change["amount"] == data["change"]
+    assert change["branch_index"] == 1
+    assert change["wallet"] == wallet.id
+
+    r = await client.post(
+        "/watchonly/api/v1/coinselect",
+        json={
+            "wallets": [wallet.id],
+            "outputs": [{"amount": 100_000, "address": destination}],
+            "fee_rate": 3,
+        },
+    )
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Insufficient funds."
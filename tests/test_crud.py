@@ -0,0 +1,296 @@
+import asyncio
+
+import pytest
+from embit import script
+from embit.transaction import Transaction, TransactionInput, TransactionOutput
+
+from .. import crud, metrics, migrations
+from ..crud import (
+    clear_config_cache,
+    create_config,
+    create_fresh_addresses,
+    create_gap_addresses,
+    create_watch_wallet,
+    delete_addresses_for_wallet,
+    get_address_index,
+    get_addresses,
+    get_addresses_by_scripthashes,
+    get_branch_indexes,
+    get_config,
+    get_fresh_address,
+    get_watch_wallet,
+    reload_address_index,
+    update_address,
+    update_addresses,
+    update_config,
+    update_watch_wallet,
+)
+from ..helpers import address_scripthash
+from ..models import Config, WalletAccount
+from .test_helpers import ZPUB
+
+# not an address of the test wallet
+OTHER_ADDRESS = "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa"
+
+
+async def _create_wallet() -> WalletAccount:
+    return await create_watch_wallet(
+        WalletAccount(
+            id="wallet_1",
+            user="user_1",
+            masterpub=ZPUB,
+            fingerprint="73c5da0a",
+            title="test",
+            address_no=-1,
+            balance=0,
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_create_fresh_addresses(watchonly_db):
+    wallet = await _create_wallet()
+
+    addresses = await create_fresh_addresses(wallet.id, 0, 1200)
+    change = await create_fresh_addresses(wallet.id, 0, 5, change_address=True)
+
+    assert [a.address_index for a in addresses] == list(range(1200))
+    assert addresses[0].address == "bc1qcr8te4kr609gcawutmrza0j4xv80jy8z306fyu"
+    assert all(a.branch_index == 1 for a in change)
+
+    stored = await get_addresses(wallet.id)
+    assert len(stored) == 1205
+    assert [a.dict() for a in stored[:1200]] == [a.dict() for a in addresses]
+
+
+@pytest.mark.asyncio
+async def test_address_scripts(watchonly_db):
+    wallet = await _create_wallet()
+    addresses = await create_fresh_addresses(wallet.id, 0, 3)
+
+    for address in addresses:
+        assert address.script_pubkey == (
+            script.address_to_scriptpubkey(address.address).data.hex()
+        )
+        assert address.scripthash == address_scripthash(address.address)
+    found = await get_addresses_by_scripthashes(
+        [addresses[1].scripthash, address_scripthash(OTHER_ADDRESS)]
+    )
+    assert [a.id for a in found] == [addresses[1].id]
+
+    # rows created before the columns existed
+    await watchonly_db.execute(
+        "UPDATE watchonly.addresses SET script_pubkey = NULL, scripthash = NULL"
+    )
+    await migrations._backfill_address_scripts(watchonly_db)
+    assert [a.dict() for a in await get_addresses(wallet.id)] == [
+        a.dict() for a in addresses
+    ]
+
+
+@pytest.mark.asyncio
+async def test_address_index(watchonly_db):
+    wallet = await _create_wallet()
+    stored = await create_fresh_addresses(wallet.id, 0, 3)
+
+    index = await get_address_index()
+    assert len(index) == 3
+    assert index.get_address(stored[2].address) == ((wallet.id, 0, 2),)
+    assert index.get_address(OTHER_ADDRESS) == ()
+    assert index.get_address("not an address") == ()
+
+    # kept up to date without reloading
+    [change] = await create_fresh_addresses(wallet.id, 0, 1, change_address=True)
+    tx = Transaction(
+        vin=[TransactionInput(b"\x00" * 32, 0)],
+        vout=[
+            TransactionOutput(1000, script.address_to_scriptpubkey(OTHER_ADDRESS)),
+            TransactionOutput(2000, script.address_to_scriptpubkey(change.address)),
+        ],
+    )
+    assert index.match_outputs(tx) == [(1, (wallet.id, 1, 0))]
+
+    # the same masterpub imported by another user
+    shared = await create_watch_wallet(
+        WalletAccount(
+            id="wallet_3",
+            user="user_3",
+            masterpub=ZPUB,
+            fingerprint="",
+            title="",
+            address_no=-1,
+            balance=0,
+        )
+    )
+    await create_fresh_addresses(shared.id, 0, 3)
+    assert len(index) == 7
+    assert set(index.get_address(stored[2].address)) == {
+        (wallet.id, 0, 2),
+        (shared.id, 0, 2),
+    }
+    assert len(index.scripts({shared.id})) == 3
+
+    await delete_addresses_for_wallet(wallet.id)
+    assert len(index) == 3
+    assert index.get_address(stored[2].address) == ((shared.id, 0, 2),)
+    assert index.match_outputs(tx) == []
+    await delete_addresses_for_wallet(shared.id)
+    assert len(index) == 0
+
+    # addresses created by another process
+    await watchonly_db.execute(
+        "INSERT INTO watchonly.addresses "
+        "(id, address, wallet, address_index, amount, script_pubkey) "
+        "VALUES ('1', :address, 'wallet_2', 7, 0, :script_pubkey)",
+        {
+            "address": OTHER_ADDRESS,
+            "script_pubkey": script.address_to_scriptpubkey(OTHER_ADDRESS).data.hex(),
+        },
+    )
+    await reload_address_index()
+    assert index.get_address(OTHER_ADDRESS) == (("wallet_2", 0, 7),)
+
+
+@pytest.mark.asyncio
+async def test_get_fresh_address_concurrently(watchonly_db):
+    wallet = await _create_wallet()
+    await create_fresh_addresses(wallet.id, 0, 1000)
+
+    addresses = await asyncio.gather(
+        *[get_fresh_address(wallet.id) for _ in range(1000)]
+    )
+
+    assert len({a.address for a in addresses if a}) == 1000
+    assert sorted(a.address_index for a in addresses if a) == list(range(1000))
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.address_no == 999
+
+    # not derived yet, and after the last address with activity
+    more = await asyncio.gather(*[get_fresh_address(wallet.id) for _ in range(20)])
+    assert sorted(a.address_index for a in more if a) == list(range(1000, 1020))
+    [last] = await create_fresh_addresses(wallet.id, 1100, 1101)
+    last.has_activity = True
+    await update_address(last)
+    fresh = await get_fresh_address(wallet.id)
+    assert fresh and fresh.address_index == 1101
+    assert await get_fresh_address("missing") is None
+
+
+@pytest.mark.asyncio
+async def test_create_fresh_addresses_empty_range(watchonly_db):
+    wallet = await _create_wallet()
+    assert await create_fresh_addresses(wallet.id, 3, 3) == []
+    assert await create_fresh_addresses(wallet.id, 5, 3) == []
+    assert await create_fresh_addresses("missing", 0, 3) == []
+    assert await get_addresses(wallet.id) == []
+
+
+@pytest.mark.asyncio
+async def test_create_fresh_addresses_is_idempotent(watchonly_db):
+    wallet = await _create_wallet()
+    first = await create_fresh_addresses(wallet.id, 0, 10)
+    # overlapping range, only indexes 10..14 are new
+    second = await create_fresh_addresses(wallet.id, 5, 15)
+
+    assert [a.address_index for a in second] == list(range(5, 15))
+    assert [a.id for a in second[:5]] == [a.id for a in first[5:]]
+    assert len(await get_addresses(wallet.id)) == 15
+
+
+@pytest.mark.asyncio
+async def test_create_gap_addresses(watchonly_db):
+    wallet = await _create_wallet()
+
+    created = await create_gap_addresses(wallet.id, 20, 5)
+    assert len(created) == 25
+    assert await get_branch_indexes(wallet.id) == {0: (19, -1), 1: (4, -1)}
+    # nothing to do while there is no new activity
+    assert await create_gap_addresses(wallet.id, 20, 5) == []
+
+    address = created[12]
+    address.has_activity = True
+    await update_address(address)
+
+    created = await create_gap_addresses(wallet.id, 20, 5)
+    assert [a.address_index for a in created] == list(range(20, 33))
+    assert await get_branch_indexes(wallet.id) == {0: (32, 12), 1: (4, -1)}
+
+
+@pytest.mark.asyncio
+async def test_get_config_is_cached(watchonly_db, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+
+    def misses() -> float:
+        return metrics.CONFIG_CACHE.values.get(("miss",), 0)
+
+    config = await get_config("user_1")
+    assert config == Config()
+    missed = misses()
+
+    config.receive_gap_limit = 100  # callers get a copy
+    assert (await get_config("user_1")).receive_gap_limit == 20
+    assert misses() == missed
+
+    await update_config(Config(receive_gap_limit=30), "user_1")
+    assert (await get_config("user_1")).receive_gap_limit == 30
+    assert misses() == missed + 1
+
+    # changes made by another process are seen once the entry expires
+    await watchonly_db.execute(
+        """UPDATE watchonly.config SET json_data = :json_data""",
+        {"json_data": Config(receive_gap_limit=40).json()},
+    )
+    assert (await get_config("user_1")).receive_gap_limit == 30
+    monkeypatch.setattr(crud, "CONFIG_CACHE_TTL", 0)
+    clear_config_cache()
+    await get_config("user_1")
+    assert (await get_config("user_1")).receive_gap_limit == 40
+
+
+@pytest.mark.asyncio
+async def test_config_cache_evicts_oldest(watchonly_db, monkeypatch):
+    monkeypatch.setattr(crud, "CONFIG_CACHE_SIZE", 2)
+    monkeypatch.setattr(crud, "CONFIG_CACHE_TTL", 0)
+    await get_config("user_1")
+    await get_config("user_2")
+    # expired, fetched again and now the newest entry
+    await get_config("user_1")
+    await get_config("user_3")
+    assert list(crud._config_cache) == ["user_1", "user_3"]
+
+
+@pytest.mark.asyncio
+async def test_create_config_once(watchonly_db):
+    await asyncio.gather(*[create_config("user_1") for _ in range(10)])
+    rows = await watchonly_db.fetchall("SELECT * FROM watchonly.config")
+    assert len(rows) == 1
+
+
+@pytest.mark.asyncio
+async def test_update_address_updates_balances(watchonly_db):
+    wallet = await _create_wallet()
+    await create_gap_addresses(wallet.id, 3, 2)
+    addresses = await get_addresses(wallet.id)
+    receive, change = addresses[0], addresses[-1]
+
+    receive.amount = 1_000
+    change.amount = 300
+    await update_addresses([receive, change])
+    receive.amount = 800
+    await update_address(receive)
+
+    wallet = await get_watch_wallet(wallet.id)
+    assert wallet
+    assert (wallet.balance, wallet.receive_balance, wallet.change_balance) == (
+        1_100,
+        800,
+        300,
+    )
+
+    # updating the wallet does not overwrite the balances
+    wallet.balance = 0
+    wallet.title = "renamed"
+    await update_watch_wallet(wallet)
+    wallet = await get_watch_wallet(wallet.id)
+    assert wallet
+    assert (wallet.title, wallet.balance) == ("renamed", 1_100)
@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+import pytest
+import pytest_asyncio
+
+from ..backends import ElectrumBackend, chain_backend
+from ..crud import get_address, get_addresses, get_transactions, get_watch_wallet
+from ..electrum import ElectrumClient, ElectrumError, close_electrum_clients
+from ..helpers import address_scripthash, derive_address
+from ..models import Config
+from ..scanner import ScanJob, scan_wallet
+from ..services import get_transactions_hex
+from ..watcher import subscribe, unsubscribe, watchers
+from .electrum_stub import BLOCK_HEIGHT, ElectrumStub
+from .test_crud import _create_wallet
+from .test_helpers import ZPUB
+from .test_views_api import _funding_tx
+from .test_watcher import _next_event
+
+
+@pytest_asyncio.fixture
+async def electrum():
+    stub = ElectrumStub()
+    url = await stub.start()
+    yield stub, url
+    await close_electrum_clients()
+    await stub.stop()
+
+
+@pytest.mark.asyncio
+async def test_batch_is_pipelined(electrum):
+    stub, url = electrum
+    stub.latency = 0.05
+    client = ElectrumClient(url)
+    scripthashes = [
+        address_scripthash(await derive_address(ZPUB, i)) for i in range(200)
+    ]
+
+    start = time.perf_counter()
+    results = await client.batch(
+        [("blockchain.scripthash.get_history", [h]) for h in scripthashes]
+    )
+    # 10s if the requests were sent one after the other
+    assert time.perf_counter() - start < 1
+    assert results == [[]] * 200
+    assert stub.connections == 1
+
+    with pytest.raises(ElectrumError):
+        await client.request("blockchain.transaction.get", "00" * 32)
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_large_response(electrum):
+    stub, url = electrum
+    scripthash = address_scripthash(await derive_address(ZPUB, 0))
+    history = [
+        {"tx_hash": f"{i:064x}", "height": BLOCK_HEIGHT - i} for i in range(1000)
+    ]
+    stub.histories[scripthash] = history
+    client = ElectrumClient(url)
+
+    # about 90 KiB on a single line
+    assert await client.request("blockchain.scripthash.get_history", scripthash) == (
+        history
+    )
+    assert stub.connections == 1
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_scan_wallet_with_electrum(watchonly_db, electrum):
+    stub, url = electrum
+    wallet = await _create_wallet()
+    funded_receive = await derive_address(ZPUB, 15, 0)
+    # only found after the receive branch has been extended
+    funded_receive_gap = await derive_address(ZPUB, 30, 0)
+    funded_change = await derive_address(ZPUB, 3, 1)
+    stub.funded.update(
+        {funded_receive: 1000, funded_receive_gap: 2000, funded_change: 500}
+    )
+    config = Config(chain_backend="electrum", electrum_server=url)
+    backend = chain_backend(config, "Mainnet")
+    assert isinstance(backend, ElectrumBackend)
+    job = ScanJob(wallet)
+
+    await scan_wallet(job, wallet, config, backend)
+
+    addresses = await get_addresses(wallet.id)
+    assert [a.address_index for a in addresses if a.branch_index == 0][-1] == 50
+    assert job.progress.active == 3
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.balance == 3500
+    # one connection, a few round trips
+    assert stub.connections == 1
+
+
+@pytest.mark.asyncio
+async def test_get_transactions_with_electrum(watchonly_db, electrum):
+    stub, url = electrum
+    funding_tx = _funding_tx(await derive_address(ZPUB, 0), 10_000)
+    tx_id = funding_tx.txid().hex()
+    stub.transactions[tx_id] = funding_tx.to_string()
+    backend = chain_backend(
+        Config(chain_backend="electrum", electrum_server=url), "Mainnet"
+    )
+
+    txs = await get_transactions_hex(backend, [tx_id])
+
+    assert txs == {tx_id: funding_tx.to_string()}
+    [cached] = await get_transactions([tx_id])
+    assert cached.block_height == BLOCK_HEIGHT
+    assert await backend.broadcast(funding_tx.to_string()) == tx_id
+
+
+def test_chain_backend_requires_electrum_server():
+    with pytest.raises(ValueError):
+        chain_backend(Config(chain_backend="electrum"), "Testnet")
+
+
+@pytest.mark.asyncio
+async def test_watch_with_electrum(watchonly_db, electrum):
+    stub, url = electrum
+    wallet = await _create_wallet()
+    address = await derive_address(ZPUB, 2)
+    config = Config(chain_backend="electrum", electrum_server=url)
+    queue = subscribe(wallet, config)
+    try:
+        for _ in range(100):
+            if address_scripthash(address) in stub.subscribed:
+                break
+            await asyncio.sleep(0.05)
+        assert watchers[wallet.id].mode == "electrum"
+
+        stub.funded[address] = 21_000
+        stub.notify_address(address)
+        event = await _next_event(queue, "address")
+        assert event["address"]["address"] == address
+        assert event["address"]["amount"] == 21_000
+        assert event["utxos"][0]["confirmed"] is False
+
+        stub.new_block()
+        assert (await _next_event(queue, "block"))["height"] == BLOCK_HEIGHT + 1
+    finally:
+        unsubscribe(wallet.id, queue)
+
+    stored = await get_address(address)
+    assert stored and stored.amount == 21_000
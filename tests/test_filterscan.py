@@ -0,0 +1,197 @@
+import os
+
+import pytest
+from embit import script
+from embit.transaction import Transaction, TransactionInput, TransactionOutput
+
+from .. import filterscan
+from ..blockfilter import BlockFilter, build_block_filter, siphash
+from ..crud import (
+    create_gap_addresses,
+    create_watch_wallet,
+    get_utxos,
+    get_wallet_sync_checkpoints,
+    get_watch_wallet,
+)
+from ..filterscan import start_filter_scan
+from ..helpers import derive_address
+from ..models import WalletAccount
+from .blockfilter_stub import BlockFilterStub
+from .test_crud import OTHER_ADDRESS, _create_wallet
+from .test_helpers import ZPUB
+
+
+def test_block_filter():
+    # SipHash-2-4 reference vector, empty message
+    k0 = int.from_bytes(bytes(range(8)), "little")
+    k1 = int.from_bytes(bytes(range(8, 16)), "little")
+    assert siphash(k0, k1, b"") == 0x726FDB47DD0E0E31
+
+    # BIP158 test vector: testnet genesis block
+    block_hash = "000000000933ea01ad0ee984209779baaec3ced90fa3f408719526f8d77f4943"
+    genesis_script = bytes.fromhex(
+        "4104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6"
+        "bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac"
+    )
+    assert build_block_filter(block_hash, [genesis_script]).hex() == "019dfca8"
+
+    items = [os.urandom(22) for _ in range(1000)]
+    block_filter = BlockFilter(block_hash, build_block_filter(block_hash, items))
+    assert block_filter.n == 1000
+    assert all(block_filter.match_any([item]) for item in items)
+    assert not block_filter.match_any([os.urandom(22) for _ in range(100)])
+
+
+def _payment(address: str, amount: int, nonce: int) -> Transaction:
+    vin = [TransactionInput(nonce.to_bytes(32, "big"), 0)]
+    vout = [TransactionOutput(amount, script.address_to_scriptpubkey(address))]
+    return Transaction(vin=vin, vout=vout)
+
+
+@pytest.mark.asyncio
+async def test_filter_scan(watchonly_db, monkeypatch):
+    wallet = await _create_wallet()
+    await create_gap_addresses(wallet.id, 20, 5)
+    stub = BlockFilterStub()
+    monkeypatch.setitem(filterscan.BLOCK_FILTER_URLS, "Mainnet", "http://node")
+
+    for _ in range(3):
+        stub.add_block([_payment(OTHER_ADDRESS, 1000, 1)])
+    first = _payment(await derive_address(ZPUB, 0), 10_000, 2)
+    stub.add_block([first])  # 3
+    stub.add_block([])
+    # the last address of the gap, the wallet is extended
+    stub.add_block([_payment(await derive_address(ZPUB, 19), 2000, 3)])  # 5
+    # only known after the extension, in the same window of blocks
+    stub.add_block([_payment(await derive_address(ZPUB, 30), 3000, 4)])  # 6
+    spend = Transaction(
+        vin=[TransactionInput(first.txid(), 0)],
+        vout=[TransactionOutput(9000, script.address_to_scriptpubkey(OTHER_ADDRESS))],
+    )
+    stub.add_block([spend])  # 7
+    stub.add_block([])
+
+    job = start_filter_scan("Mainnet", 0, http_client=stub.http_client)
+    assert job.task
+    await job.task
+
+    assert job.progress.status == "done", job.progress.error
+    assert job.progress.height == job.progress.tip_height == 8
+    assert job.progress.matched_blocks == 4
+    # only the matching blocks are downloaded
+    assert len([r for r in stub.requests if r.startswith("/rest/block/")]) == 4
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.balance == 5000
+    utxos = await get_utxos(wallet.id)
+    assert sorted((u.amount, u.block_height) for u in utxos) == [(2000, 5), (3000, 6)]
+    [checkpoint] = await get_wallet_sync_checkpoints([wallet.id])
+    assert (checkpoint.height, checkpoint.block_hash) == (8, stub.blocks[8][0])
+
+    # the next scan starts after the checkpoint, the wallet never scanned is
+    # skipped without a start height
+    other_wallet = await create_watch_wallet(
+        WalletAccount(
+            id="wallet_2",
+            user="user_2",
+            masterpub=ZPUB,
+            fingerprint="",
+            title="",
+            address_no=-1,
+            balance=0,
+        )
+    )
+    stub.add_block([_payment(await derive_address(ZPUB, 1), 500, 5)])
+    job = start_filter_scan("Mainnet", http_client=stub.http_client)
+    assert job.task
+    await job.task
+    assert job.progress.start_height == 9
+    assert (job.progress.wallets, job.progress.skipped_wallets) == (1, 1)
+    assert job.progress.matched_blocks == 1
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.balance == 5500
+    assert not await get_wallet_sync_checkpoints([other_wallet.id])
+
+
+@pytest.mark.asyncio
+async def test_filter_scan_reorg(watchonly_db, monkeypatch):
+    wallet = await _create_wallet()
+    await create_gap_addresses(wallet.id, 20, 5)
+    stub = BlockFilterStub()
+    monkeypatch.setitem(filterscan.BLOCK_FILTER_URLS, "Mainnet", "http://node")
+
+    stub.add_block([_payment(await derive_address(ZPUB, 0), 1000, 1)])
+    for _ in range(3):
+        stub.add_block([])
+    stub.add_block([_payment(await derive_address(ZPUB, 1), 2000, 2)])  # 4
+    stub.add_block([])
+    job = start_filter_scan("Mainnet", 0, http_client=stub.http_client)
+    assert job.task
+    await job.task
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.balance == 3000
+
+    # blocks 4 and 5 replaced, the payment is confirmed later
+    stub.reorg(4)
+    for _ in range(3):
+        stub.add_block([])
+    stub.add_block([_payment(await derive_address(ZPUB, 1), 2000, 2)])  # 7
+    stub.requests.clear()
+    job = start_filter_scan("Mainnet", http_client=stub.http_client)
+    assert job.task
+    await job.task
+
+    assert job.progress.status == "done", job.progress.error
+    assert job.progress.reorg_height == 3
+    assert job.progress.start_height == 4
+    # only the blocks after the fork are scanned
+    assert "/rest/blockfilter/basic/" + stub.blocks[3][0] + ".hex" not in stub.requests
+    utxos = await get_utxos(wallet.id)
+    assert sorted((u.amount, u.block_height) for u in utxos) == [(1000, 0), (2000, 7)]
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.balance == 3000
+    [checkpoint] = await get_wallet_sync_checkpoints([wallet.id])
+    assert (checkpoint.height, checkpoint.block_hash) == (7, stub.blocks[7][0])
+
+
+def test_filter_scan_requires_server(monkeypatch):
+    monkeypatch.setitem(filterscan.BLOCK_FILTER_URLS, "Testnet", "")
+    with pytest.raises(ValueError):
+        start_filter_scan("Testnet")
+
+
+@pytest.mark.asyncio
+async def test_filter_scan_reorg_restores_spent(watchonly_db, monkeypatch):
+    wallet = await _create_wallet()
+    await create_gap_addresses(wallet.id, 20, 5)
+    stub = BlockFilterStub()
+    monkeypatch.setitem(filterscan.BLOCK_FILTER_URLS, "Mainnet", "http://node")
+
+    funding = _payment(await derive_address(ZPUB, 0), 1000, 1)
+    stub.add_block([funding])
+    stub.add_block([])
+    spend = Transaction(
+        vin=[TransactionInput(funding.txid(), 0)],
+        vout=[TransactionOutput(900, script.address_to_scriptpubkey(OTHER_ADDRESS))],
+    )
+    stub.add_block([spend])  # 2
+    stub.add_block([])
+    job = start_filter_scan("Mainnet", 0, http_client=stub.http_client)
+    assert job.task
+    await job.task
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.balance == 0
+
+    # the spend is not mined again in the new chain
+    stub.reorg(2)
+    for _ in range(3):
+        stub.add_block([])
+    job = start_filter_scan("Mainnet", http_client=stub.http_client)
+    assert job.task
+    await job.task
+
+    assert job.progress.status == "done", job.progress.error
+    assert job.progress.reorg_height == 1
+    utxos = await get_utxos(wallet.id)
+    assert [(u.tx_id, u.amount) for u in utxos] == [(funding.txid().hex(), 1000)]
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.balance == 1000
@@ -0,0 +1,67 @@
+import pytest
+from embit.descriptor import Descriptor
+
+from ..helpers import address_scripthash, branch_descriptor, derive_address, parse_key
+
+# derived from the "abandon ... about" test mnemonic
+ZPUB = (
+    "zpub6rFR7y4Q2AijBEqTUquhVz398htDFrtymD9xYYfG1m4wAcvPhXNfE3EfH1r1ADqtfSdVCToU"
+    "G868RvUUkgDKf31mGDtKsAYz2oz2AGutZYs"
+)
+YPUB = (
+    "ypub6Ww3ibxVfGzLrAH1PNcjyAWenMTbbAosGNB6VvmSEgytSER9azLDWCxoJwW7Ke7icmizBMXr"
+    "zBx9979FfaHxHcrArf3zbeJJJUZPf663zsP"
+)
+XPUB = (
+    "xpub6BosfCnifzxcFwrSzQiqu2DBVTshkCXacvNsWGYJVVhhawA7d4R5WSWGFNbi8Aw6ZRc1brxM"
+    "yWMzG3DSSSSoekkudhUd9yLb6qx39T9nMdj"
+)
+TR_DESCRIPTOR = (
+    "tr([73c5da0a/86h/1h/0h]tpubDDfvzhdVV4unsoKt5aE6dcsNsfeWbTgmLZPi8LQDYU2xixrYem"
+    "MfWJ3BaVneH3u7DBQePdTwhpybaKRU95pi6PMUtLPBJLVQRpzEnjfjZzX/<0;1>/*)"
+)
+MULTISIG_DESCRIPTOR = f"wsh(sortedmulti(1,{XPUB}/<0;1>/*,{ZPUB}/<0;1>/*))"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "masterpub", [ZPUB, YPUB, XPUB, TR_DESCRIPTOR, MULTISIG_DESCRIPTOR]
+)
+async def test_derive_address_matches_full_derivation(masterpub):
+    desc, network = parse_key(masterpub)
+    # parse a fresh copy so the check does not depend on the cache
+    full = Descriptor.from_string(str(desc))
+    for branch_index in (0, 1):
+        for num in (0, 1, 7):
+            expected = full.derive(num, branch_index).address(network=network)
+            assert await derive_address(masterpub, num, branch_index) == expected
+
+
+@pytest.mark.asyncio
+async def test_derive_address_known_vector():
+    # bip84 test vector for the "abandon ... about" mnemonic
+    address = await derive_address(ZPUB, 0)
+    assert address == "bc1qcr8te4kr609gcawutmrza0j4xv80jy8z306fyu"
+
+
+def test_parse_key_is_cached():
+    assert parse_key(ZPUB) is parse_key(ZPUB)
+    assert branch_descriptor(ZPUB, 1) is branch_descriptor(ZPUB, 1)
+    assert branch_descriptor(ZPUB, 0) is not branch_descriptor(ZPUB, 1)
+
+
+def test_branch_descriptor_keeps_key_origin():
+    desc, _ = parse_key(TR_DESCRIPTOR)
+    branch = branch_descriptor(TR_DESCRIPTOR, 1)
+    expected = desc.derive(3, 1).keys[0].origin
+    derived = branch.derive(3).keys[0].origin
+    assert derived.fingerprint == expected.fingerprint
+    assert derived.derivation == expected.derivation
+
+
+def test_address_scripthash():
+    # example of the Electrum protocol documentation
+    address = "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa"
+    assert address_scripthash(address) == (
+        "8b01df4e368ea28f8dc0423bcf7a4923e3a12d307c875e47a0cfbf90b5c39161"
+    )
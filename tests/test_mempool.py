@@ -0,0 +1,54 @@
+import httpx
+import pytest
+
+from ..mempool import MempoolClient, close_http_client, get_http_client
+from .mempool_stub import MempoolStub
+from .test_views_api import _funding_tx
+
+
+@pytest.mark.asyncio
+async def test_mempool_client_retries_when_rate_limited():
+    stub = MempoolStub()
+    stub.fail_next = 2
+    client = MempoolClient(
+        "http://mempool.local", retry_delay=0, http_client=stub.http_client
+    )
+    stats = await client.get_address_stats("bc1qtest")
+    assert stats["chain_stats"]["tx_count"] == 0
+    assert len(stub.requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_mempool_client_broadcast():
+    stub = MempoolStub()
+    client = MempoolClient("http://mempool.local/testnet", http_client=stub.http_client)
+    tx_id = await client.broadcast("ab" * 100)
+    assert tx_id == "ab" * 32
+    assert stub.requests == ["/testnet/api/tx"]
+
+
+@pytest.mark.asyncio
+async def test_mempool_client_broadcast_is_not_retried():
+    stub = MempoolStub()
+    client = MempoolClient(
+        "http://mempool.local", retry_delay=0, http_client=stub.http_client
+    )
+    stub.fail_next = 1
+    with pytest.raises(httpx.HTTPStatusError):
+        await client.broadcast("ab" * 100)
+    assert len(stub.requests) == 1
+
+    # the first broadcast reached the node, the response was lost
+    tx = _funding_tx("bc1qxy2kgdygjrsqtzq2n0yrf2493p83kkfjhx0wlh", 1000)
+    stub.broadcasted.append(tx.to_string())
+    assert await client.broadcast(tx.to_string()) == tx.txid().hex()
+
+
+@pytest.mark.asyncio
+async def test_shared_http_client_lifecycle():
+    client = get_http_client()
+    assert get_http_client() is client
+    await close_http_client()
+    assert client.is_closed
+    assert get_http_client() is not client
+    await close_http_client()
@@ -0,0 +1,82 @@
+import pytest
+
+from .. import metrics
+from ..mempool import MempoolClient
+from ..metrics import Histogram
+from .mempool_stub import MempoolStub
+from .test_crud import _create_wallet
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    metrics.reset()
+    monkeypatch.setattr(metrics, "enabled", True)
+    yield
+    metrics.reset()
+
+
+def test_histogram_render():
+    histogram = Histogram("latency_seconds", "Latency.", ("route",), (0.1, 1))
+    histogram.observe(0.1, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+
+    assert histogram.render() == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 5.6',
+        'latency_seconds_count{route="/a"} 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_metrics_disabled(watchonly_db, client):
+    await client.get("/watchonly/api/v1/config")
+
+    r = await client.get("/watchonly/api/v1/metrics")
+    assert r.status_code == 404
+    assert metrics.HTTP_REQUESTS.values == {}
+
+
+@pytest.mark.asyncio
+async def test_metrics(watchonly_db, client, enabled):
+    wallet = await _create_wallet()
+    r = await client.get(f"/watchonly/api/v1/addresses/{wallet.id}")
+    assert r.status_code == 200
+    r = await client.get("/watchonly/api/v1/wallet/unknown")
+    assert r.status_code == 404
+
+    stub = MempoolStub()
+    stub.fail_next = 1
+    mempool = MempoolClient(
+        "http://mempool.local", retry_delay=0, http_client=stub.http_client
+    )
+    await mempool.get_address_stats("bc1qtest")
+
+    r = await client.get("/watchonly/api/v1/metrics")
+    assert r.status_code == 200
+    assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    lines = r.text.splitlines()
+    for line in [
+        "watchonly_http_request_duration_seconds_count"
+        '{method="GET",route="/watchonly/api/v1/addresses/{wallet_id}",status="200"} 1',
+        "watchonly_http_request_duration_seconds_count"
+        '{method="GET",route="/watchonly/api/v1/wallet/{wallet_id}",status="404"} 1',
+        'watchonly_crud_duration_seconds_count{function="create_watch_wallet"} 1',
+        "watchonly_derivation_duration_seconds_count 25",
+        "watchonly_mempool_request_duration_seconds_count"
+        '{host="mempool.local",operation="address"} 2',
+        'watchonly_mempool_errors_total{host="mempool.local",operation="address",'
+        'error="429"} 1',
+    ]:
+        assert line in lines
+    # the queries are attributed to the crud function running them
+    assert any(
+        line.startswith(
+            'watchonly_db_query_duration_seconds_count{function="get_addresses_page"}'
+        )
+        for line in lines
+    )
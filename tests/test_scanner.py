@@ -0,0 +1,76 @@
+import pytest
+
+from ..backends import EsploraBackend
+from ..crud import get_addresses, get_utxos, get_watch_wallet
+from ..helpers import derive_address
+from ..mempool import MempoolClient
+from ..models import Config
+from ..scanner import ScanJob, scan_wallet, start_scan
+from .mempool_stub import MempoolStub
+from .test_crud import _create_wallet
+from .test_helpers import ZPUB
+
+
+@pytest.mark.asyncio
+async def test_scan_wallet_follows_gap_limit(watchonly_db):
+    wallet = await _create_wallet()
+    funded_receive = await derive_address(ZPUB, 15, 0)
+    # only found after the receive branch has been extended
+    funded_receive_gap = await derive_address(ZPUB, 30, 0)
+    funded_change = await derive_address(ZPUB, 3, 1)
+    stub = MempoolStub(
+        {funded_receive: 1000, funded_receive_gap: 2000, funded_change: 500},
+        latency=0.001,
+    )
+    client = MempoolClient(
+        "http://mempool.local", concurrency=4, http_client=stub.http_client
+    )
+    job = ScanJob(wallet)
+
+    await scan_wallet(job, wallet, Config(), EsploraBackend(client))
+
+    # 20 + 5 initial addresses, receive branch extended twice
+    addresses = await get_addresses(wallet.id)
+    receive = [a for a in addresses if a.branch_index == 0]
+    change = [a for a in addresses if a.branch_index == 1]
+    assert receive[-1].address_index == 30 + 20
+    assert change[-1].address_index == 3 + 5
+    assert job.progress.scanned == len(addresses)
+    assert job.progress.active == 3
+    assert stub.max_in_flight <= 4
+
+    active = {a.address: a for a in addresses if a.has_activity}
+    assert active[funded_receive].amount == 1000
+    assert active[funded_receive_gap].amount == 2000
+    assert active[funded_change].amount == 500
+
+    result = job.result()
+    assert [a.address for a in result.addresses] == [
+        funded_receive,
+        funded_receive_gap,
+        funded_change,
+    ]
+    assert result.addresses[0].utxos[0].amount == 1000
+
+    utxos = await get_utxos(wallet.id)
+    assert sorted(u.amount for u in utxos) == [500, 1000, 2000]
+
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet
+    assert updated_wallet.address_no == 30
+    assert updated_wallet.balance == 3500
+    assert updated_wallet.receive_balance == 3000
+    assert updated_wallet.change_balance == 500
+
+
+@pytest.mark.asyncio
+async def test_start_scan_runs_in_background(watchonly_db):
+    wallet = await _create_wallet()
+    stub = MempoolStub()
+    job = start_scan(wallet, Config(scan_rate_limit=0), http_client=stub.http_client)
+    assert start_scan(wallet, Config(), http_client=stub.http_client) is job
+    assert job.task
+    await job.task
+    assert job.progress.status == "done"
+    assert job.progress.scanned == 25
+    assert all(path.startswith("/api/address/") for path in stub.requests)
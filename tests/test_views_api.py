@@ -0,0 +1,378 @@
+import json
+
+import pytest
+from embit import bip32, bip39, script
+from embit.psbt import PSBT
+from embit.transaction import Transaction, TransactionInput, TransactionOutput
+
+from .. import mempool, scanner, views_api, watcher
+from ..crud import (
+    create_fresh_addresses,
+    create_watch_wallet,
+    get_transactions,
+    update_address_utxos,
+)
+from ..helpers import derive_address
+from ..models import WalletAccount, WalletUtxo
+from .mempool_stub import MempoolStub
+from .test_crud import _create_wallet
+from .test_helpers import XPUB, ZPUB
+
+
+@pytest.mark.asyncio
+async def test_get_addresses_pages(watchonly_db, client):
+    wallet = await _create_wallet()
+    url = f"/watchonly/api/v1/addresses/{wallet.id}"
+
+    r = await client.get(url)
+    assert r.status_code == 200
+    all_addresses = r.json()
+    assert len(all_addresses) == 25
+    assert "X-Next-Cursor" not in r.headers
+
+    pages = []
+    cursor = None
+    while True:
+        params: dict = {"limit": 10}
+        if cursor:
+            params["cursor"] = cursor
+        r = await client.get(url, params=params)
+        pages.append(r.json())
+        cursor = r.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [a["id"] for page in pages for a in page] == [a["id"] for a in all_addresses]
+
+    r = await client.get(url, params={"branch_index": 1})
+    assert {a["branch_index"] for a in r.json()} == {1}
+
+
+@pytest.mark.asyncio
+async def test_get_addresses_etag(watchonly_db, client):
+    wallet = await _create_wallet()
+    url = f"/watchonly/api/v1/addresses/{wallet.id}"
+
+    r = await client.get(url)
+    etag = r.headers["ETag"]
+    r = await client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.content == b""
+
+    address_id = (await client.get(url)).json()[0]["id"]
+    await client.put(f"/watchonly/api/v1/address/{address_id}", json={"note": "x"})
+    r = await client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+
+
+def _funding_tx(address: str, amount: int, nonce: int = 0) -> Transaction:
+    vin = [TransactionInput(nonce.to_bytes(32, "big"), 0)]
+    vout = [TransactionOutput(amount, script.address_to_scriptpubkey(address))]
+    return Transaction(vin=vin, vout=vout)
+
+
+@pytest.mark.asyncio
+async def test_psbt_create_resolves_previous_transactions(
+    watchonly_db, client, monkeypatch
+):
+    wallet = await _create_wallet()
+    address = await derive_address(ZPUB, 0)
+    funding_tx = _funding_tx(address, 10_000)
+    tx_id = funding_tx.txid().hex()
+    stub = MempoolStub(transactions={tx_id: funding_tx.to_string()})
+    monkeypatch.setattr(mempool, "_http_client", stub.http_client)
+
+    data = {
+        "masterpubs": [
+            {"id": wallet.id, "public_key": ZPUB, "fingerprint": "73c5da0a"}
+        ],
+        "inputs": [
+            {
+                "tx_id": tx_id,
+                "vout": 0,
+                "amount": 10_000,
+                "address": address,
+                "branch_index": 0,
+                "address_index": 0,
+                "wallet": wallet.id,
+            }
+        ],
+        "outputs": [{"amount": 9_000, "address": await derive_address(ZPUB, 1)}],
+        "fee_rate": 1,
+        "tx_size": 140,
+    }
+    r = await client.post("/watchonly/api/v1/psbt", json=data)
+    assert r.status_code == 200, r.text
+    assert r.headers["Server-Timing"].startswith("psbt;dur=")
+    psbt = PSBT.from_string(r.json())
+    assert psbt.inputs[0].non_witness_utxo.txid().hex() == tx_id
+    assert [tx.id for tx in await get_transactions([tx_id])] == [tx_id]
+
+    # the previous transaction is now served from the cache
+    requests = len(stub.requests)
+    r = await client.post("/watchonly/api/v1/psbt", json=data)
+    assert r.status_code == 200, r.text
+    assert len(stub.requests) == requests
+
+
+@pytest.mark.asyncio
+async def test_psbt_extract_segwit_without_backend(watchonly_db, client, monkeypatch):
+    wallet = await _create_wallet()
+    address = await derive_address(ZPUB, 0)
+    funding_tx = _funding_tx(address, 10_000)
+    data = {
+        "masterpubs": [
+            {"id": wallet.id, "public_key": ZPUB, "fingerprint": "73c5da0a"}
+        ],
+        "inputs": [
+            {
+                "tx_id": funding_tx.txid().hex(),
+                "vout": 0,
+                "amount": 10_000,
+                "address": address,
+                "branch_index": 0,
+                "address_index": 0,
+                "wallet": wallet.id,
+                "tx_hex": funding_tx.to_string(),
+            }
+        ],
+        "outputs": [{"amount": 9_000, "address": await derive_address(ZPUB, 1)}],
+        "fee_rate": 1,
+        "tx_size": 140,
+    }
+    r = await client.post("/watchonly/api/v1/psbt", json=data)
+    assert r.status_code == 200, r.text
+    psbt = PSBT.from_string(r.json())
+    root = bip32.HDKey.from_seed(bip39.mnemonic_to_seed("abandon " * 11 + "about"))
+    assert psbt.sign_with(root.derive("m/84h/0h/0h")) == 1
+    # only the spent output, as in the streamed PSBTs
+    for inp in psbt.inputs:
+        inp.witness_utxo = inp.non_witness_utxo.vout[inp.vout]
+        inp.non_witness_utxo = None
+
+    async def no_backend(*args):
+        raise AssertionError("No previous transaction should be fetched.")
+
+    monkeypatch.setattr(views_api, "get_transactions_hex", no_backend)
+    r = await client.put(
+        "/watchonly/api/v1/psbt/extract",
+        json={"psbt_base64": psbt.to_string(), "network": "Mainnet"},
+    )
+    assert r.status_code == 200, r.text
+    assert json.loads(r.json()["tx_json"])["fee"] == 1_000
+
+
+@pytest.mark.asyncio
+async def test_psbt_create_stream(watchonly_db, client, monkeypatch):
+    wallet = await _create_wallet()
+    legacy_address = await derive_address(XPUB, 0)
+    funding_tx = _funding_tx(legacy_address, 5_000)
+    stub = MempoolStub(transactions={funding_tx.txid().hex(): funding_tx.to_string()})
+    monkeypatch.setattr(mempool, "_http_client", stub.http_client)
+
+    masterpubs = [
+        {"id": wallet.id, "public_key": ZPUB, "fingerprint": "73c5da0a"},
+        {"id": "legacy", "public_key": XPUB, "fingerprint": "73c5da0a"},
+    ]
+    inputs = [
+        {
+            "tx_id": f"{i:064x}",
+            "vout": i % 3,
+            "amount": 1_000 + i,
+            "address": await derive_address(ZPUB, i),
+            "branch_index": 0,
+            "address_index": i,
+            "wallet": wallet.id,
+        }
+        for i in range(450)
+    ]
+    inputs.append(
+        {
+            "tx_id": funding_tx.txid().hex(),
+            "vout": 0,
+            "amount": 5_000,
+            "address": legacy_address,
+            "branch_index": 0,
+            "address_index": 0,
+            "wallet": "legacy",
+        }
+    )
+    change = {
+        "amount": 400_000,
+        "address": await derive_address(ZPUB, 0, 1),
+        "branch_index": 1,
+        "address_index": 0,
+        "wallet": wallet.id,
+    }
+
+    async def body():
+        header = {"masterpubs": masterpubs, "outputs": [change]}
+        yield json.dumps(header).encode() + b"\n"
+        for inp in inputs:
+            yield json.dumps(inp).encode() + b"\n"
+
+    r = await client.post("/watchonly/api/v1/psbt/stream", content=body())
+    assert r.status_code == 200, r.text
+
+    psbt = PSBT.parse(r.content)
+    assert len(psbt.inputs) == len(inputs)
+    segwit = psbt.inputs[7]
+    assert segwit.txid.hex() == inputs[7]["tx_id"]
+    assert segwit.non_witness_utxo is None
+    assert segwit.witness_utxo.value == inputs[7]["amount"]
+    assert segwit.witness_utxo.script_pubkey.address() == inputs[7]["address"]
+    [derivation] = segwit.bip32_derivations.values()
+    assert derivation.derivation[-2:] == [0, 7]
+    legacy = psbt.inputs[-1]
+    assert legacy.non_witness_utxo.txid() == funding_tx.txid()
+    [derivation] = psbt.outputs[0].bip32_derivations.values()
+    assert derivation.derivation[-2:] == [1, 0]
+
+    r = await client.post("/watchonly/api/v1/psbt/stream", content=b"")
+    assert r.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_update_addresses(watchonly_db, client):
+    wallet = await _create_wallet()
+    addresses = (await client.get(f"/watchonly/api/v1/addresses/{wallet.id}")).json()
+    receive = [a for a in addresses if a["branch_index"] == 0]
+    change = [a for a in addresses if a["branch_index"] == 1]
+
+    r = await client.put(
+        "/watchonly/api/v1/addresses",
+        json=[
+            {"id": receive[3]["id"], "amount": 1_000},
+            {"id": receive[7]["id"], "amount": 2_000, "note": "shop"},
+            {"id": receive[9]["id"], "note": "friend"},
+            {"id": change[1]["id"], "amount": 500},
+        ],
+    )
+    assert r.status_code == 200, r.text
+    updated = {a["id"]: a for a in r.json()}
+    assert updated[receive[7]["id"]]["note"] == "shop"
+    assert updated[receive[7]["id"]]["has_activity"]
+    assert not updated[receive[9]["id"]]["has_activity"]
+
+    wallet_data = (await client.get(f"/watchonly/api/v1/wallet/{wallet.id}")).json()
+    assert wallet_data["address_no"] == 7
+    assert wallet_data["balance"] == 3_500
+    assert wallet_data["change_balance"] == 500
+
+    r = await client.put(
+        "/watchonly/api/v1/addresses", json=[{"id": "missing", "amount": 1}]
+    )
+    assert r.status_code == 404
+
+    # nothing is updated
+    r = await client.put(
+        "/watchonly/api/v1/addresses",
+        json=[
+            {"id": receive[3]["id"], "amount": 5_000},
+            {"id": receive[4]["id"], "amount": None},
+        ],
+    )
+    assert r.status_code == 400
+    wallet_data = (await client.get(f"/watchonly/api/v1/wallet/{wallet.id}")).json()
+    assert wallet_data["balance"] == 3_500
+
+
+@pytest.mark.asyncio
+async def test_decode_transactions(watchonly_db, client, monkeypatch):
+    address = await derive_address(ZPUB, 0)
+    funding_tx = _funding_tx(address, 10_000)
+    vin = [TransactionInput(funding_tx.txid(), 0)]
+    vout = [
+        TransactionOutput(9_000, script.address_to_scriptpubkey(address)),
+        TransactionOutput(0, script.Script(b"\x6a")),
+    ]
+    psbt = PSBT(Transaction(vin=vin, vout=vout))
+    psbt.inputs[0].witness_utxo = funding_tx.vout[0]
+    data = {
+        "transactions": [funding_tx.to_string(), psbt.to_string(), "not a tx"],
+    }
+    monkeypatch.setattr(views_api, "TX_DECODE_BATCH_SIZE", 2)
+
+    r = await client.put("/watchonly/api/v1/tx/decode", json=data)
+
+    assert r.status_code == 200, r.text
+    assert r.headers["Content-Type"] == "application/x-ndjson"
+    raw_tx, psbt_tx, invalid = (json.loads(line) for line in r.text.splitlines())
+    assert raw_tx["index"] == 0
+    assert raw_tx["tx_id"] == funding_tx.txid().hex()
+    assert raw_tx["outputs"] == [{"amount": 10_000, "address": address}]
+    assert raw_tx["fee"] is None
+    assert psbt_tx["inputs"] == [{"tx_id": funding_tx.txid().hex(), "vout": 0}]
+    assert psbt_tx["outputs"][1] == {"amount": 0, "address": None}
+    assert psbt_tx["fee"] == 1_000
+    assert invalid["index"] == 2 and "error" in invalid
+
+    monkeypatch.setattr(views_api, "TX_DECODE_MAX_ITEMS", 2)
+    r = await client.put("/watchonly/api/v1/tx/decode", json=data)
+    assert r.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_events_end_after_error(watchonly_db, client, monkeypatch):
+    wallet = await _create_wallet()
+
+    async def load_addresses(self):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(watcher.WalletWatcher, "load_addresses", load_addresses)
+    r = await client.get(f"/watchonly/api/v1/events/{wallet.id}", timeout=5)
+    assert r.status_code == 200
+    assert "event: error" in r.text
+    assert wallet.id not in watcher.watchers
+
+
+async def _create_other_user_wallet() -> WalletAccount:
+    return await create_watch_wallet(
+        WalletAccount(
+            id="wallet_2",
+            user="user_2",
+            masterpub=ZPUB,
+            fingerprint="",
+            title="",
+            address_no=-1,
+            balance=0,
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_scan_of_another_user(watchonly_db, client, monkeypatch):
+    wallet = await _create_wallet()
+    other_wallet = await _create_other_user_wallet()
+    for w in (wallet, other_wallet):
+        monkeypatch.setitem(scanner.scan_jobs, w.id, scanner.ScanJob(w))
+
+    for url in ("/api/v1/scan/{}", "/api/v1/scan/{}/result"):
+        r = await client.get("/watchonly" + url.format(wallet.id))
+        assert r.status_code == 200, r.text
+        r = await client.get("/watchonly" + url.format(other_wallet.id))
+        assert r.status_code == 404
+    r = await client.post(f"/watchonly/api/v1/scan/{other_wallet.id}")
+    assert r.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_utxos_of_another_user(watchonly_db, client):
+    wallet = await _create_wallet()
+    other_wallet = await _create_other_user_wallet()
+    addresses = await create_fresh_addresses(other_wallet.id, 0, 1)
+    utxo = WalletUtxo(
+        address_id=addresses[0].id,
+        wallet=other_wallet.id,
+        tx_id="00" * 32,
+        vout=0,
+        amount=1000,
+    )
+    await update_address_utxos([addresses[0].id], [utxo])
+
+    r = await client.get(f"/watchonly/api/v1/utxos/{wallet.id}")
+    assert r.status_code == 200
+    assert r.json() == []
+    r = await client.get(f"/watchonly/api/v1/utxos/{other_wallet.id}")
+    assert r.status_code == 404
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from .. import crud
+from ..crud import (
+    create_gap_addresses,
+    get_address_pools,
+    get_fresh_address,
+)
+from ..warmer import AddressPoolWarmer, start_warmer, stop_warmer
+from .test_crud import _create_wallet
+
+
+@pytest.mark.asyncio
+async def test_refill_address_pools(watchonly_db):
+    wallet = await _create_wallet()
+    await create_gap_addresses(wallet.id, 20, 5)
+    warmer = AddressPoolWarmer(receive_pool=50, change_pool=20)
+
+    assert await warmer.refill() == 30 + 15
+    pools = {p.branch_index: p for p in await get_address_pools([wallet.id])}
+    assert (pools[0].last_index, pools[0].unused) == (49, 50)
+    assert (pools[1].last_index, pools[1].unused) == (19, 20)
+
+    # above the low-water mark
+    for _ in range(20):
+        await get_fresh_address(wallet.id)
+    assert await warmer.refill() == 0
+    for _ in range(10):
+        await get_fresh_address(wallet.id)
+    assert await warmer.refill([wallet.id]) == 30
+    pools = {p.branch_index: p for p in await get_address_pools([wallet.id])}
+    assert (pools[0].address_no, pools[0].last_index) == (29, 79)
+
+
+async def _wait_for_pool(wallet_id: str, unused: int):
+    for _ in range(200):
+        pools = await get_address_pools([wallet_id])
+        if pools[0].unused == unused:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("The pool was not refilled.")
+
+
+@pytest.mark.asyncio
+async def test_fresh_addresses_are_not_derived(watchonly_db, monkeypatch):
+    wallet = await _create_wallet()
+    derived: list[range] = []
+
+    def derive_address_scripts(masterpub, start, end, branch_index=0):
+        derived.append(range(start, end))
+        return original(masterpub, start, end, branch_index)
+
+    original = crud.derive_address_scripts
+    monkeypatch.setattr(crud, "derive_address_scripts", derive_address_scripts)
+    start_warmer(receive_pool=20, change_pool=4)
+    try:
+        await _wait_for_pool(wallet.id, 20)
+        for _ in range(5):
+            addresses = await asyncio.gather(
+                *[get_fresh_address(wallet.id) for _ in range(15)]
+            )
+            assert all(addresses)
+            # woken up by the allocations
+            await _wait_for_pool(wallet.id, 20)
+    finally:
+        stop_warmer()
+
+    # the warmer derived the addresses in batches, the requests none
+    assert sum(len(r) for r in derived) == 20 + 4 + 5 * 15
+    assert all(len(r) > 1 for r in derived)
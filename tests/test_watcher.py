@@ -0,0 +1,131 @@
+import asyncio
+import json
+
+import pytest
+from websockets.asyncio.server import serve
+
+from .. import watcher
+from ..crud import get_address, get_watch_wallet
+from ..helpers import derive_address
+from ..models import Config
+from ..watcher import subscribe, unsubscribe, watchers
+from .mempool_stub import MempoolStub
+from .test_crud import _create_wallet
+from .test_helpers import ZPUB
+
+
+class MempoolFeed:
+    """Local stand-in for the mempool.space websocket API"""
+
+    def __init__(self):
+        self.tracked: list[str] = []
+        self.subscribed = asyncio.Event()
+        self.connections: set = set()
+
+    async def handler(self, connection):
+        self.connections.add(connection)
+        try:
+            async for message in connection:
+                data = json.loads(message)
+                if "track-addresses" in data:
+                    self.tracked = data["track-addresses"]
+                    self.subscribed.set()
+        finally:
+            self.connections.discard(connection)
+
+    async def send(self, data: dict):
+        for connection in self.connections:
+            await connection.send(json.dumps(data))
+
+
+async def _next_event(queue: asyncio.Queue, event_type: str) -> dict:
+    while True:
+        event = await asyncio.wait_for(queue.get(), 5)
+        if event["type"] == event_type:
+            return event
+
+
+@pytest.mark.asyncio
+async def test_watch_with_websocket(watchonly_db):
+    wallet = await _create_wallet()
+    address = await derive_address(ZPUB, 2)
+    stub = MempoolStub()
+    feed = MempoolFeed()
+    async with serve(feed.handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        config = Config(mempool_endpoint=f"http://127.0.0.1:{port}")
+        queue = subscribe(wallet, config, stub.http_client)
+        try:
+            await asyncio.wait_for(feed.subscribed.wait(), 5)
+            assert address in feed.tracked
+            assert watchers[wallet.id].mode == "websocket"
+
+            stub.funded[address] = 21_000
+            await feed.send({"multi-address-transactions": {address: {"mempool": []}}})
+
+            event = await _next_event(queue, "address")
+            assert event["address"]["address"] == address
+            assert event["address"]["amount"] == 21_000
+            assert event["utxos"][0]["amount"] == 21_000
+
+            await feed.send({"block": {"height": 800_001}})
+            assert (await _next_event(queue, "block"))["height"] == 800_001
+        finally:
+            unsubscribe(wallet.id, queue)
+
+    assert wallet.id not in watchers
+    stored = await get_address(address)
+    assert stored and stored.amount == 21_000 and stored.has_activity
+    updated_wallet = await get_watch_wallet(wallet.id)
+    assert updated_wallet and updated_wallet.balance == 21_000
+
+
+@pytest.mark.asyncio
+async def test_watch_falls_back_to_polling(watchonly_db, monkeypatch):
+    monkeypatch.setattr(watcher, "POLL_INTERVAL", 0.05)
+    wallet = await _create_wallet()
+    address = await derive_address(ZPUB, 1, 1)
+    stub = MempoolStub()
+    # nothing listens on this port
+    config = Config(mempool_endpoint="http://127.0.0.1:9")
+    queue = subscribe(wallet, config, stub.http_client)
+    try:
+        await asyncio.sleep(0.1)
+        assert watchers[wallet.id].mode == "polling"
+        stub.funded[address] = 5_000
+
+        event = await _next_event(queue, "address")
+        assert event["address"]["address"] == address
+        assert event["address"]["branch_index"] == 1
+    finally:
+        unsubscribe(wallet.id, queue)
+
+
+@pytest.mark.asyncio
+async def test_failed_watcher_is_replaced(watchonly_db, monkeypatch):
+    wallet = await _create_wallet()
+    stub = MempoolStub()
+    config = Config(mempool_endpoint="http://127.0.0.1:9")
+
+    async def load_addresses(self):
+        raise RuntimeError("database is locked")
+
+    with monkeypatch.context() as m:
+        m.setattr(watcher.WalletWatcher, "load_addresses", load_addresses)
+        queue = subscribe(wallet, config, stub.http_client)
+        failed = watchers[wallet.id]
+        event = await _next_event(queue, "error")
+        assert event["error"] == "database is locked"
+        assert failed.task
+        await asyncio.wait([failed.task], timeout=5)
+    assert wallet.id not in watchers
+
+    new_queue = subscribe(wallet, config, stub.http_client)
+    try:
+        assert watchers[wallet.id] is not failed
+        # the subscriber of the failed watcher leaves
+        unsubscribe(wallet.id, queue)
+        assert wallet.id in watchers
+    finally:
+        unsubscribe(wallet.id, new_queue)
+    assert wallet.id not in watchers
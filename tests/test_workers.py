@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+import pytest
+
+from .. import metrics
+from ..psbt import extract_tx
+from ..workers import run_in_worker, start_workers, stop_workers
+
+# one input, one p2wpkh output
+TX_HEX = (
+    "02000000010000000000000000000000000000000000000000000000000000000000000000"
+    "0000000000ffffffff0110270000000000001600149bb2d9c5b1ed1c27a2f7e8e6ffa3c3e6"
+    "2bfbbf2200000000"
+)
+
+
+def _busy(seconds: float) -> float:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+    return seconds
+
+
+@pytest.fixture
+def pool():
+    stop_workers()
+    yield
+    stop_workers()
+
+
+@pytest.mark.asyncio
+async def test_run_in_worker_reports_timings(pool, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+
+    def jobs() -> int:
+        buckets, _ = metrics.WORKER_JOBS.values.get(("extract_tx",), [[], 0.0])
+        return sum(buckets)
+
+    count = jobs()
+    tx, duration = await run_in_worker(extract_tx, TX_HEX, "Mainnet")
+
+    assert tx["outputs"][0]["amount"] == 10_000
+    assert duration > 0
+    assert jobs() == count + 1
+
+
+@pytest.mark.asyncio
+async def test_event_loop_stays_responsive(pool):
+    start_workers("process", 1)
+    # wait for the worker to be started and warmed up
+    await run_in_worker(_busy, 0)
+
+    job = asyncio.create_task(run_in_worker(_busy, 0.5))
+    max_lag = 0.0
+    while not job.done():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        max_lag = max(max_lag, time.perf_counter() - start - 0.01)
+    await job
+    assert max_lag < 0.1
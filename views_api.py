@@ -1,46 +1,90 @@
+import asyncio
+import hashlib
 import json
+from collections.abc import AsyncIterator
 from http import HTTPStatus
+from tempfile import SpooledTemporaryFile
+from typing import Optional
 
-import httpx
-from embit import finalizer, script
-from embit.ec import PublicKey
-from embit.networks import NETWORKS
-from embit.psbt import PSBT, DerivationPath
-from embit.transaction import Transaction, TransactionInput, TransactionOutput
-from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from embit.psbt import PSBT
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from lnbits.core.models import WalletTypeInfo
-from lnbits.decorators import require_admin_key, require_invoice_key
+from lnbits.decorators import check_admin, require_admin_key, require_invoice_key
 from lnbits.helpers import urlsafe_short_hash
+from sse_starlette.sse import EventSourceResponse
 
+from . import metrics
+from .backends import ChainBackend, chain_backend
 from .crud import (
-    create_fresh_addresses,
+    create_gap_addresses,
     create_watch_wallet,
     delete_addresses_for_wallet,
+    delete_utxos_for_wallet,
     delete_watch_wallet,
     get_address_by_id,
-    get_addresses,
+    get_addresses_by_ids,
+    get_addresses_page,
     get_config,
     get_fresh_address,
+    get_utxos,
     get_watch_wallet,
     get_watch_wallets,
     update_address,
+    update_addresses,
     update_config,
-    update_watch_wallet,
 )
+from .filterscan import get_filter_scan, start_filter_scan
 from .helpers import parse_key
 from .models import (
     Address,
+    AddressUpdate,
+    CoinSelect,
+    CoinSelection,
     Config,
     CreatePsbt,
     CreateWallet,
+    DecodeTransactions,
     ExtractPsbt,
     ExtractTx,
+    FilterScanProgress,
+    PsbtStreamHeader,
+    ScanProgress,
+    ScanResult,
     SerializedTransaction,
     SignedTransaction,
+    StartFilterScan,
+    TransactionInput,
     WalletAccount,
+    WalletUtxo,
 )
+from .psbt import (
+    create_psbt,
+    decode_transactions,
+    extract_psbt,
+    extract_tx,
+    psbt_missing_tx_ids,
+    serialize_psbt_header,
+    serialize_psbt_inputs,
+    serialize_psbt_outputs,
+)
+from .scanner import get_scan_job, start_scan
+from .services import get_transactions_hex, select_wallet_coins
+from .warmer import wake_warmer
+from .watcher import subscribe, unsubscribe
+from .workers import run_in_worker, server_timing
+
+watchonly_api_router = APIRouter(route_class=metrics.TimedRoute)
 
-watchonly_api_router = APIRouter()
+ADDRESSES_PAGE_MAX_LIMIT = 1000
+# inputs serialized per worker job by the streaming PSBT builder
+PSBT_STREAM_BATCH_SIZE = 200
+# transactions decoded per request, and per worker job
+TX_DECODE_MAX_ITEMS = 1000
+TX_DECODE_BATCH_SIZE = 50
+# the serialized inputs are written to disk above this size
+PSBT_SPOOL_MAX_SIZE = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 @watchonly_api_router.get("/api/v1/wallet")
@@ -110,7 +154,11 @@ async def api_wallet_create_or_update(
 
         wallet = await create_watch_wallet(new_wallet)
 
-        await api_get_addresses(wallet.id, key_info)
+        config = await get_config(key_info.wallet.user)
+        await create_gap_addresses(
+            wallet.id, config.receive_gap_limit, config.change_gap_limit
+        )
+        wake_warmer(wallet.id)
     except Exception as exc:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
@@ -132,6 +180,7 @@ async def api_wallet_delete(wallet_id: str):
 
     await delete_watch_wallet(wallet_id)
     await delete_addresses_for_wallet(wallet_id)
+    await delete_utxos_for_wallet(wallet_id)
 
     return "", HTTPStatus.NO_CONTENT
 
@@ -158,140 +207,353 @@ async def api_update_address(address_id: str, req: Request):
             status_code=HTTPStatus.NOT_FOUND, detail="Address does not exist."
         )
 
-    body = await req.json()
+    _apply_address_update(address, await req.json())
+    return await update_address(address)
+
+
+@watchonly_api_router.put("/api/v1/addresses")
+async def api_update_addresses(
+    data: list[AddressUpdate], key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> list[Address]:
+    """Update the amount and/or note of many addresses in one transaction"""
+    addresses = {a.id: a for a in await get_addresses_by_ids([u.id for u in data])}
+    missing = [u.id for u in data if u.id not in addresses]
+    if missing:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"Address does not exist: {missing[0]}.",
+        )
+    for wallet_id in {a.wallet for a in addresses.values()}:
+        wallet = await get_watch_wallet(wallet_id)
+        if not wallet or wallet.user != key_info.wallet.user:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND, detail="Wallet does not exist."
+            )
+
+    for update in data:
+        _apply_address_update(addresses[update.id], update.dict(exclude_unset=True))
+    await update_addresses(list(addresses.values()))
+    return [addresses[u.id] for u in data]
+
+
+def _apply_address_update(address: Address, body: dict):
     # amount is only updated if the address has history
     if "amount" in body:
+        if body["amount"] is None:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f"The amount of {address.id} cannot be null.",
+            )
         address.amount = int(body["amount"])
         address.has_activity = True
 
     if "note" in body:
         address.note = body["note"]
 
-    address = await update_address(address)
 
-    wallet = (
-        await get_watch_wallet(address.wallet)
-        if address.branch_index == 0 and address.amount != 0
-        else None
+@watchonly_api_router.get("/api/v1/addresses/{wallet_id}", response_model=list[Address])
+async def api_get_addresses(
+    wallet_id,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    limit: Optional[int] = Query(None, ge=1, le=ADDRESSES_PAGE_MAX_LIMIT),
+    cursor: Optional[str] = Query(
+        None, description="`X-Next-Cursor` header of the previous page"
+    ),
+    branch_index: Optional[int] = Query(None, ge=0, le=1),
+    has_activity: Optional[bool] = None,
+    has_note: Optional[bool] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    wallet = await get_watch_wallet(wallet_id)
+    if not wallet:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Wallet does not exist."
+        )
+
+    after = None
+    if cursor:
+        try:
+            after_branch, after_index = cursor.split(":")
+            after = (int(after_branch), int(after_index))
+        except ValueError as exc:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST, detail="Invalid cursor."
+            ) from exc
+    else:
+        # the gap only has to be checked once, when the first page is requested
+        config = await get_config(key_info.wallet.user)
+        assert config, "Config not found"
+        await create_gap_addresses(
+            wallet_id, config.receive_gap_limit, config.change_gap_limit
+        )
+
+    addresses = await get_addresses_page(
+        wallet_id, limit, after, branch_index, has_activity, has_note
     )
 
-    if wallet and wallet.address_no < address.address_index:
-        wallet.address_no = address.address_index
-        await update_watch_wallet(wallet)
-    return address
+    body = json.dumps([address.dict() for address in addresses]).encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    # make browsers revalidate the cached response using the etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if limit and len(addresses) == limit:
+        last = addresses[-1]
+        headers["X-Next-Cursor"] = f"{last.branch_index}:{last.address_index}"
 
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-@watchonly_api_router.get("/api/v1/addresses/{wallet_id}")
-async def api_get_addresses(
-    wallet_id, key_info: WalletTypeInfo = Depends(require_invoice_key)
-) -> list[Address]:
+
+#############################SCAN##########################
+
+
+async def _user_wallet(wallet_id: str, user: str) -> WalletAccount:
+    """The wallet if it belongs to the user, 404 otherwise"""
     wallet = await get_watch_wallet(wallet_id)
-    if not wallet:
+    if not wallet or wallet.user != user:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Wallet does not exist."
         )
+    return wallet
+
 
-    addresses = await get_addresses(wallet_id)
+@watchonly_api_router.post("/api/v1/scan/{wallet_id}")
+async def api_scan_start(
+    wallet_id: str, key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> ScanProgress:
+    wallet = await _user_wallet(wallet_id, key_info.wallet.user)
     config = await get_config(key_info.wallet.user)
-    assert config, "Config not found"
-
-    if not addresses:
-        await create_fresh_addresses(wallet_id, 0, config.receive_gap_limit)
-        await create_fresh_addresses(wallet_id, 0, config.change_gap_limit, True)
-        addresses = await get_addresses(wallet_id)
-
-    receive_addresses = list(filter(lambda addr: addr.branch_index == 0, addresses))
-    change_addresses = list(filter(lambda addr: addr.branch_index == 1, addresses))
-
-    last_receive_address = list(
-        filter(lambda addr: addr.has_activity, receive_addresses)
-    )[-1:]
-    last_change_address = list(
-        filter(lambda addr: addr.has_activity, change_addresses)
-    )[-1:]
-
-    if last_receive_address:
-        current_index = receive_addresses[-1].address_index
-        address_index = last_receive_address[0].address_index
-        await create_fresh_addresses(
-            wallet_id, current_index + 1, address_index + config.receive_gap_limit + 1
-        )
+    try:
+        job = start_scan(wallet, config)
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
+    return job.progress
 
-    if last_change_address:
-        current_index = change_addresses[-1].address_index
-        address_index = last_change_address[0].address_index
-        await create_fresh_addresses(
-            wallet_id,
-            current_index + 1,
-            address_index + config.change_gap_limit + 1,
-            True,
+
+@watchonly_api_router.get("/api/v1/scan/{wallet_id}")
+async def api_scan_progress(
+    wallet_id: str, key_info: WalletTypeInfo = Depends(require_invoice_key)
+) -> ScanProgress:
+    await _user_wallet(wallet_id, key_info.wallet.user)
+    job = get_scan_job(wallet_id)
+    if not job:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="No scan for this wallet."
         )
+    return job.progress
 
-    return await get_addresses(wallet_id)
 
+@watchonly_api_router.get("/api/v1/scan/{wallet_id}/result")
+async def api_scan_result(
+    wallet_id: str, key_info: WalletTypeInfo = Depends(require_invoice_key)
+) -> ScanResult:
+    await _user_wallet(wallet_id, key_info.wallet.user)
+    job = get_scan_job(wallet_id)
+    if not job:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="No scan for this wallet."
+        )
+    return job.result()
 
-@watchonly_api_router.post("/api/v1/psbt", dependencies=[Depends(require_admin_key)])
-async def api_psbt_create(data: CreatePsbt):
+
+@watchonly_api_router.post("/api/v1/filterscan", dependencies=[Depends(check_admin)])
+async def api_filter_scan_start(data: StartFilterScan) -> FilterScanProgress:
+    """Scan the blocks with the compact block filters, for all the wallets of
+    the network (see `filterscan.py`)"""
     try:
-        vin = [
-            TransactionInput(bytes.fromhex(inp.tx_id), inp.vout) for inp in data.inputs
-        ]
-        vout = [
-            TransactionOutput(out.amount, script.address_to_scriptpubkey(out.address))
-            for out in data.outputs
-        ]
+        job = start_filter_scan(data.network, data.start_height)
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
+    return job.progress
 
-        descriptors = {}
-        for _, masterpub in enumerate(data.masterpubs):
-            descriptors[masterpub.id] = parse_key(masterpub.public_key)
 
-        inputs_extra: list[dict] = []
+@watchonly_api_router.get(
+    "/api/v1/filterscan/{network}", dependencies=[Depends(check_admin)]
+)
+async def api_filter_scan_progress(network: str) -> FilterScanProgress:
+    job = get_filter_scan(network)
+    if not job:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="No scan for this network."
+        )
+    return job.progress
+
+
+@watchonly_api_router.get("/api/v1/events/{wallet_id}")
+async def api_wallet_events(
+    wallet_id: str, key_info: WalletTypeInfo = Depends(require_invoice_key)
+) -> EventSourceResponse:
+    """
+    Server-sent events with the activity of the wallet addresses: `address`
+    (amount changed), `block` and `error` (the stream ends). The addresses are
+    watched while there are subscribers. Browsers can pass the key in the
+    `api-key` query parameter.
+    """
+    wallet = await get_watch_wallet(wallet_id)
+    if not wallet or wallet.user != key_info.wallet.user:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Wallet does not exist."
+        )
 
-        for inp in data.inputs:
-            bip32_derivations = {}
-            descriptor = descriptors[inp.wallet][0]
-            d = descriptor.derive(inp.address_index, inp.branch_index)
-            for k in d.keys:
-                bip32_derivations[PublicKey.parse(k.sec())] = DerivationPath(
-                    k.origin.fingerprint, k.origin.derivation
-                )
-            inputs_extra.append(
-                {
-                    "bip32_derivations": bip32_derivations,
-                    "non_witness_utxo": Transaction.from_string(inp.tx_hex),
-                }
+    config = await get_config(key_info.wallet.user)
+    queue = subscribe(wallet, config)
+
+    async def events():
+        try:
+            while True:
+                event = await queue.get()
+                yield {"event": event["type"], "data": json.dumps(event)}
+                if event["type"] == "error":
+                    # the watcher has stopped, the client reconnects
+                    break
+        finally:
+            unsubscribe(wallet_id, queue)
+
+    return EventSourceResponse(events())
+
+
+#############################PSBT##########################
+
+
+@watchonly_api_router.post("/api/v1/coinselect")
+async def api_coin_select(
+    data: CoinSelect, key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> CoinSelection:
+    wallets = {}
+    wallet_ids = data.wallets + ([data.change_wallet] if data.change_wallet else [])
+    for wallet_id in wallet_ids:
+        wallet = await get_watch_wallet(wallet_id)
+        if not wallet or wallet.user != key_info.wallet.user:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND, detail="Wallet does not exist."
             )
+        wallets[wallet_id] = wallet
+    if not wallets:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="No wallets.")
 
-        tx = Transaction(vin=vin, vout=vout)
-        psbt = PSBT(tx)
+    try:
+        return await select_wallet_coins(data, wallets)
+    except Exception as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
 
-        for i, inp_extra in enumerate(inputs_extra):
-            psbt.inputs[i].bip32_derivations = inp_extra["bip32_derivations"]
-            psbt.inputs[i].non_witness_utxo = inp_extra.get("non_witness_utxo", None)
 
-        outputs_extra = []
-        bip32_derivations = {}
-        for out in data.outputs:
-            if out.branch_index == 1:
-                assert out.wallet
-                descriptor = descriptors[out.wallet][0]
-                d = descriptor.derive(out.address_index, out.branch_index)
-                for k in d.keys:
-                    bip32_derivations[PublicKey.parse(k.sec())] = DerivationPath(
-                        k.origin.fingerprint, k.origin.derivation
-                    )
-                outputs_extra.append({"bip32_derivations": bip32_derivations})
+@watchonly_api_router.post("/api/v1/psbt")
+async def api_psbt_create(
+    data: CreatePsbt,
+    response: Response,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+):
+    try:
+        wallets = {masterpub.id: masterpub.public_key for masterpub in data.masterpubs}
+        missing_tx_ids = [inp.tx_id for inp in data.inputs if not inp.tx_hex]
+        if missing_tx_ids:
+            _, network = parse_key(wallets[data.inputs[0].wallet])
+            assert network, "Unknown network"
+            txs = await get_transactions_hex(
+                await _chain_backend(key_info.wallet.user, network["name"]),
+                missing_tx_ids,
+            )
+            for inp in data.inputs:
+                inp.tx_hex = inp.tx_hex or txs[inp.tx_id]
 
-        for i, out_extra in enumerate(outputs_extra):
-            psbt.outputs[i].bip32_derivations = out_extra["bip32_derivations"]
+        psbt, duration = await run_in_worker(create_psbt, data)
+        response.headers["Server-Timing"] = server_timing("psbt", duration)
+        return psbt
+
+    except Exception as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
 
-        return psbt.to_string()
 
+@watchonly_api_router.post("/api/v1/psbt/stream")
+async def api_psbt_create_stream(
+    req: Request, key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> StreamingResponse:
+    """
+    PSBT for (consolidation) transactions with a large number of inputs.
+    The request body is NDJSON: a `PsbtStreamHeader` on the first line, then
+    one `TransactionInput` per line. Segwit inputs only carry the spent output
+    (`witness_utxo`). The binary PSBT is streamed back.
+    """
+    spool = SpooledTemporaryFile(max_size=PSBT_SPOOL_MAX_SIZE)
+    try:
+        header: Optional[PsbtStreamHeader] = None
+        wallets: dict[str, str] = {}
+        outpoints: list[tuple[str, int]] = []
+        batch: list[TransactionInput] = []
+        async for line in _ndjson_lines(req):
+            if header is None:
+                header = PsbtStreamHeader.parse_raw(line)
+                wallets = {m.id: m.public_key for m in header.masterpubs}
+                continue
+            inp = TransactionInput.parse_raw(line)
+            outpoints.append((inp.tx_id, inp.vout))
+            batch.append(inp)
+            if len(batch) >= PSBT_STREAM_BATCH_SIZE:
+                spool.write(await _serialize_inputs(key_info, wallets, batch))
+                batch = []
+        if header is None or not outpoints:
+            raise ValueError("No inputs.")
+        if batch:
+            spool.write(await _serialize_inputs(key_info, wallets, batch))
+
+        psbt_header, _ = await run_in_worker(
+            serialize_psbt_header, outpoints, header.outputs
+        )
+        psbt_outputs, _ = await run_in_worker(
+            serialize_psbt_outputs, wallets, header.outputs
+        )
     except Exception as exc:
+        spool.close()
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
         ) from exc
 
+    async def content():
+        try:
+            yield psbt_header
+            spool.seek(0)
+            while chunk := spool.read(STREAM_CHUNK_SIZE):
+                yield chunk
+            yield psbt_outputs
+        finally:
+            spool.close()
+
+    return StreamingResponse(
+        content(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="transaction.psbt"'},
+    )
+
+
+async def _serialize_inputs(
+    key_info: WalletTypeInfo, wallets: dict[str, str], inputs: list[TransactionInput]
+) -> bytes:
+    # only the legacy inputs need the previous transaction
+    missing_tx_ids = [
+        inp.tx_id
+        for inp in inputs
+        if not inp.tx_hex and not parse_key(wallets[inp.wallet])[0].is_segwit
+    ]
+    if missing_tx_ids:
+        _, network = parse_key(wallets[inputs[0].wallet])
+        assert network, "Unknown network"
+        txs = await get_transactions_hex(
+            await _chain_backend(key_info.wallet.user, network["name"]),
+            missing_tx_ids,
+        )
+        for inp in inputs:
+            inp.tx_hex = inp.tx_hex or txs.get(inp.tx_id)
+    serialized, _ = await run_in_worker(serialize_psbt_inputs, wallets, inputs)
+    return serialized
+
 
 @watchonly_api_router.put(
     "/api/v1/psbt/utxos", dependencies=[Depends(require_admin_key)]
@@ -313,34 +575,32 @@ async def api_psbt_utxos_tx(req: Request):
         ) from exc
 
 
-@watchonly_api_router.put(
-    "/api/v1/psbt/extract", dependencies=[Depends(require_admin_key)]
-)
-async def api_psbt_extract_tx(data: ExtractPsbt) -> SignedTransaction:
-    network = NETWORKS["main"] if data.network == "Mainnet" else NETWORKS["test"]
+@watchonly_api_router.put("/api/v1/psbt/extract")
+async def api_psbt_extract_tx(
+    data: ExtractPsbt,
+    response: Response,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> SignedTransaction:
     try:
-        psbt = PSBT.from_base64(data.psbt_base64)
-        for i, inp in enumerate(data.inputs):
-            psbt.inputs[i].non_witness_utxo = Transaction.from_string(inp.tx_hex)
-
-        final_psbt = finalizer.finalize_psbt(psbt)
-        if not final_psbt:
-            raise ValueError("PSBT cannot be finalized!")
-
-        tx_hex = final_psbt.to_string()
-        transaction = Transaction.from_string(tx_hex)
-        tx = {
-            "locktime": transaction.locktime,
-            "version": transaction.version,
-            "outputs": [],
-            "fee": psbt.fee(),
-        }
-
-        for out in transaction.vout:
-            tx["outputs"].append(
-                {"amount": out.value, "address": out.script_pubkey.address(network)}
+        inputs_tx_hex = [inp.tx_hex for inp in data.inputs]
+        psbt_tx_ids, _ = await run_in_worker(psbt_missing_tx_ids, data.psbt_base64)
+        missing_tx_ids = [
+            tx_id for tx_id in psbt_tx_ids[len(inputs_tx_hex) :] if tx_id is not None
+        ]
+        if missing_tx_ids:
+            txs = await get_transactions_hex(
+                await _chain_backend(key_info.wallet.user, data.network),
+                missing_tx_ids,
             )
-        signed_tx = SignedTransaction(tx_hex=tx_hex, tx_json=json.dumps(tx))
+            inputs_tx_hex += [
+                txs[tx_id] if tx_id else ""
+                for tx_id in psbt_tx_ids[len(inputs_tx_hex) :]
+            ]
+
+        signed_tx, duration = await run_in_worker(
+            extract_psbt, data.psbt_base64, inputs_tx_hex, data.network
+        )
+        response.headers["Server-Timing"] = server_timing("extract", duration)
         return signed_tx
     except Exception as exc:
         raise HTTPException(
@@ -351,20 +611,10 @@ async def api_psbt_extract_tx(data: ExtractPsbt) -> SignedTransaction:
 @watchonly_api_router.put(
     "/api/v1/tx/extract", dependencies=[Depends(require_admin_key)]
 )
-async def api_extract_tx(data: ExtractTx):
-    network = NETWORKS["main"] if data.network == "Mainnet" else NETWORKS["test"]
+async def api_extract_tx(data: ExtractTx, response: Response):
     try:
-        transaction = Transaction.from_string(data.tx_hex)
-        tx = {
-            "locktime": transaction.locktime,
-            "version": transaction.version,
-            "outputs": [],
-        }
-
-        for out in transaction.vout:
-            tx["outputs"].append(
-                {"amount": out.value, "address": out.script_pubkey.address(network)}
-            )
+        tx, duration = await run_in_worker(extract_tx, data.tx_hex, data.network)
+        response.headers["Server-Timing"] = server_timing("extract", duration)
         return {"tx_json": tx}
     except Exception as exc:
         raise HTTPException(
@@ -372,6 +622,57 @@ async def api_extract_tx(data: ExtractTx):
         ) from exc
 
 
+@watchonly_api_router.put(
+    "/api/v1/tx/decode", dependencies=[Depends(require_admin_key)]
+)
+async def api_decode_transactions(data: DecodeTransactions) -> StreamingResponse:
+    """
+    Decode up to `TX_DECODE_MAX_ITEMS` raw transactions or PSBTs in the worker
+    pool. One JSON object per transaction is streamed back (NDJSON), in order.
+    """
+    if len(data.transactions) > TX_DECODE_MAX_ITEMS:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"At most {TX_DECODE_MAX_ITEMS} transactions per request.",
+        )
+    # all the batches are queued at once, the pool decodes them concurrently
+    jobs = [
+        asyncio.ensure_future(
+            run_in_worker(
+                decode_transactions,
+                data.transactions[start : start + TX_DECODE_BATCH_SIZE],
+                data.network,
+            )
+        )
+        for start in range(0, len(data.transactions), TX_DECODE_BATCH_SIZE)
+    ]
+
+    async def content():
+        try:
+            index = 0
+            for job in jobs:
+                decoded, _ = await job
+                lines = []
+                for tx in decoded:
+                    lines.append(json.dumps({"index": index, **tx}) + "\n")
+                    index += 1
+                yield "".join(lines)
+        finally:
+            for job in jobs:
+                job.cancel()
+
+    return StreamingResponse(content(), media_type="application/x-ndjson")
+
+
+@watchonly_api_router.get("/api/v1/utxos/{wallet_id}")
+async def api_get_utxos(
+    wallet_id: str, key_info: WalletTypeInfo = Depends(require_invoice_key)
+) -> list[WalletUtxo]:
+    """UTXOs of the wallet found by the last server side scan"""
+    await _user_wallet(wallet_id, key_info.wallet.user)
+    return await get_utxos(wallet_id)
+
+
 @watchonly_api_router.post("/api/v1/tx")
 async def api_tx_broadcast(
     data: SerializedTransaction, key_info: WalletTypeInfo = Depends(require_admin_key)
@@ -383,16 +684,8 @@ async def api_tx_broadcast(
                 "Cannot broadcast transaction. Mempool endpoint not defined!"
             )
 
-        endpoint = (
-            config.mempool_endpoint
-            if config.network == "Mainnet"
-            else config.mempool_endpoint + "/testnet"
-        )
-        async with httpx.AsyncClient() as client:
-            r = await client.post(endpoint + "/api/tx", content=data.tx_hex)
-            r.raise_for_status()
-            tx_id = r.text
-            return tx_id
+        backend = chain_backend(config, config.network)
+        return await backend.broadcast(data.tx_hex)
     except Exception as exc:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
@@ -413,3 +706,38 @@ async def api_get_config(
 ) -> Config:
     config = await get_config(key_info.wallet.user)
     return config
+
+
+@watchonly_api_router.get(
+    "/api/v1/metrics",
+    response_class=PlainTextResponse,
+    dependencies=[Depends(check_admin)],
+)
+async def api_metrics():
+    """Prometheus metrics, see `metrics.py`"""
+    if not metrics.enabled:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail="Metrics are disabled, set WATCHONLY_METRICS=true.",
+        )
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+async def _chain_backend(user: str, network: str) -> ChainBackend:
+    config = await get_config(user)
+    return chain_backend(config, network)
+
+
+async def _ndjson_lines(req: Request) -> AsyncIterator[bytes]:
+    """Non empty lines of the NDJSON request body, as they are received"""
+    buffer = b""
+    async for chunk in req.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
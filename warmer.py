@@ -0,0 +1,106 @@
+"""
+Background task keeping addresses derived ahead of use for every wallet, so
+that `crud.get_fresh_address()` (new charges and invoices) finds them in the
+database instead of deriving keys in the request.
+The pool of a wallet is refilled in one batch when its unused addresses drop
+below half of `WATCHONLY_ADDRESS_POOL` (receive) or
+`WATCHONLY_CHANGE_ADDRESS_POOL` (change): right after an allocation, and for
+all the wallets every `WARMER_INTERVAL` seconds.
+"""
+
+import asyncio
+import os
+from typing import Optional
+
+from loguru import logger
+
+from . import crud
+from .crud import create_fresh_addresses, get_address_pools
+
+ADDRESS_POOL = int(os.getenv("WATCHONLY_ADDRESS_POOL", "50"))
+CHANGE_ADDRESS_POOL = int(os.getenv("WATCHONLY_CHANGE_ADDRESS_POOL", "10"))
+WARMER_INTERVAL = 60
+
+
+class AddressPoolWarmer:
+    def __init__(
+        self,
+        receive_pool: int = ADDRESS_POOL,
+        change_pool: int = CHANGE_ADDRESS_POOL,
+        interval: float = WARMER_INTERVAL,
+    ):
+        self.pool_sizes = {0: receive_pool, 1: change_pool}
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+        # wallets to check as soon as possible
+        self._pending: set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def wake(self, wallet_id: str):
+        self._pending.add(wallet_id)
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        await self._refill_safely()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                await self._refill_safely()
+                continue
+            self._wakeup.clear()
+            wallet_ids, self._pending = list(self._pending), set()
+            await self._refill_safely(wallet_ids)
+
+    async def _refill_safely(self, wallet_ids: Optional[list[str]] = None):
+        try:
+            await self.refill(wallet_ids)
+        except Exception as exc:
+            logger.warning(f"watchonly: refilling the address pools failed: {exc!s}")
+
+    async def refill(self, wallet_ids: Optional[list[str]] = None) -> int:
+        """Derive the addresses missing from the pools below the low-water
+        mark, returns the number of addresses created"""
+        created = 0
+        for pool in await get_address_pools(wallet_ids):
+            size = self.pool_sizes[pool.branch_index]
+            if size <= 0 or pool.unused >= max(1, size // 2):
+                continue
+            addresses = await create_fresh_addresses(
+                pool.wallet,
+                pool.last_index + 1,
+                pool.last_used_index + size + 1,
+                pool.branch_index == 1,
+            )
+            created += len(addresses)
+        return created
+
+
+_warmer: Optional[AddressPoolWarmer] = None
+
+
+def start_warmer(**kwargs) -> AddressPoolWarmer:
+    global _warmer
+    if _warmer is None:
+        _warmer = AddressPoolWarmer(**kwargs)
+        crud.address_allocated_hooks.append(_warmer.wake)
+        _warmer.task = asyncio.create_task(_warmer.run())
+    return _warmer
+
+
+def wake_warmer(wallet_id: str):
+    """Check the pools of the wallet now (e.g. when it is created)"""
+    if _warmer:
+        _warmer.wake(wallet_id)
+
+
+def stop_warmer():
+    global _warmer
+    if _warmer is None:
+        return
+    crud.address_allocated_hooks.remove(_warmer.wake)
+    if _warmer.task:
+        _warmer.task.cancel()
+    _warmer = None
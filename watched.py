@@ -0,0 +1,127 @@
+"""
+In-memory index of the addresses watched by all the wallets, so that the
+outputs of a block or of the mempool can be matched without a database round
+trip per output. See `crud.get_address_index()`.
+"""
+
+from collections.abc import Iterable
+from typing import NamedTuple, Optional
+
+from embit import script
+from embit.transaction import Transaction
+
+
+class WatchedAddress(NamedTuple):
+    wallet: str
+    branch_index: int
+    address_index: int
+
+
+class AddressIndex:
+    """
+    Owners of each watched scriptPubKey. Only the scripts are kept (an address
+    is looked up by its script), one dict entry per script. Several wallets
+    own the same script when their users imported the same masterpub.
+    The index is per process: addresses created by another LNbits process are
+    only seen after `crud.reload_address_index()`.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        # set while the addresses are read from the database
+        self.loading = False
+        self._scripts: dict[bytes, tuple[WatchedAddress, ...]] = {}
+        self._count = 0
+        # wallet ids are shared by all the entries of the wallet
+        self._wallets: dict[str, str] = {}
+        # changes made while loading
+        self._added: list[tuple[bytes, WatchedAddress]] = []
+        self._removed_wallets: set[str] = set()
+
+    def __len__(self) -> int:
+        """Number of (script, owner) entries"""
+        return self._count
+
+    def __contains__(self, script_pubkey: bytes) -> bool:
+        return script_pubkey in self._scripts
+
+    def add(self, wallet: str, branch_index: int, address_index: int, spk: bytes):
+        if not (self.loaded or self.loading):
+            return
+        wallet = self._wallets.setdefault(wallet, wallet)
+        owner = WatchedAddress(wallet, branch_index, address_index)
+        owners = self._scripts.get(spk, ())
+        others = tuple(o for o in owners if o.wallet != wallet)
+        self._scripts[spk] = (*others, owner)
+        self._count += len(others) + 1 - len(owners)
+        if self.loading:
+            self._added.append((spk, owner))
+
+    def remove_wallet(self, wallet: str):
+        if self.loading:
+            self._removed_wallets.add(wallet)
+            self._added = [
+                (spk, owner) for spk, owner in self._added if owner.wallet != wallet
+            ]
+        if self._wallets.pop(wallet, None) is None:
+            return
+        scripts: dict[bytes, tuple[WatchedAddress, ...]] = {}
+        for spk, owners in self._scripts.items():
+            kept = tuple(o for o in owners if o.wallet != wallet)
+            if kept:
+                scripts[spk] = kept
+            self._count -= len(owners) - len(kept)
+        self._scripts = scripts
+
+    def start_loading(self):
+        """Called before the addresses are read from the database"""
+        self.loading = True
+        self._added, self._removed_wallets = [], set()
+
+    def load(self, entries: Iterable[tuple[str, int, int, bytes]]):
+        """Replace the index with the `(wallet, branch_index, address_index,
+        script_pubkey)` read from the database. The changes made since
+        `start_loading()` are kept."""
+        added, removed_wallets = self._added, self._removed_wallets
+        self.clear()
+        self.loaded = True
+        for wallet, branch_index, address_index, spk in entries:
+            if wallet not in removed_wallets:
+                self.add(wallet, branch_index, address_index, spk)
+        for spk, owner in added:
+            self.add(*owner, spk)
+
+    def clear(self):
+        self.loaded = self.loading = False
+        self._scripts, self._wallets, self._count = {}, {}, 0
+        self._added, self._removed_wallets = [], set()
+
+    def scripts(self, wallets: Optional[set[str]] = None) -> list[bytes]:
+        """The scripts of all the wallets, or of the given ones"""
+        if wallets is None:
+            return list(self._scripts)
+        return [
+            spk
+            for spk, owners in self._scripts.items()
+            if any(owner.wallet in wallets for owner in owners)
+        ]
+
+    def get_script(self, script_pubkey: bytes) -> tuple[WatchedAddress, ...]:
+        """The owners of the script, empty if it is not watched"""
+        return self._scripts.get(script_pubkey, ())
+
+    def get_address(self, address: str) -> tuple[WatchedAddress, ...]:
+        try:
+            spk = script.address_to_scriptpubkey(address)
+        except Exception:
+            return ()
+        return self.get_script(spk.data)
+
+    def match_outputs(self, tx: Transaction) -> list[tuple[int, WatchedAddress]]:
+        """(vout, owner) of the outputs of the transaction paying to a watched
+        address, once per owner"""
+        matches = []
+        for vout, out in enumerate(tx.vout):
+            for owner in self._scripts.get(out.script_pubkey.data, ()):
+                matches.append((vout, owner))
+        return matches
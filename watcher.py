@@ -0,0 +1,271 @@
+"""
+Watches the addresses of the wallets that have subscribers (browsers connected
+to `GET /api/v1/events/{wallet_id}`). New transactions are detected with the
+mempool.space websocket API (`track-addresses` and the block feed), polling is
+used when the websocket is not available. With the Electrum backend the
+scripthashes and the headers are subscribed to instead. The changed addresses
+are stored and an event is pushed to the subscribers.
+"""
+
+import asyncio
+import json
+from typing import Optional
+
+import httpx
+import websockets
+from loguru import logger
+
+from .backends import ElectrumBackend, EsploraBackend, chain_backend
+from .crud import create_gap_addresses, get_watched_addresses
+from .electrum import DISCONNECTED, ElectrumError
+from .helpers import address_scripthash, mempool_ws_url
+from .mempool import address_balance, address_tx_count
+from .models import Address, Config, ScannedAddress, WalletAccount
+from .scanner import save_scanned_addresses, scan_addresses
+
+# addresses tracked per wallet, mempool.space limits the tracked addresses
+WATCH_MAX_ADDRESSES = 100
+POLL_INTERVAL = 30
+# how long polling is used before trying the websocket again
+WEBSOCKET_RETRY_INTERVAL = 300
+WEBSOCKET_OPEN_TIMEOUT = 10
+ELECTRUM_RETRY_INTERVAL = 30
+# events kept for a slow subscriber, the oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class WalletWatcher:
+    def __init__(
+        self,
+        wallet: WalletAccount,
+        config: Config,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
+        self.wallet = wallet
+        self.config = config
+        self.backend = chain_backend(
+            config,
+            wallet.network,
+            concurrency=config.scan_concurrency,
+            rate_limit=config.scan_rate_limit,
+            http_client=http_client,
+        )
+        self.ws_url = mempool_ws_url(config.mempool_endpoint, wallet.network)
+        self.mode = "websocket"  # "polling" or "electrum"
+        self.subscribers: set[asyncio.Queue] = set()
+        self.task: Optional[asyncio.Task] = None
+        # watched addresses by address
+        self.addresses: dict[str, Address] = {}
+        # addresses with unconfirmed UTXOs, refreshed on every new block
+        self.unconfirmed: set[str] = set()
+        # Electrum status and address of the watched addresses, by scripthash
+        self.statuses: dict[str, Optional[str]] = {}
+        self._scripthash_addresses: dict[str, str] = {}
+
+    def publish(self, event: dict):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def run(self):
+        try:
+            await self.load_addresses()
+            if isinstance(self.backend, ElectrumBackend):
+                await self._watch_electrum(self.backend)
+            elif isinstance(self.backend, EsploraBackend):
+                await self._watch_esplora(self.backend)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning(f"Watching wallet '{self.wallet.id}' failed: {exc!s}")
+            self.publish({"type": "error", "error": str(exc)})
+
+    async def load_addresses(self) -> bool:
+        """Load the addresses to watch, returns `True` if they have changed"""
+        await create_gap_addresses(
+            self.wallet.id, self.config.receive_gap_limit, self.config.change_gap_limit
+        )
+        addresses = await get_watched_addresses(self.wallet.id, WATCH_MAX_ADDRESSES)
+        changed = set(self.addresses) != {a.address for a in addresses}
+        self.addresses = {a.address: a for a in addresses}
+        return changed
+
+    async def refresh(self, addresses: list[str]) -> bool:
+        """
+        Scan the addresses, store and publish the changes.
+        Returns `True` if the watched addresses have changed (gap extended).
+        """
+        watched = [self.addresses[a] for a in addresses if a in self.addresses]
+        results = await scan_addresses(watched, self.backend)
+        return await self._save(list(zip(watched, results)))
+
+    async def _save(self, scanned: list[tuple[Address, ScannedAddress]]) -> bool:
+        for address, result in scanned:
+            if any(not utxo.confirmed for utxo in result.utxos):
+                self.unconfirmed.add(address.address)
+            else:
+                self.unconfirmed.discard(address.address)
+
+        results = {address.id: result for address, result in scanned}
+        changed = await save_scanned_addresses(self.wallet.id, scanned)
+        for address in changed:
+            utxos = results[address.id].utxos
+            self.publish(
+                {
+                    "type": "address",
+                    "address": address.dict(),
+                    "utxos": [utxo.dict() for utxo in utxos],
+                }
+            )
+        return bool(changed) and await self.load_addresses()
+
+    async def _watch_esplora(self, backend: EsploraBackend):
+        while True:
+            try:
+                await self._watch_websocket()
+            except (
+                OSError,
+                asyncio.TimeoutError,
+                httpx.HTTPError,
+                websockets.WebSocketException,
+            ) as exc:
+                logger.debug(f"watchonly: websocket '{self.ws_url}': {exc!s}")
+            await self._poll(backend, WEBSOCKET_RETRY_INTERVAL)
+
+    async def _watch_websocket(self):
+        async with websockets.connect(
+            self.ws_url, open_timeout=WEBSOCKET_OPEN_TIMEOUT
+        ) as ws:
+            self.mode = "websocket"
+            await ws.send(json.dumps({"action": "want", "data": ["blocks"]}))
+            await ws.send(json.dumps({"track-addresses": list(self.addresses)}))
+            async for message in ws:
+                data = json.loads(message)
+                addresses = set(data.get("multi-address-transactions", {}))
+                if "block" in data:
+                    self.publish({"type": "block", "height": data["block"]["height"]})
+                    # the unconfirmed funds might be confirmed now
+                    addresses |= self.unconfirmed
+                if addresses and await self.refresh(list(addresses)):
+                    await ws.send(json.dumps({"track-addresses": list(self.addresses)}))
+
+    async def _poll(self, backend: EsploraBackend, duration: float):
+        self.mode = "polling"
+        loop = asyncio.get_running_loop()
+        end = loop.time() + duration
+        while loop.time() < end:
+            try:
+                await self._poll_once(backend)
+            except httpx.HTTPError as exc:
+                logger.debug(f"watchonly: polling '{backend.client.api_url}': {exc!s}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _poll_once(self, backend: EsploraBackend):
+        # one request per address, the UTXOs are only fetched for the changed ones
+        addresses = list(self.addresses.values())
+        stats = await asyncio.gather(
+            *[backend.client.get_address_stats(a.address) for a in addresses]
+        )
+        changed = [
+            address.address
+            for address, address_stats in zip(addresses, stats)
+            if address.address in self.unconfirmed
+            or address.amount != address_balance(address_stats)
+            or address.has_activity != (address_tx_count(address_stats) > 0)
+        ]
+        if changed:
+            await self.refresh(changed)
+
+    async def _watch_electrum(self, backend: ElectrumBackend):
+        self.mode = "electrum"
+        while True:
+            notifications = backend.client.listen()
+            try:
+                await self._subscribe_electrum(backend)
+                await backend.client.request("blockchain.headers.subscribe")
+                while True:
+                    method, params = await notifications.get()
+                    if method == DISCONNECTED:
+                        raise ConnectionError("Electrum connection closed.")
+                    addresses: set[str] = set()
+                    if method == "blockchain.headers.subscribe":
+                        self.publish({"type": "block", "height": params[0]["height"]})
+                        # the unconfirmed funds might be confirmed now
+                        addresses |= self.unconfirmed
+                    elif method == "blockchain.scripthash.subscribe":
+                        scripthash, status = params
+                        if scripthash in self.statuses:
+                            self.statuses[scripthash] = status
+                            addresses.add(self._scripthash_addresses[scripthash])
+                    if addresses and await self.refresh(list(addresses)):
+                        await self._subscribe_electrum(backend)
+            except (OSError, asyncio.TimeoutError, ElectrumError) as exc:
+                logger.debug(f"watchonly: Electrum '{backend.client.url}': {exc!s}")
+                await asyncio.sleep(ELECTRUM_RETRY_INTERVAL)
+            finally:
+                backend.client.unlisten(notifications)
+
+    async def _subscribe_electrum(self, backend: ElectrumBackend):
+        """Subscribe to the watched addresses, the ones that have changed since
+        the previous subscription (e.g. before a reconnection) are refreshed"""
+        self._scripthash_addresses = {
+            a.scripthash or address_scripthash(a.address): a.address
+            for a in self.addresses.values()
+        }
+        statuses = await backend.subscribe(list(self.addresses.values()))
+        changed = [
+            self._scripthash_addresses[scripthash]
+            for scripthash, status in statuses.items()
+            if self.statuses.get(scripthash, status) != status
+        ]
+        self.statuses = statuses
+        if changed and await self.refresh(changed):
+            await self._subscribe_electrum(backend)
+
+
+watchers: dict[str, WalletWatcher] = {}
+
+
+def subscribe(
+    wallet: WalletAccount,
+    config: Config,
+    http_client: Optional[httpx.AsyncClient] = None,
+) -> asyncio.Queue:
+    """Queue receiving the events of the wallet, starts watching it if needed"""
+    watcher = watchers.get(wallet.id)
+    if not watcher or not watcher.task or watcher.task.done():
+        watcher = WalletWatcher(wallet, config, http_client)
+        watcher.task = asyncio.create_task(watcher.run())
+        watcher.task.add_done_callback(lambda _: _forget(watcher))
+        watchers[wallet.id] = watcher
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    watcher.subscribers.add(queue)
+    return queue
+
+
+def _forget(watcher: WalletWatcher):
+    """Drop the watcher once it has stopped (e.g. failed), the next
+    subscription starts a new one"""
+    if watchers.get(watcher.wallet.id) is watcher:
+        del watchers[watcher.wallet.id]
+
+
+def unsubscribe(wallet_id: str, queue: asyncio.Queue):
+    """Stop watching the wallet once the last subscriber is gone"""
+    watcher = watchers.get(wallet_id)
+    # the queue of a watcher that has failed and been replaced
+    if not watcher or queue not in watcher.subscribers:
+        return
+    watcher.subscribers.discard(queue)
+    if not watcher.subscribers:
+        if watcher.task:
+            watcher.task.cancel()
+        del watchers[wallet_id]
+
+
+def stop_watchers():
+    for watcher in watchers.values():
+        if watcher.task:
+            watcher.task.cancel()
+    watchers.clear()
@@ -0,0 +1,90 @@
+"""
+Worker pool for the CPU bound work (PSBT building, finalization, parsing),
+so that it does not block the event loop shared by all the LNbits extensions.
+
+The pool is configured with environment variables:
+- `WATCHONLY_WORKER_POOL`: `thread` (default) or `process`
+- `WATCHONLY_WORKERS`: number of workers (default 2)
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, TypeVar
+
+from loguru import logger
+
+from . import metrics
+
+T = TypeVar("T")
+
+WORKER_POOL = os.getenv("WATCHONLY_WORKER_POOL", "thread")
+WORKERS = int(os.getenv("WATCHONLY_WORKERS", "2"))
+
+_executor: Optional[Executor] = None
+
+
+def _warmup():
+    # importing (and using once) embit takes a while, do it before the first job
+    from embit.descriptor import Descriptor  # noqa: F401
+    from embit.psbt import PSBT  # noqa: F401
+
+    from . import psbt  # noqa: F401
+
+
+def _ready() -> bool:
+    return True
+
+
+def start_workers(pool: str = WORKER_POOL, workers: int = WORKERS) -> Executor:
+    """Create the worker pool and warm up all the workers"""
+    global _executor
+    if _executor is not None:
+        return _executor
+    if pool == "process":
+        # `spawn`: forking the running event loop and its threads is not safe
+        _executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warmup,
+        )
+    else:
+        _executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="watchonly",
+            initializer=_warmup,
+        )
+    # workers are created lazily, submit one job per worker to start them
+    for _ in range(workers):
+        _executor.submit(_ready)
+    return _executor
+
+
+def stop_workers():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run_in_worker(func: Callable[..., T], *args) -> tuple[T, float]:
+    """Run `func(*args)` in the worker pool.
+    Returns the result and the duration (in milliseconds), including the time
+    spent waiting for a free worker."""
+    executor = start_workers()
+    start = time.perf_counter()
+    result = await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    duration = time.perf_counter() - start
+
+    if metrics.enabled:
+        metrics.WORKER_JOBS.observe(duration, func.__name__)
+    logger.debug(f"watchonly: {func.__name__} took {duration * 1000:.1f}ms")
+    return result, duration * 1000
+
+
+def server_timing(name: str, duration: float) -> str:
+    """`Server-Timing` header value"""
+    return f"{name};dur={duration:.1f}"